@@ -14,6 +14,9 @@ import pandas as pd
 import seaborn as sns
 from tqdm.auto import tqdm
 
+from byprot.utils.protein.tm_scoring import TMAlignScorer
+from byprot.utils.protein.tm_store import TMScoreStore
+
 
 def run_tmalign(query, reference, fast=True):
     # --> one to one
@@ -57,20 +60,18 @@ def tm_one2refs(
     return values
 
 
-def tm_set2set(querys, targets, save_path, n_threads=mp.cpu_count()):
+def tm_set2set(
+    querys, targets, save_path, n_threads=mp.cpu_count(), scorer=None
+):
+    # TM-align in process (tmtools) in a pool, skipping the pairs `scorer`
+    # (a TMAlignScorer or TMScoreStore) has scored before
+    scorer = scorer or TMAlignScorer(num_workers=n_threads)
+    tm_scores = scorer.matrix(querys, targets)
     save_dict = {
-        "query": [],
-        "tm_scores": [],
+        "query": list(querys),
+        "tm_scores": [list(row) for row in tm_scores],
     }
 
-    print("using {:d} threads", n_threads)
-    cnt = 0
-    for pdb in tqdm(querys[:]):
-        tm_scores = tm_one2refs(pdb, targets, n_threads=n_threads)
-        save_dict["query"].append(pdb)
-        save_dict["tm_scores"].append(tm_scores)
-        cnt += 1
-
     save_df = pandas.DataFrame.from_dict(save_dict)
     save_df.to_csv(os.path.join(save_path, "inter_tmscore.csv"))
 
@@ -97,18 +98,40 @@ def main():
         required=True,
         help='Specify the type. Options are "diversity" or "novelty".',
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=mp.cpu_count(),
+        help="processes running TM-align",
+    )
+    parser.add_argument(
+        "--score_store",
+        type=str,
+        default=None,
+        help="an SQLite store of TM-scores, to align only the pairs not "
+        "scored in earlier runs",
+    )
     args = parser.parse_args()
 
     query_dir = args.query_dir
     reference_dir = args.ref_dir
+    # shared by all subdirectories, so the references are read once
+    store = None
+    if args.score_store is not None:
+        store = TMScoreStore(args.score_store, num_workers=args.num_workers)
+    scorer = store or TMAlignScorer(num_workers=args.num_workers)
 
-    if args.cal_type == "diversity":
-        cal_diversity(query_dir, reference_dir)
-    elif args.cal_type == "novelty":
-        cal_novelty(query_dir, reference_dir)
+    try:
+        if args.cal_type == "diversity":
+            cal_diversity(query_dir, reference_dir, scorer)
+        elif args.cal_type == "novelty":
+            cal_novelty(query_dir, reference_dir, scorer)
+    finally:
+        if store is not None:
+            store.close()
 
 
-def cal_novelty(query_dir, reference_dir):
+def cal_novelty(query_dir, reference_dir, scorer=None):
     output_dir = os.path.join(query_dir, "../novelty")
     os.makedirs(output_dir, exist_ok=True)
 
@@ -126,11 +149,14 @@ def cal_novelty(query_dir, reference_dir):
         ]
         os.makedirs(os.path.join(output_dir, dirname), exist_ok=True)
         tm_set2set(
-            query_paths, reference_paths, os.path.join(output_dir, dirname)
-        )  # , mp.cpu_count())
+            query_paths,
+            reference_paths,
+            os.path.join(output_dir, dirname),
+            scorer=scorer,
+        )
 
 
-def cal_diversity(query_dir, reference_dir):
+def cal_diversity(query_dir, reference_dir, scorer=None):
     output_dir = os.path.join(query_dir, "../diversity")
     os.makedirs(output_dir, exist_ok=True)
 
@@ -149,8 +175,11 @@ def cal_diversity(query_dir, reference_dir):
         ]
         os.makedirs(os.path.join(output_dir, dirname), exist_ok=True)
         tm_set2set(
-            query_paths, reference_paths, os.path.join(output_dir, dirname)
-        )  # , mp.cpu_count())
+            query_paths,
+            reference_paths,
+            os.path.join(output_dir, dirname),
+            scorer=scorer,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+"""Equivalence check and benchmark of batched ESMFold folding
+(`FoldingModel.fold_sequences`) against folding one sequence at a time, as
+`FoldingModel._esmf_model` used to.
+
+The atom coordinates of the PDB strings and the mean pLDDTs of both paths
+are compared, then sequences/sec of both are reported. By default, a small
+ESMFold (8M ESM-2, structure module only) runs on CPU:
+
+    python benchmarks/bench_batched_folding.py --num_seqs 32 --device cpu
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from byprot.utils.protein.folding_model import FoldingModel
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def pdb_atoms(pdb):
+    """(atom, residue, chain) names and coordinates of the ATOM records of a
+    PDB string."""
+    names, coords = [], []
+    for line in pdb.splitlines():
+        if line.startswith("ATOM"):
+            names.append((line[12:16], line[17:20], line[21:27]))
+            coords.append(
+                [float(line[30:38]), float(line[38:46]), float(line[46:54])]
+            )
+    return names, np.array(coords)
+
+
+@torch.no_grad()
+def fold_one_by_one(esmf, sequences):
+    results = []
+    for seq in sequences:
+        esmf_outputs = esmf.infer(seq)
+        results.append(
+            {
+                "pdb": esmf.output_to_pdb(esmf_outputs)[0],
+                "plddt": esmf_outputs["mean_plddt"][0].item(),
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--esmf_model",
+        type=str,
+        default="esmfold_structure_module_only_8M",
+        help="a model of esm.pretrained, e.g., esmfold_v1",
+    )
+    parser.add_argument("--num_seqs", type=int, default=32)
+    parser.add_argument("--min_len", type=int, default=50)
+    parser.add_argument("--max_len", type=int, default=200)
+    parser.add_argument("--max_batch_size", type=int, default=16)
+    parser.add_argument("--max_num_res_squared", type=int, default=500_000)
+    parser.add_argument("--chunk_size", type=int, default=None)
+    parser.add_argument("--atol", type=float, default=5e-2)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    sequences = [
+        "".join(rng.choice(list(AMINO_ACIDS), size=n))
+        for n in rng.integers(args.min_len, args.max_len + 1, args.num_seqs)
+    ]
+    cfg = OmegaConf.create(
+        {
+            "folding_model": "esmf",
+            "esmf_model": args.esmf_model,
+            "esmf_max_batch_size": args.max_batch_size,
+            "esmf_max_num_res_squared": args.max_num_res_squared,
+            "esmf_chunk_size": args.chunk_size,
+        }
+    )
+    folding_model = FoldingModel(cfg, device=args.device)
+    esmf = folding_model.esmf
+
+    # warmup
+    fold_one_by_one(esmf, sequences[:1])
+
+    start = time.perf_counter()
+    reference = fold_one_by_one(esmf, sequences)
+    one_by_one_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    num_batches = 0
+    batched = [None] * len(sequences)
+    for batch in folding_model.fold_sequences(sequences):
+        num_batches += 1
+        for result in batch:
+            batched[result["index"]] = result
+    batched_time = time.perf_counter() - start
+
+    max_coord_diff = max_plddt_diff = 0.0
+    for ref, res in zip(reference, batched):
+        ref_names, ref_coords = pdb_atoms(ref["pdb"])
+        names, coords = pdb_atoms(res["pdb"])
+        assert names == ref_names, "batched PDB has different atoms"
+        max_coord_diff = max(max_coord_diff, np.abs(coords - ref_coords).max())
+        max_plddt_diff = max(max_plddt_diff, abs(res["plddt"] - ref["plddt"]))
+    assert (
+        max_coord_diff < args.atol
+    ), f"batched coordinates differ by {max_coord_diff:.3f} A"
+    print(
+        f"max |batched - one by one| over {len(sequences)} sequences: "
+        f"coordinates {max_coord_diff:.2e} A, mean pLDDT "
+        f"{max_plddt_diff:.2e}"
+    )
+    print(
+        f"one by one: {len(sequences) / one_by_one_time:.2f} sequences/s\n"
+        f"   batched: {len(sequences) / batched_time:.2f} sequences/s "
+        f"({num_batches} batches), speedup "
+        f"{one_by_one_time / batched_time:.2f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Benchmark of the DPLM-2 attention masking: the former dense [B, H, L, L]
+bias against the compact key padding mask plus the `single_modality`
+blockwise path, on a randomly initialized `EsmForDPLM2`.
+
+Both paths are checked to give the same outputs, and peak memory (CUDA)
+and tokens/sec of forward (+ backward) passes are reported:
+
+    python benchmarks/bench_dplm2_attention.py --length 512 --batch_size 8
+"""
+
+import argparse
+import math
+import time
+
+import torch
+from transformers import EsmConfig
+
+from byprot.models.dplm2 import EsmForDPLM2
+
+PAD_ID = 1
+STRUCT_OFFSET = 33
+
+
+def sample_inputs(batch_size, length, vocab_size, device):
+    """[struct; aa] tokens of random lengths, padded within each half."""
+    lengths = torch.randint(length // 2, length + 1, (batch_size,))
+    half = length + 2
+    struct = torch.full((batch_size, half), PAD_ID, dtype=torch.long)
+    aa = torch.full((batch_size, half), PAD_ID, dtype=torch.long)
+    for i, n in enumerate(lengths.tolist()):
+        struct[i, : n + 2] = torch.randint(STRUCT_OFFSET, vocab_size, (n + 2,))
+        aa[i, : n + 2] = torch.randint(4, 24, (n + 2,))
+    input_ids = torch.cat([struct, aa], dim=1).to(device)
+    # 0: struct, 1: aa, 2: pad
+    input_mask = input_ids.ne(PAD_ID)
+    type_ids = ((input_ids < STRUCT_OFFSET) & input_mask).int()
+    type_ids[~input_mask] = 2
+    single_modality = torch.rand(batch_size, device=device) < 0.25
+    return input_ids, type_ids, single_modality
+
+
+def dense_attention_bias(net, input_ids, single_modality):
+    # the attention bias previously built in DPLM2.forward
+    input_mask = input_ids.ne(PAD_ID)
+    L = input_ids.shape[1]
+    num_heads = net.config.num_attention_heads
+    attention_bias = net.esm.get_extended_attention_mask(
+        input_mask, input_ids.shape
+    ).repeat(1, num_heads, L, 1)
+    struct_attention_bias, aa_attention_bias = attention_bias.chunk(2, dim=-2)
+    struct_attention_bias[single_modality, :, :, L // 2 :] = -math.inf
+    aa_attention_bias[single_modality, :, :, : L // 2] = -math.inf
+    return torch.concat([struct_attention_bias, aa_attention_bias], dim=-2)
+
+
+def run_dense(net, input_ids, type_ids, single_modality):
+    attention_bias = dense_attention_bias(net, input_ids, single_modality)
+    return net(
+        input_ids=input_ids, attention_mask=attention_bias, type_ids=type_ids
+    )["logits"]
+
+
+def run_compact(net, input_ids, type_ids, single_modality):
+    attention_bias = net.esm.get_extended_attention_mask(
+        input_ids.ne(PAD_ID), input_ids.shape
+    )
+    return net(
+        input_ids=input_ids,
+        attention_mask=attention_bias,
+        type_ids=type_ids,
+        single_modality=single_modality,
+    )["logits"]
+
+
+def measure(fn, inputs, repeats, backward, device):
+    def _step():
+        logits = fn(*inputs)
+        if backward:
+            logits.float().mean().backward()
+        return logits
+
+    _step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        _step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeats
+    peak = (
+        torch.cuda.max_memory_allocated() / 2**20
+        if device.type == "cuda"
+        else float("nan")
+    )
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--length", type=int, default=510)
+    parser.add_argument("--hidden_size", type=int, default=640)
+    parser.add_argument("--num_layers", type=int, default=6)
+    parser.add_argument("--num_heads", type=int, default=20)
+    parser.add_argument("--vocab_size", type=int, default=8229)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--backward", action="store_true")
+    parser.add_argument("--device", type=str, default=None)
+    args = parser.parse_args()
+
+    device = torch.device(
+        args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    )
+    config = EsmConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        num_hidden_layers=args.num_layers,
+        num_attention_heads=args.num_heads,
+        intermediate_size=args.hidden_size * 4,
+        position_embedding_type="rotary",
+        pad_token_id=PAD_ID,
+        token_dropout=False,
+        max_position_embeddings=2 * args.length + 8,
+    )
+    net = EsmForDPLM2(config, dropout=0.0).to(device)
+    net.train(args.backward)
+
+    inputs = sample_inputs(
+        args.batch_size, args.length, args.vocab_size, device
+    )
+    input_ids, _, single_modality = inputs
+    num_tokens = input_ids.ne(PAD_ID).sum().item()
+
+    with torch.set_grad_enabled(args.backward):
+        dense_logits = run_dense(net, *inputs)
+        compact_logits = run_compact(net, *inputs)
+        valid = input_ids.ne(PAD_ID)
+        max_diff = (dense_logits - compact_logits)[valid].abs().max().item()
+        print(
+            f"max |dense - compact| over non-pad logits: {max_diff:.2e} "
+            f"({single_modality.sum().item()}/{args.batch_size} samples "
+            f"with single_modality)"
+        )
+        del dense_logits, compact_logits
+
+        L = input_ids.shape[1]
+        bias_mb = args.batch_size * args.num_heads * L * L * 4 / 2**20
+        print(f"dense bias alone: {bias_mb:.1f} MB per forward (fp32)")
+        for name, fn in [("dense", run_dense), ("compact", run_compact)]:
+            elapsed, peak = measure(
+                fn, inputs, args.repeats, args.backward, device
+            )
+            print(
+                f"{name:>8}: {num_tokens / elapsed:,.0f} tokens/s, "
+                f"peak memory {peak:.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Equivalence check and benchmark of the DPLM attention backends
+(`eager`, `sdpa`, `chunked`) on a randomly initialized `EsmForDPLM`.
+
+The outputs of every backend are compared against the eager reference, then
+tokens/sec and peak memory (CUDA) of forward (+ backward) passes are
+reported:
+
+    python benchmarks/bench_dplm_attention.py --length 500 --batch_size 16
+"""
+
+import argparse
+import time
+
+import torch
+from transformers import AutoConfig
+
+from byprot.models.dplm import EsmForDPLM
+from byprot.models.dplm.modules.dplm_modeling_esm import (
+    ATTN_IMPLS,
+    ModifiedEsmSelfAttention,
+)
+
+
+def set_attn_impl(net, attn_impl, attn_chunk_size):
+    for module in net.modules():
+        if isinstance(module, ModifiedEsmSelfAttention):
+            module.set_attn_impl(attn_impl, attn_chunk_size)
+
+
+def sample_inputs(net, batch_size, length, device):
+    """Amino acid tokens of random lengths, wrapped with <cls>/<eos> and
+    right-padded, with about half of the residues masked."""
+    lengths = torch.randint(length // 2, length + 1, (batch_size,))
+    input_ids = torch.full((batch_size, length + 2), net.pad_id)
+    for i, n in enumerate(lengths.tolist()):
+        input_ids[i, 0] = net.bos_id
+        input_ids[i, 1 : n + 1] = torch.randint(4, 24, (n,))
+        input_ids[i, n + 1] = net.eos_id
+    masked = (torch.rand(input_ids.shape) < 0.5) & (input_ids >= 4)
+    input_ids = input_ids.masked_fill(masked, net.mask_id)
+    return input_ids.to(device)
+
+
+def measure(net, input_ids, repeats, backward, device):
+    def _step():
+        logits = net(input_ids)["logits"]
+        if backward:
+            logits.float().mean().backward()
+        return logits
+
+    _step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        _step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeats
+    peak = (
+        torch.cuda.max_memory_allocated() / 2**20
+        if device.type == "cuda"
+        else float("nan")
+    )
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config_name", type=str, default="facebook/esm2_t12_35M_UR50D"
+    )
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--length", type=int, default=500)
+    parser.add_argument("--attn_chunk_size", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--backward", action="store_true")
+    parser.add_argument("--device", type=str, default=None)
+    args = parser.parse_args()
+
+    device = torch.device(
+        args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    )
+    config = AutoConfig.from_pretrained(args.config_name)
+    net = EsmForDPLM(config, dropout=0.0).to(device)
+    net.train(args.backward)
+
+    input_ids = sample_inputs(net, args.batch_size, args.length, device)
+    valid = input_ids.ne(net.pad_id)
+    num_tokens = valid.sum().item()
+
+    with torch.set_grad_enabled(args.backward):
+        set_attn_impl(net, "eager", args.attn_chunk_size)
+        reference = net(input_ids)["logits"]
+        for attn_impl in ATTN_IMPLS:
+            set_attn_impl(net, attn_impl, args.attn_chunk_size)
+            logits = net(input_ids)["logits"]
+            max_diff = (logits - reference)[valid].abs().max().item()
+            assert (
+                max_diff < args.atol
+            ), f"{attn_impl} differs from eager by {max_diff:.2e}"
+            print(
+                f"max |{attn_impl} - eager| over non-pad logits: "
+                f"{max_diff:.2e}"
+            )
+        del reference, logits
+
+        for attn_impl in ATTN_IMPLS:
+            set_attn_impl(net, attn_impl, args.attn_chunk_size)
+            elapsed, peak = measure(
+                net, input_ids, args.repeats, args.backward, device
+            )
+            print(
+                f"{attn_impl:>8}: {num_tokens / elapsed:,.0f} tokens/s, "
+                f"peak memory {peak:.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Epoch-boundary stall of `LengthBatcher`, on a synthetic metadata CSV.
+
+Compares the former pandas implementation (groupby / sample / iloc per
+length, at every augmentation) with the vectorized one, with and without
+building the next epoch in a background thread while the current one is
+iterated (with `--step_ms` of simulated training per batch). The batches
+are checked to hold proteins of a single length within the budgets, and
+to have the same count on every replica:
+
+    python benchmarks/bench_length_batcher.py --num_rows 200000
+"""
+
+import argparse
+import math
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import torch
+
+from byprot.datamodules.pdb_dataset.pdb_datamodule import LengthBatcher
+
+
+class LegacyLengthBatcher:
+    # the pandas implementation previously used in LengthBatcher
+    def __init__(self, *, sampler_cfg, metadata_csv, num_replicas, rank):
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self._sampler_cfg = sampler_cfg
+        self._data_csv = metadata_csv.copy()
+        self._num_batches = math.ceil(len(self._data_csv) / num_replicas)
+        self._data_csv["index"] = list(range(len(self._data_csv)))
+        self.seed = 123
+        self.epoch = 0
+        self.max_batch_size = sampler_cfg.max_batch_size
+        self._create_batches()
+
+    def _replica_epoch_batches(self):
+        rng = torch.Generator()
+        rng.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self._data_csv), generator=rng).tolist()
+        replica_csv = self._data_csv.iloc[
+            indices[self.rank :: self.num_replicas]
+        ]
+        sample_order = []
+        for seq_len, len_df in replica_csv.groupby("modeled_seq_len"):
+            max_batch_size = min(
+                self.max_batch_size,
+                self._sampler_cfg.max_num_res_squared // seq_len**2 + 1,
+            )
+            num_batches = math.ceil(len(len_df) / max_batch_size)
+            shuffled_len_df = len_df.sample(frac=1).reset_index(drop=True)
+            for i in range(num_batches):
+                batch_df = shuffled_len_df.iloc[
+                    i * max_batch_size : (i + 1) * max_batch_size
+                ]
+                sample_order.append(batch_df["index"].tolist())
+        new_order = (
+            torch.randperm(len(sample_order), generator=rng).numpy().tolist()
+        )
+        return [sample_order[i] for i in new_order]
+
+    def _create_batches(self):
+        all_batches = []
+        while len(all_batches) < self._num_batches:
+            all_batches.extend(self._replica_epoch_batches())
+        self.sample_order = all_batches[: self._num_batches]
+
+    def __iter__(self):
+        yield from iter(self.sample_order)
+        self.epoch += 1
+        self._create_batches()
+
+    def __len__(self):
+        return len(self.sample_order)
+
+
+def epoch_stalls(batcher, num_epochs, step_ms):
+    """Time spent at the end of each epoch, where the batches of the next
+    one are built (or waited for)."""
+    stalls = []
+    for _ in range(num_epochs):
+        iterator = iter(batcher)
+        while True:
+            start = time.perf_counter()
+            try:
+                next(iterator)
+            except StopIteration:
+                stalls.append(time.perf_counter() - start)
+                break
+            time.sleep(step_ms / 1e3)
+    return stalls
+
+
+def check_batches(batchers, lengths, sampler_cfg):
+    counts = {len(b) for b in batchers}
+    assert len(counts) == 1, f"replicas have {counts} batches"
+    for batcher in batchers:
+        for batch in batcher:
+            batch_lengths = lengths[batch]
+            length = batch_lengths[0]
+            assert (batch_lengths == length).all(), "mixed lengths"
+            assert len(batch) <= min(
+                sampler_cfg.max_batch_size,
+                sampler_cfg.max_num_res_squared // length**2 + 1,
+            ), "batch exceeds the budgets"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_rows", type=int, default=200_000)
+    parser.add_argument("--min_len", type=int, default=40)
+    parser.add_argument("--max_len", type=int, default=512)
+    parser.add_argument("--max_batch_size", type=int, default=100)
+    parser.add_argument("--max_num_res_squared", type=int, default=500_000)
+    parser.add_argument("--num_replicas", type=int, default=8)
+    parser.add_argument("--num_epochs", type=int, default=2)
+    parser.add_argument("--step_ms", type=float, default=0.2)
+    parser.add_argument("--skip_legacy", action="store_true")
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    csv = pd.DataFrame(
+        {
+            "modeled_seq_len": rng.randint(
+                args.min_len, args.max_len + 1, size=args.num_rows
+            )
+        }
+    )
+    sampler_cfg = SimpleNamespace(
+        max_batch_size=args.max_batch_size,
+        max_num_res_squared=args.max_num_res_squared,
+    )
+    replicas = dict(num_replicas=args.num_replicas, rank=0)
+
+    batchers = [
+        LengthBatcher(
+            sampler_cfg=sampler_cfg,
+            metadata_csv=csv,
+            num_replicas=args.num_replicas,
+            rank=rank,
+            prefetch=False,
+        )
+        for rank in range(args.num_replicas)
+    ]
+    check_batches(batchers, csv["modeled_seq_len"].to_numpy(), sampler_cfg)
+    print(f"{len(batchers[0])} batches per replica, checks passed")
+
+    variants = {
+        "vectorized": LengthBatcher(
+            sampler_cfg=sampler_cfg,
+            metadata_csv=csv,
+            prefetch=False,
+            **replicas,
+        ),
+        "vectorized+prefetch": LengthBatcher(
+            sampler_cfg=sampler_cfg,
+            metadata_csv=csv,
+            prefetch=True,
+            **replicas,
+        ),
+    }
+    if not args.skip_legacy:
+        start = time.perf_counter()
+        variants["legacy"] = LegacyLengthBatcher(
+            sampler_cfg=sampler_cfg, metadata_csv=csv, **replicas
+        )
+        print(f"legacy construction: {time.perf_counter() - start:.2f} s")
+
+    for name, batcher in variants.items():
+        stalls = epoch_stalls(batcher, args.num_epochs, args.step_ms)
+        print(
+            f"{name:>20}: epoch-boundary stall "
+            f"{np.mean(stalls) * 1e3:.1f} ms (mean of {len(stalls)})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Benchmark of the in-process, batched ProteinMPNN (`ProteinMPNNRunner`)
+against the ProteinMPNN subprocesses per structure of
+`FoldingModel.run_pmpnn`, on the chains of the PDB files of a directory.
+
+Both design `--seq_per_sample` sequences per chain from the same
+coordinates. As sampling differs in its random draws, the sequences are
+compared by their length and their native sequence recovery (which should
+agree closely on average), then structures/sec of both are reported:
+
+    python benchmarks/bench_pmpnn_runner.py --pdb_dir data/pdbs \
+        --pmpnn_path vendor/ProteinMPNN --seq_per_sample 8
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+from biotite.sequence.io import fasta
+from omegaconf import OmegaConf
+
+from byprot.datamodules.pdb_dataset import utils as du
+from byprot.utils.protein import utils as eu
+from byprot.utils.protein.folding_model import FoldingModel
+from byprot.utils.protein.residue_constants import restypes_with_x
+
+
+def load_chains(pdb_dir, num_structures, max_len):
+    """atom37 coordinates and aatypes of the first chain of each PDB."""
+    backbones, aatypes = [], []
+    for path in sorted(glob.glob(os.path.join(pdb_dir, "*.pdb"))):
+        try:
+            feats, _ = du.process_pdb_file(path)
+        except du.DataError:
+            continue
+        chain = feats["chain_index"] == feats["chain_index"][0]
+        if chain.sum() > max_len:
+            continue
+        backbones.append(feats["atom_positions"][chain])
+        aatypes.append(feats["aatype"][chain])
+        if len(backbones) == num_structures:
+            break
+    return backbones, aatypes
+
+
+def design_by_subprocesses(folding_model, pdb_paths, work_dir):
+    # as `EvalRunner.run_pmpnn`
+    designed = []
+    for i, pdb_path in enumerate(pdb_paths):
+        sc_dir = os.path.join(work_dir, str(i))
+        os.makedirs(sc_dir)
+        pmpnn_pdb_path = os.path.join(sc_dir, "sample.pdb")
+        shutil.copy(pdb_path, pmpnn_pdb_path)
+        folding_model.run_pmpnn(sc_dir, pmpnn_pdb_path)
+        fasta_seqs = fasta.FastaFile.read(
+            os.path.join(sc_dir, "seqs", "sample.fa")
+        )
+        designed.append(list(fasta_seqs.values())[1:])
+    return designed
+
+
+def recovery(designed, aatypes):
+    return np.mean(
+        [
+            np.mean([restypes_with_x[a] == s for a, s in zip(aatype, seq)])
+            for seqs, aatype in zip(designed, aatypes)
+            for seq in seqs
+        ]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdb_dir", type=str, required=True)
+    parser.add_argument("--pmpnn_path", type=str, required=True)
+    parser.add_argument("--num_structures", type=int, default=64)
+    parser.add_argument("--max_len", type=int, default=512)
+    parser.add_argument("--seq_per_sample", type=int, default=8)
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument("--max_tokens", type=int, default=65536)
+    parser.add_argument("--recovery_atol", type=float, default=0.05)
+    parser.add_argument("--device_id", type=int, default=0)
+    args = parser.parse_args()
+
+    backbones, aatypes = load_chains(
+        args.pdb_dir, args.num_structures, args.max_len
+    )
+    cfg = OmegaConf.create(
+        {
+            "folding_model": "esmf",
+            "pmpnn_path": args.pmpnn_path,
+            "seq_per_sample": args.seq_per_sample,
+            "pmpnn_max_batch_size": args.max_batch_size,
+            "pmpnn_max_tokens": args.max_tokens,
+        }
+    )
+    folding_model = FoldingModel(cfg, device_id=args.device_id)
+    work_dir = tempfile.mkdtemp()
+    try:
+        pdb_paths = [
+            eu.write_prot_to_pdb(
+                backbone,
+                os.path.join(work_dir, f"input_{i}.pdb"),
+                aatype=aatype,
+                no_indexing=True,
+            )
+            for i, (backbone, aatype) in enumerate(zip(backbones, aatypes))
+        ]
+
+        start = time.perf_counter()
+        reference = design_by_subprocesses(
+            folding_model, pdb_paths, os.path.join(work_dir, "subprocess")
+        )
+        subprocess_time = time.perf_counter() - start
+
+        # warmup, including loading the weights
+        folding_model.design_sequences(backbones[:1], aatypes=aatypes[:1])
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        designed = folding_model.design_sequences(backbones, aatypes=aatypes)
+        torch.cuda.synchronize()
+        in_process_time = time.perf_counter() - start
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for ref_seqs, seqs, backbone in zip(reference, designed, backbones):
+        assert len(seqs) == len(ref_seqs) == args.seq_per_sample
+        # both design every residue of the chain
+        assert {len(seq) for seq in seqs + ref_seqs} == {len(backbone)}
+    ref_recovery = recovery(reference, aatypes)
+    in_process_recovery = recovery(designed, aatypes)
+    assert (
+        abs(ref_recovery - in_process_recovery) < args.recovery_atol
+    ), f"recovery {in_process_recovery:.3f} != {ref_recovery:.3f}"
+    print(
+        f"native sequence recovery over {len(backbones)} chains: "
+        f"subprocesses {ref_recovery:.3f}, in process "
+        f"{in_process_recovery:.3f}"
+    )
+    print(
+        f"subprocesses: {len(backbones) / subprocess_time:.2f} structures/s\n"
+        f"  in process: {len(backbones) / in_process_time:.2f} structures/s, "
+        f"speedup {subprocess_time / in_process_time:.2f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""Equivalence check and benchmark of sequence packing for DPLM training, on
+a randomly initialized `EsmForDPLM` and synthetic sequences of long-tailed
+(log-normal, UniRef50-like) lengths.
+
+First, the logits of sequences packed into rows (`DPLMPackingCollater`)
+are compared with those of the same sequences padded (`DPLMCollater`), and
+so is the `RDMCrossEntropyLoss` over the same masked tokens. Then the
+training steps (`DPLM.compute_loss`, loss and backward) over all sequences
+are timed with padded batches of similar lengths (`TokenBudgetBatchSampler`)
+and with packed batches, and the effective throughput (non-pad tokens/sec)
+and padding of both are reported:
+
+    python benchmarks/bench_sequence_packing.py --num_seqs 2000
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from transformers import AutoConfig
+
+from byprot.datamodules.dataset.batch_sampler import (
+    TokenBudgetBatchSampler,
+    first_fit_rows,
+)
+from byprot.datamodules.dataset.uniref_hf import (
+    DPLMCollater,
+    DPLMPackingCollater,
+)
+from byprot.models.dplm import EsmForDPLM
+from byprot.models.dplm.dplm import DiffusionProteinLanguageModel
+from byprot.modules.cross_entropy import RDMCrossEntropyLoss
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def sample_sequences(num_seqs, max_len, rng):
+    lengths = np.clip(
+        rng.lognormal(mean=5.5, sigma=0.7, size=num_seqs).astype(int),
+        20,
+        max_len,
+    )
+    return [
+        "".join(rng.choice(list(AMINO_ACIDS), size=n)) for n in lengths
+    ], lengths
+
+
+def check_equivalence(net, sequences, pack_len, atol, rng):
+    """Logits and loss of packed rows vs. padded sequences, with the same
+    residues masked."""
+    masked = []
+    for seq in sequences:
+        tokens = list(seq)
+        for i in np.flatnonzero(rng.random(len(tokens)) < 0.3):
+            tokens[i] = "<mask>"
+        masked.append("".join(tokens))
+    padded = DPLMCollater()(masked)
+    packed = DPLMPackingCollater(pack_len=pack_len)(masked)
+
+    criterion = RDMCrossEntropyLoss(ignore_index=net.pad_id)
+    with torch.no_grad():
+        padded_logits = net(padded["input_ids"])["logits"]
+        packed_logits = net(
+            packed["input_ids"], segment_ids=packed["segment_ids"]
+        )["logits"]
+
+    lengths = padded["input_mask"].sum(-1).tolist()
+    max_diff = 0.0
+    for r, row in enumerate(first_fit_rows(lengths, pack_len)):
+        offset = 0
+        for i in row:
+            n = lengths[i]
+            diff = packed_logits[r, offset : offset + n] - padded_logits[i, :n]
+            max_diff = max(max_diff, diff.abs().max().item())
+            offset += n
+    assert max_diff < atol, f"packed logits differ by {max_diff:.2e}"
+
+    def loss(logits, input_ids):
+        label_mask = input_ids.eq(net.mask_id)
+        weights = torch.ones_like(input_ids, dtype=torch.float)
+        return criterion(logits, input_ids, label_mask, weights)[0].item()
+
+    # the targets do not matter here, only which tokens are in the loss
+    padded_loss = loss(padded_logits, padded["input_ids"])
+    packed_loss = loss(packed_logits, packed["input_ids"])
+    assert (
+        abs(padded_loss - packed_loss) < atol
+    ), f"packed loss {packed_loss:.6f} != padded loss {padded_loss:.6f}"
+    print(
+        f"max |packed - padded| over {len(sequences)} sequences: "
+        f"logits {max_diff:.2e}, loss {abs(packed_loss - padded_loss):.2e}"
+    )
+
+
+def measure(model, criterion, batches, device):
+    """Seconds of training steps (without optimizer) over `batches`, and
+    the non-pad / total tokens of the batches."""
+    real = total = 0
+    elapsed = 0.0
+    for batch in batches:
+        batch = {k: v.to(device) for k, v in batch.items()}
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        logits, target, loss_mask, weights = model.compute_loss(batch)
+        loss = criterion(logits, target, loss_mask, weights)[0]
+        loss.backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed += time.perf_counter() - start
+        real += batch["targets"].ne(model.pad_id).sum().item()
+        total += batch["targets"].numel()
+    return elapsed, real, total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config_name", type=str, default="facebook/esm2_t12_35M_UR50D"
+    )
+    parser.add_argument("--num_seqs", type=int, default=2000)
+    parser.add_argument("--max_len", type=int, default=1022)
+    parser.add_argument("--max_tokens", type=int, default=6000)
+    parser.add_argument("--max_batch_size", type=int, default=800)
+    parser.add_argument("--num_check_seqs", type=int, default=32)
+    parser.add_argument("--rdm_couple", action="store_true")
+    parser.add_argument("--attn_impl", type=str, default="sdpa")
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--device", type=str, default=None)
+    args = parser.parse_args()
+
+    device = torch.device(
+        args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    )
+    rng = np.random.default_rng(0)
+    torch.manual_seed(0)
+    config = AutoConfig.from_pretrained(args.config_name)
+    net = EsmForDPLM(config, dropout=0.0).to(device)
+    model = DiffusionProteinLanguageModel(
+        cfg={"rdm_couple": args.rdm_couple, "attn_impl": args.attn_impl},
+        net=net,
+    )
+    pack_len = args.max_len + 2
+
+    net.eval()
+    check_sequences, _ = sample_sequences(
+        args.num_check_seqs, args.max_len, rng
+    )
+    check_equivalence(net.cpu(), check_sequences, pack_len, args.atol, rng)
+    net.to(device).train()
+
+    sequences, lengths = sample_sequences(args.num_seqs, args.max_len, rng)
+    criterion = RDMCrossEntropyLoss(ignore_index=net.pad_id)
+    results = {}
+    for name, packed, collater in [
+        ("padded", False, DPLMCollater()),
+        ("packed", True, DPLMPackingCollater(pack_len=pack_len)),
+    ]:
+        sampler = TokenBudgetBatchSampler(
+            lengths,
+            args.max_tokens,
+            args.max_batch_size,
+            max_len=args.max_len,
+            num_replicas=1,
+            rank=0,
+            packed=packed,
+        )
+        batches = [
+            collater([sequences[i] for i in batch]) for batch in sampler
+        ]
+        # warmup
+        measure(model, criterion, batches[:2], device)
+        net.zero_grad(set_to_none=True)
+        elapsed, real, total = measure(model, criterion, batches, device)
+        results[name] = real / elapsed
+        print(
+            f"{name:>7}: {len(batches)} batches, padding "
+            f"{1 - real / total:.1%}, {real / elapsed:,.0f} effective "
+            f"tokens/s ({total / elapsed:,.0f} tokens/s incl. padding)"
+        )
+    print(f"speedup: {results['packed'] / results['padded']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
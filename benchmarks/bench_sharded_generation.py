@@ -0,0 +1,137 @@
+"""Check and benchmark of the sharded generation launcher on CPU, with a
+randomly initialized tiny DPLM (ESM-2 8M architecture by default).
+
+The same sweep is generated with one worker and with `--num_workers`
+worker processes, the output fasta files are checked to be identical, and
+the throughput of both runs is reported:
+
+    python benchmarks/bench_sharded_generation.py --num_workers 4
+"""
+
+import argparse
+import filecmp
+import os
+import tempfile
+import time
+
+import torch
+
+from byprot import utils
+from byprot.models.dplm import DiffusionProteinLanguageModel
+from byprot.utils.generation import (
+    GenerationManifest,
+    GenerationWorker,
+    ShardOutputs,
+    build_sweep_shards,
+    run_sharded,
+)
+
+
+class TinyDPLMWorker(GenerationWorker):
+    def __init__(self, net_name, max_iter, saveto):
+        self.net_name = net_name
+        self.max_iter = max_iter
+        self.saveto = saveto
+
+    def setup(self, device):
+        # the same random weights in every worker
+        utils.seed_everything(0)
+        model = DiffusionProteinLanguageModel(
+            cfg={"net": {"name": self.net_name, "dropout": 0.0}}
+        )
+        self.model = model.eval().to(device)
+        self.device = torch.device(device)
+
+    @torch.no_grad()
+    def __call__(self, shard):
+        model, tokenizer = self.model, self.model.tokenizer
+        utils.seed_everything(shard.rng_seed)
+        input_tokens = tokenizer(
+            ["<mask>" * shard.length] * shard.num_seqs, return_tensors="pt"
+        )["input_ids"].to(self.device)
+        output_tokens = model.generate(
+            batch={"input_ids": input_tokens},
+            tokenizer=tokenizer,
+            max_iter=self.max_iter,
+        )[0]
+        seqs = [
+            "".join(seq.split(" "))
+            for seq in tokenizer.batch_decode(
+                output_tokens, skip_special_tokens=True
+            )
+        ]
+        outputs = ShardOutputs()
+        outputs.write_fasta(
+            os.path.join(self.saveto, f"L_{shard.length}.fasta"),
+            headers=[
+                f"SEQUENCE_{shard.seed}_{shard.start + i}"
+                for i in range(len(seqs))
+            ],
+            seqs=seqs,
+        )
+        return outputs
+
+
+def run(args, saveto, num_workers):
+    shards = build_sweep_shards(
+        args.seq_lens,
+        args.num_seqs,
+        seeds=args.seeds,
+        batch_size=args.batch_size,
+    )
+    manifest = GenerationManifest(saveto, shards)
+    start = time.perf_counter()
+    run_sharded(
+        manifest,
+        TinyDPLMWorker(args.net_name, args.max_iter, saveto),
+        num_workers=num_workers,
+        device="cpu",
+        num_threads=args.num_threads,
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--net_name", type=str, default="facebook/esm2_t6_8M_UR50D"
+    )
+    parser.add_argument(
+        "--seq_lens", nargs="*", type=int, default=[50, 100, 200]
+    )
+    parser.add_argument("--num_seqs", type=int, default=8)
+    parser.add_argument("--seeds", nargs="*", type=int, default=[0, 1])
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--max_iter", type=int, default=20)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--num_threads", type=int, default=None)
+    args = parser.parse_args()
+    # the same intra-op threads in both runs, as CPU kernels may not give
+    # bitwise identical results with different numbers of threads
+    if args.num_threads is None:
+        args.num_threads = max(1, (os.cpu_count() or 1) // args.num_workers)
+
+    num_samples = len(args.seq_lens) * len(args.seeds) * args.num_seqs
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dirs = {}
+        for num_workers in [1, args.num_workers]:
+            saveto = os.path.join(tmpdir, f"workers_{num_workers}")
+            elapsed = run(args, saveto, num_workers)
+            dirs[num_workers] = saveto
+            print(
+                f"{num_workers} worker(s): {elapsed:.1f} s, "
+                f"{num_samples / elapsed:.2f} samples/s"
+            )
+
+        for length in args.seq_lens:
+            name = f"L_{length}.fasta"
+            assert filecmp.cmp(
+                os.path.join(dirs[1], name),
+                os.path.join(dirs[args.num_workers], name),
+                shallow=False,
+            ), f"{name} differs between 1 and {args.num_workers} workers"
+        print("outputs are identical")
+
+
+if __name__ == "__main__":
+    main()
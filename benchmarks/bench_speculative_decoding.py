@@ -0,0 +1,123 @@
+"""Quality vs. throughput of the speculative decoding of DPLM, with
+randomly initialized tiny models on CPU by default.
+
+The target model (ESM-2 35M architecture by default) decodes alone, and
+with a draft model proposing `--draft_steps` steps per forward pass of the
+target. The draft is either another architecture (ESM-2 8M by default), or
+with `--draft_layers`, the first layers of the target itself. For each
+run, the forward passes of the target, the latency, the mean
+log-likelihood of the samples under the target, and the tokens identical
+to the target-only samples are reported:
+
+    python benchmarks/bench_speculative_decoding.py --draft_steps 2 4 8
+
+With random weights, the acceptance rate of the draft steps is not
+representative of pretrained checkpoints, e.g., DPLM-150M for DPLM-3B.
+"""
+
+import argparse
+import copy
+import time
+
+import torch
+
+from byprot import utils
+from byprot.models.dplm import DiffusionProteinLanguageModel
+
+
+def build_model(net_name):
+    model = DiffusionProteinLanguageModel(
+        cfg={"net": {"name": net_name, "dropout": 0.0}}
+    )
+    return model.eval()
+
+
+@torch.no_grad()
+def log_likelihood(model, tokens):
+    """Mean log-probability of the non-special tokens under `model`."""
+    logits = model.net(input_ids=tokens)["logits"].float()
+    log_probs = logits.log_softmax(-1).gather(-1, tokens[..., None])[..., 0]
+    mask = model.get_non_special_sym_mask(tokens)
+    return (log_probs * mask).sum().item() / mask.sum().item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--net_name", type=str, default="facebook/esm2_t12_35M_UR50D"
+    )
+    parser.add_argument(
+        "--draft_net_name", type=str, default="facebook/esm2_t6_8M_UR50D"
+    )
+    parser.add_argument(
+        "--draft_layers",
+        type=int,
+        default=None,
+        help="use the first layers of the target as the draft model",
+    )
+    parser.add_argument("--draft_steps", nargs="*", type=int, default=[2, 4])
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--length", type=int, default=100)
+    parser.add_argument("--max_iter", type=int, default=100)
+    parser.add_argument("--sampling_strategy", type=str, default="argmax")
+    parser.add_argument("--num_threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    utils.seed_everything(0)
+    model = build_model(args.net_name)
+    if args.draft_layers is not None:
+        draft_model = copy.deepcopy(model)
+        encoder = draft_model.net.esm.encoder
+        encoder.layer = encoder.layer[: args.draft_layers]
+    else:
+        draft_model = build_model(args.draft_net_name)
+
+    num_target_calls = [0]
+
+    def count_calls(module, inputs, outputs):
+        num_target_calls[0] += 1
+
+    model.net.register_forward_hook(count_calls)
+
+    input_tokens = model.tokenizer(
+        ["<mask>" * args.length] * args.batch_size, return_tensors="pt"
+    )["input_ids"]
+    batch = {"input_ids": input_tokens}
+
+    def run(**kwargs):
+        utils.seed_everything(0)
+        num_target_calls[0] = 0
+        start = time.perf_counter()
+        tokens = model.generate(
+            batch=batch,
+            max_iter=args.max_iter,
+            sampling_strategy=args.sampling_strategy,
+            **kwargs,
+        )[0]
+        elapsed = time.perf_counter() - start
+        return tokens, elapsed, num_target_calls[0]
+
+    reference, ref_elapsed, ref_calls = run()
+    results = [("target", reference, ref_elapsed, ref_calls)]
+    for draft_steps in args.draft_steps:
+        tokens, elapsed, calls = run(
+            decoding_strategy="speculative",
+            draft_model=draft_model,
+            draft_steps=draft_steps,
+        )
+        results.append((f"draft_steps={draft_steps}", tokens, elapsed, calls))
+
+    for name, tokens, elapsed, calls in results:
+        agreement = tokens.eq(reference).float().mean().item()
+        print(
+            f"{name:>14}: {calls:4d} target passes, {elapsed:.2f} s "
+            f"({ref_elapsed / elapsed:.2f}x), "
+            f"log-likelihood {log_likelihood(model, tokens):.3f}, "
+            f"{agreement:.2%} tokens identical to target"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Benchmark of incremental diversity / novelty with `TMScoreStore`.
+
+The PDB files of `--sample_dir` are split into a first batch of samples
+and `--num_new` new ones, and scored against the references of
+`--ref_dir` as an evaluation would: first the first batch alone (all pairs
+aligned), then with the new samples (only their pairs aligned), then the
+same again (nothing aligned). The clusters and novelty of each step are
+checked against a store built from scratch:
+
+    python benchmarks/bench_tm_score_store.py --sample_dir samples \
+        --ref_dir data/pdbs --num_new 16
+"""
+
+import argparse
+import glob
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from byprot.utils.protein.tm_store import TMScoreStore
+
+
+def evaluate(store, samples, references, threshold):
+    start = time.perf_counter()
+    num_pairs = len(store)
+    clusters = store.clusters(samples, threshold=threshold)
+    max_tm = store.max_tm_to_references(samples, references)
+    return {
+        "seconds": time.perf_counter() - start,
+        "aligned": len(store) - num_pairs,
+        "clusters": sorted(sorted(cluster) for cluster in clusters),
+        "max_tm": max_tm,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sample_dir", type=str, required=True)
+    parser.add_argument("--ref_dir", type=str, required=True)
+    parser.add_argument("--num_samples", type=int, default=64)
+    parser.add_argument("--num_new", type=int, default=16)
+    parser.add_argument("--num_refs", type=int, default=256)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    samples = sorted(glob.glob(os.path.join(args.sample_dir, "*.pdb")))
+    samples = samples[: args.num_samples]
+    references = sorted(glob.glob(os.path.join(args.ref_dir, "*.pdb")))
+    references = references[: args.num_refs]
+    first = samples[: len(samples) - args.num_new]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = TMScoreStore(
+            os.path.join(tmp_dir, "tm_scores.sqlite"),
+            num_workers=args.num_workers,
+        )
+        steps = {
+            "first samples": evaluate(
+                store, first, references, args.threshold
+            ),
+            "+ new samples": evaluate(
+                store, samples, references, args.threshold
+            ),
+            "again": evaluate(store, samples, references, args.threshold),
+        }
+        store.close()
+
+        scratch = TMScoreStore(
+            os.path.join(tmp_dir, "scratch.sqlite"),
+            num_workers=args.num_workers,
+        )
+        expected = evaluate(scratch, samples, references, args.threshold)
+        scratch.close()
+
+    for name in ["+ new samples", "again"]:
+        assert steps[name]["clusters"] == expected["clusters"], name
+        assert np.allclose(steps[name]["max_tm"], expected["max_tm"]), name
+    print(
+        f"{len(samples)} samples ({args.num_new} new) vs "
+        f"{len(references)} references, checks passed"
+    )
+    print(f"{'from scratch':>14}: {expected['seconds']:.2f} s")
+    for name, step in steps.items():
+        print(
+            f"{name:>14}: {step['seconds']:.2f} s, {step['aligned']} pairs "
+            f"aligned, {len(step['clusters'])} clusters, mean max TM "
+            f"{step['max_tm'].mean():.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
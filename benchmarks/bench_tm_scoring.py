@@ -0,0 +1,174 @@
+"""Equivalence check and benchmark of the batched RMSD / TM-score of
+`tm_scoring` against the per-pair path `process_folded_outputs` used before
+(openfold `superimpose` and tmtools `tm_align` per folded structure), and
+of the all-vs-all TM-align matrix of `TMAlignScorer` against aligning the
+pairs one by one.
+
+Self-consistency pairs are made from the first chain of the PDB files of
+`--pdb_dir`, each against `--num_folded` noisy, randomly moved copies of
+itself (standing in for folded structures). The RMSDs of both paths must
+agree, and the TM-scores of the fixed correspondence are compared with
+those of TM-align (which may only be higher, by aligning differently):
+
+    python benchmarks/bench_tm_scoring.py --pdb_dir data/pdbs \
+        --num_structures 64 --num_folded 8
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import torch
+from openfold.utils.superimposition import superimpose
+from scipy.spatial.transform import Rotation
+from tmtools import tm_align
+
+from byprot.datamodules.pdb_dataset import utils as du
+from byprot.utils.protein import tm_scoring
+from byprot.utils.protein.residue_constants import atom_order
+from byprot.utils.protein.tm_scoring import TMAlignScorer, _read_ca
+
+CA_IDX = atom_order["CA"]
+
+
+def load_backbones(pdb_paths, max_len):
+    backbones, paths = [], []
+    for path in pdb_paths:
+        feats = du.parse_pdb_feats("pdb", path, chain_id=None)
+        feats = next(iter(feats.values()))
+        bb_pos = feats["atom_positions"][:, :3]
+        if len(bb_pos) <= max_len and np.abs(bb_pos).sum(-1).all():
+            backbones.append(bb_pos)
+            paths.append(path)
+    return backbones, paths
+
+
+def make_folded(backbone, num_folded, noise, rng):
+    folded = []
+    for _ in range(num_folded):
+        rotation = Rotation.random(random_state=rng).as_matrix()
+        moved = backbone @ rotation.T + rng.normal(scale=10.0, size=3)
+        folded.append(moved + rng.normal(scale=noise, size=backbone.shape))
+    return folded
+
+
+def score_per_pair(sample, folded):
+    # as `process_folded_outputs` did
+    num_res = len(sample)
+    mask = torch.ones(num_res)
+    results = []
+    for bb_pos in folded:
+        bb_rmsd = superimpose(
+            torch.tensor(sample.reshape(-1, 3))[None],
+            torch.tensor(bb_pos.reshape(-1, 3))[None],
+            mask[:, None].repeat(1, 3).reshape(-1),
+        )[1].item()
+        ca_rmsd = superimpose(
+            torch.tensor(sample[:, CA_IDX])[None],
+            torch.tensor(bb_pos[:, CA_IDX])[None],
+            mask,
+        )[1].item()
+        seq = "A" * num_res
+        tmscore = tm_align(
+            np.float64(sample[:, CA_IDX]),
+            np.float64(bb_pos[:, CA_IDX]),
+            seq,
+            seq,
+        ).tm_norm_chain2
+        results.append((bb_rmsd, ca_rmsd, tmscore))
+    return np.array(results)
+
+
+def score_batched(sample, folded):
+    pos_1 = np.stack([sample] * len(folded))
+    pos_2 = np.stack(folded)
+    num = len(folded)
+    bb_rmsd = tm_scoring.superimposed_rmsd(
+        pos_1.reshape(num, -1, 3), pos_2.reshape(num, -1, 3)
+    )
+    ca_rmsd = tm_scoring.superimposed_rmsd(
+        pos_1[:, :, CA_IDX], pos_2[:, :, CA_IDX]
+    )
+    tmscore = tm_scoring.tm_score(pos_1[:, :, CA_IDX], pos_2[:, :, CA_IDX])
+    return np.stack([bb_rmsd, ca_rmsd, tmscore], -1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdb_dir", type=str, required=True)
+    parser.add_argument("--num_structures", type=int, default=64)
+    parser.add_argument("--max_len", type=int, default=512)
+    parser.add_argument("--num_folded", type=int, default=8)
+    parser.add_argument("--noise", type=float, default=1.5)
+    parser.add_argument("--num_matrix", type=int, default=32)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--rmsd_atol", type=float, default=1e-3)
+    parser.add_argument("--tm_atol", type=float, default=0.05)
+    args = parser.parse_args()
+
+    pdb_paths = sorted(glob.glob(os.path.join(args.pdb_dir, "*.pdb")))
+    backbones, paths = load_backbones(
+        pdb_paths[: args.num_structures], args.max_len
+    )
+    rng = np.random.default_rng(0)
+    folded = [
+        make_folded(bb, args.num_folded, args.noise, rng) for bb in backbones
+    ]
+
+    start = time.perf_counter()
+    reference = [score_per_pair(bb, f) for bb, f in zip(backbones, folded)]
+    per_pair_time = time.perf_counter() - start
+    start = time.perf_counter()
+    batched = [score_batched(bb, f) for bb, f in zip(backbones, folded)]
+    batched_time = time.perf_counter() - start
+
+    reference, batched = np.concatenate(reference), np.concatenate(batched)
+    rmsd_diff = np.abs(reference[:, :2] - batched[:, :2]).max()
+    tm_diff = reference[:, 2] - batched[:, 2]
+    assert rmsd_diff < args.rmsd_atol, f"RMSDs differ by {rmsd_diff:.2e}"
+    assert (
+        np.abs(tm_diff).mean() < args.tm_atol
+    ), f"TM-scores differ by {np.abs(tm_diff).mean():.3f} on average"
+    num_pairs = len(reference)
+    print(
+        f"{num_pairs} self-consistency pairs: max |RMSD diff| "
+        f"{rmsd_diff:.2e} A, TM-align - TM-score mean {tm_diff.mean():.4f} "
+        f"(max |diff| {np.abs(tm_diff).max():.4f})"
+    )
+    print(
+        f"  per pair: {num_pairs / per_pair_time:.1f} pairs/s\n"
+        f"   batched: {num_pairs / batched_time:.1f} pairs/s, speedup "
+        f"{per_pair_time / batched_time:.2f}x"
+    )
+
+    matrix_paths = paths[: args.num_matrix]
+    structures = [_read_ca(path) for path in matrix_paths]
+    start = time.perf_counter()
+    one_by_one = np.eye(len(structures))
+    for i, j in zip(*np.triu_indices(len(structures), k=1)):
+        (pos_1, seq_1), (pos_2, seq_2) = structures[i], structures[j]
+        result = tm_align(np.float64(pos_1), np.float64(pos_2), seq_1, seq_2)
+        one_by_one[i, j] = result.tm_norm_chain1
+        one_by_one[j, i] = result.tm_norm_chain2
+    one_by_one_time = time.perf_counter() - start
+
+    scorer = TMAlignScorer(num_workers=args.num_workers)
+    start = time.perf_counter()
+    matrix = scorer.matrix(matrix_paths)
+    pooled_time = time.perf_counter() - start
+    start = time.perf_counter()
+    scorer.matrix(matrix_paths)
+    cached_time = time.perf_counter() - start
+    matrix_diff = np.abs(matrix - one_by_one).max()
+    assert matrix_diff < 1e-6, f"TM-align matrices differ by {matrix_diff}"
+    print(
+        f"all-vs-all TM-align of {len(structures)} structures: "
+        f"one by one {one_by_one_time:.2f} s, pooled {pooled_time:.2f} s "
+        f"({one_by_one_time / pooled_time:.2f}x), cached {cached_time:.3f} s"
+    )
+
+
+if __name__ == "__main__":
+    main()
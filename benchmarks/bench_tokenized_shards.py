@@ -0,0 +1,122 @@
+"""Equivalence and collation cost of the memory-mapped tokenized shards
+against tokenizing the DPLM-2 training strings on the fly, with random
+sequences and structure tokens.
+
+Batches of `TokenizedProteinDataset`-style samples collated by
+`DPLM2Collater` are checked to be identical to the same entries read by
+`TokenizedShardDataset` and collated by `DPLM2ShardCollater`, and the
+time of both is reported:
+
+    python benchmarks/bench_tokenized_shards.py --num_entries 2000
+"""
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import torch
+from datasets import Dataset
+
+from byprot.datamodules.dataset.tokenized_protein import (
+    DPLM2Collater,
+    DPLM2Tokenizer,
+)
+from byprot.datamodules.dataset.tokenized_shards import (
+    DPLM2ShardCollater,
+    TokenizedShardDataset,
+    write_tokenized_shards,
+)
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def random_data(num_entries, min_len, max_len, struct_vocab_size, seed=0):
+    rng = np.random.RandomState(seed)
+    lengths = rng.randint(min_len, max_len + 1, size=num_entries)
+    aa_seq = ["".join(rng.choice(list(AMINO_ACIDS), size=n)) for n in lengths]
+    struct_seq = [
+        ",".join(f"{c:04d}" for c in rng.randint(struct_vocab_size, size=n))
+        for n in lengths
+    ]
+    return Dataset.from_dict(
+        {
+            "aa_seq": aa_seq,
+            "struct_seq": struct_seq,
+            "pdb_name": [f"entry_{i}" for i in range(num_entries)],
+            "length": lengths.tolist(),
+        }
+    )
+
+
+def string_sample(tokenizer, row):
+    # TokenizedProteinDataset.__getitem__ without cropping
+    return {
+        "struct_tokens": tokenizer.struct_cls_token
+        + "".join(row["struct_seq"].split(","))
+        + tokenizer.struct_eos_token,
+        "aatype_tokens": tokenizer.aa_cls_token
+        + row["aa_seq"]
+        + tokenizer.aa_eos_token,
+        "pdb_name": row["pdb_name"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--vocab_file", type=str, default="airkingbd/dplm2_650m"
+    )
+    parser.add_argument("--num_entries", type=int, default=2000)
+    parser.add_argument("--min_len", type=int, default=50)
+    parser.add_argument("--max_len", type=int, default=500)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--struct_vocab_size", type=int, default=8192)
+    args = parser.parse_args()
+
+    tokenizer = DPLM2Tokenizer.from_pretrained(args.vocab_file)
+    data = random_data(
+        args.num_entries, args.min_len, args.max_len, args.struct_vocab_size
+    )
+    batches = [
+        list(range(i, min(i + args.batch_size, len(data))))
+        for i in range(0, len(data), args.batch_size)
+    ]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        write_tokenized_shards(data, tmpdir, tokenizer)
+        print(f"conversion: {time.perf_counter() - start:.2f} s")
+        dataset = TokenizedShardDataset(tmpdir, max_len=args.max_len)
+
+        string_collater = DPLM2Collater(tokenizer)
+        shard_collater = DPLM2ShardCollater(tokenizer)
+        elapsed = {"strings": 0.0, "shards": 0.0}
+        for indices in batches:
+            start = time.perf_counter()
+            expected = string_collater(
+                [string_sample(tokenizer, data[i]) for i in indices]
+            )
+            elapsed["strings"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            batch = shard_collater([dataset[i] for i in indices])
+            elapsed["shards"] += time.perf_counter() - start
+
+            assert batch["pdb_name"] == expected["pdb_name"]
+            for key in ["struct_tokens", "aatype_tokens"]:
+                for name in ["targets", "attention_mask"]:
+                    assert torch.equal(
+                        batch[key][name], expected[key][name]
+                    ), f"{key}.{name} differs"
+        print("collated batches are identical")
+
+    for name, seconds in elapsed.items():
+        print(
+            f"{name:>8}: {seconds / len(batches) * 1e3:.2f} ms/batch "
+            f"(batch size {args.batch_size})"
+        )
+
+
+if __name__ == "__main__":
+    main()
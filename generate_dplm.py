@@ -6,6 +6,15 @@ import torch
 
 from byprot import utils
 from byprot.models.dplm.dplm import DiffusionProteinLanguageModel
+from byprot.models.utils import DecodingHistory
+from byprot.utils.generation import (
+    GenerationManifest,
+    GenerationWorker,
+    ShardOutputs,
+    add_launcher_args,
+    build_sweep_shards,
+    run_sharded,
+)
 
 
 def format_check(args):
@@ -70,32 +79,78 @@ def initialize_generation(
     return batch["input_ids"]
 
 
-def generate(args):
-    model = DiffusionProteinLanguageModel.from_pretrained(
-        args.model_name, from_huggingface=False
-    )
-    tokenizer = model.tokenizer
-    model = model.eval()
-    model = model.cuda()
-    device = next(model.parameters()).device
+class DPLMGenerationWorker(GenerationWorker):
+    def __init__(self, args):
+        self.args = args
+
+    def setup(self, device):
+        args = self.args
+        # local checkpoints of this repo, or DPLM models on huggingface
+        model = DiffusionProteinLanguageModel.from_pretrained(
+            args.model_name,
+            from_huggingface=not os.path.exists(args.model_name),
+        )
+        self.model = model.eval().to(device)
+        self.tokenizer = model.tokenizer
+        self.draft_model = None
+        if args.draft_model_name is not None:
+            draft_model = DiffusionProteinLanguageModel.from_pretrained(
+                args.draft_model_name,
+                from_huggingface=not os.path.exists(args.draft_model_name),
+            )
+            self.draft_model = draft_model.eval().to(device)
+        self.device = torch.device(device)
 
-    for seq_len in args.seq_lens:
+    @torch.no_grad()
+    def __call__(self, shard):
+        args, model, tokenizer = self.args, self.model, self.tokenizer
+        utils.seed_everything(shard.rng_seed)
         max_iter = args.max_iter
+        seq_len = shard.length
         input_tokens = initialize_generation(
-            args.num_seqs, seq_len, tokenizer, device
+            shard.num_seqs, seq_len, tokenizer, self.device
         )
         partial_mask = input_tokens.ne(model.mask_id)
-        with torch.cuda.amp.autocast():
+        history = None
+        if args.history_every > 0:
+            # the decoding trajectory of the shard, see DecodingHistory.load
+            history_dir = os.path.join(args.saveto, "history")
+            os.makedirs(history_dir, exist_ok=True)
+            history = DecodingHistory(
+                every=args.history_every,
+                capacity=1,
+                save_path=os.path.join(history_dir, f"{shard.name}.npy"),
+                vocab_size=len(tokenizer),
+            )
+        with torch.autocast(
+            "cuda", dtype=torch.float16, enabled=self.device.type == "cuda"
+        ):
             outputs = model.generate(
-                input_tokens=input_tokens,
+                batch={"input_ids": input_tokens},
                 tokenizer=tokenizer,
                 max_iter=max_iter,
                 sampling_strategy=args.sampling_strategy,
                 partial_masks=partial_mask,
+                early_exit=args.early_exit,
+                early_exit_patience=args.early_exit_patience,
+                early_exit_tol=args.early_exit_tol,
+                history=history,
+                decoding_strategy=(
+                    "reparam" if self.draft_model is None else "speculative"
+                ),
+                draft_model=self.draft_model,
+                draft_steps=args.draft_steps,
+            )
+        if history is not None:
+            history.close()
+        output_tokens = outputs[0]
+        if args.early_exit:
+            print(
+                f"Average decoding steps: "
+                f"{outputs[2].float().mean():.1f}/{max_iter}"
             )
-        output_tokens = outputs
 
-        print("final:")
+        print(f"final ({shard.name}):")
         output_results = [
             "".join(seq.split(" "))
             for seq in tokenizer.batch_decode(
@@ -104,15 +159,63 @@ def generate(args):
         ]
         pprint(output_results)
 
-        os.makedirs(args.saveto, exist_ok=True)
-        saveto_name = os.path.join(
-            args.saveto, f"iter_{max_iter}_L_{seq_len}.fasta"
+        # samples are numbered across seeds, as in a single-seed run
+        seeds = args.seeds if args.seeds else [args.seed]
+        offset = seeds.index(shard.seed) * args.num_seqs + shard.start
+        shard_outputs = ShardOutputs()
+        shard_outputs.write_fasta(
+            os.path.join(args.saveto, f"iter_{max_iter}_L_{seq_len}.fasta"),
+            headers=[
+                f"SEQUENCE_{offset + idx}_L={seq_len}"
+                for idx in range(len(output_results))
+            ],
+            seqs=output_results,
         )
-        fp_save = open(saveto_name, "w")
-        for idx, seq in enumerate(output_results):
-            fp_save.write(f">SEQUENCE_{idx}_L={seq_len}\n")
-            fp_save.write(f"{seq}\n")
-        fp_save.close()
+        return shard_outputs
+
+
+def get_manifest_config(args):
+    # every argument the outputs depend on, so that resuming with other
+    # settings is rejected rather than mixing outputs (the lengths, number
+    # of samples and seeds are in the shards)
+    config = dict(
+        model_name=args.model_name,
+        max_iter=args.max_iter,
+        temperature=args.temperature,
+        sampling_strategy=args.sampling_strategy,
+        batch_size=args.batch_size,
+        early_exit=args.early_exit,
+        draft_model_name=args.draft_model_name,
+    )
+    if args.early_exit:
+        config.update(
+            early_exit_patience=args.early_exit_patience,
+            early_exit_tol=args.early_exit_tol,
+        )
+    if args.draft_model_name:
+        config.update(draft_steps=args.draft_steps)
+    return config
+
+
+def generate(args):
+    # every batch is written to disk once generated, and recorded in the
+    # manifest so that an interrupted sweep resumes from the pending batches
+    seeds = args.seeds if args.seeds else [args.seed]
+    shards = build_sweep_shards(
+        args.seq_lens, args.num_seqs, seeds=seeds, batch_size=args.batch_size
+    )
+    manifest = GenerationManifest(
+        args.saveto,
+        shards,
+        config=get_manifest_config(args),
+    )
+    run_sharded(
+        manifest,
+        DPLMGenerationWorker(args),
+        num_workers=args.num_workers,
+        device=args.device,
+        num_threads=args.num_threads,
+    )
 
 
 def main():
@@ -124,12 +227,32 @@ def main():
     )
     parser.add_argument("--num_seqs", type=int, default=40)
     parser.add_argument("--seq_lens", nargs="*", type=int)
+    # generate num_seqs samples for each of the seeds (default: --seed)
+    parser.add_argument("--seeds", nargs="*", type=int)
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=None,
+        help="samples per batch, each batch is saved once generated",
+    )
     parser.add_argument("--saveto", type=str, default="gen.fasta")
     parser.add_argument("--temperature", type=float, default=1.0)
+    add_launcher_args(parser)
     parser.add_argument(
         "--sampling_strategy", type=str, default="gumbel_argmax"
     )
     parser.add_argument("--max_iter", type=int, default=500)
+    # stop decoding a sequence once its prediction stays unchanged for
+    # `early_exit_patience` steps
+    parser.add_argument("--early_exit", action="store_true")
+    parser.add_argument("--early_exit_patience", type=int, default=5)
+    parser.add_argument("--early_exit_tol", type=float, default=None)
+    # speculative decoding: a smaller DPLM (e.g., airkingbd/dplm_150m)
+    # proposes draft_steps steps, verified by one pass of --model_name
+    parser.add_argument("--draft_model_name", type=str, default=None)
+    parser.add_argument("--draft_steps", type=int, default=4)
+    # save the decoding trajectory every k steps to <saveto>/history (0: off)
+    parser.add_argument("--history_every", type=int, default=0)
     # inpainting
     # Note: the format of --cond_position and --cond_seq should split by ','
     # the number and the length of segments should match.
@@ -5,12 +5,21 @@ import torch
 import tree
 from Bio import SeqIO
 from peft.peft_model import PeftModel
-from tqdm import tqdm
 
+from byprot import utils
 from byprot.models.dplm2 import DPLM2Bit
 from byprot.models.dplm2 import (
     MultimodalDiffusionProteinLanguageModel as DPLM2,
 )
+from byprot.utils.generation import (
+    GenerationManifest,
+    GenerationShard,
+    GenerationWorker,
+    ShardOutputs,
+    add_launcher_args,
+    build_sweep_shards,
+    run_sharded,
+)
 
 
 def initialize_conditional_generation(
@@ -196,66 +205,129 @@ def initialize_generation(
     return input_tokens_batch
 
 
-def unconditional_generate(args):
+def get_early_exit_kwargs(args):
+    # both DPLM2 and DPLM2Bit then also return the decoding steps used by
+    # each sequence as `num_steps`
+    if not args.early_exit:
+        return {}
+    return dict(
+        early_exit=True,
+        early_exit_patience=args.early_exit_patience,
+        early_exit_tol=args.early_exit_tol,
+    )
+
+
+def load_model(args, device):
     if args.bit_model:
         model = DPLM2Bit.from_pretrained(args.model_name)
     else:
         model = DPLM2.from_pretrained(args.model_name)
 
-    tokenizer = model.tokenizer
     model = model.eval()
-    model = model.cuda()
-    device = next(model.parameters()).device
+    model = model.to(device)
     if issubclass(type(model.net), PeftModel):
         model.net = model.net.merge_and_unload()
+    return model
+
+
+def get_manifest_config(args):
+    # every argument the outputs depend on, so that resuming with other
+    # settings is rejected rather than mixing outputs (the lengths, number
+    # of samples and seeds are in the shards)
+    return dict(
+        model_name=args.model_name,
+        bit_model=args.bit_model,
+        task=args.task,
+        input_fasta_path=args.input_fasta_path,
+        max_iter=args.max_iter,
+        temperature=args.temperature,
+        sampling_strategy=args.sampling_strategy,
+        unmasking_strategy=args.unmasking_strategy,
+        batch_size=args.batch_size,
+        save_pdb=args.save_pdb,
+        save_parquet=args.save_parquet,
+        **get_early_exit_kwargs(args),
+    )
 
-    for seq_len in args.seq_lens:
+
+class DPLM2GenerationWorker(GenerationWorker):
+    def __init__(self, args):
+        self.args = args
+
+    def setup(self, device):
+        self.model = load_model(self.args, device)
+        self.tokenizer = self.model.tokenizer
+        self.device = torch.device(device)
+        if self.args.task in ["folding", "inverse_folding"]:
+            (
+                self.batches,
+                self.name_lists,
+            ) = initialize_conditional_generation(
+                self.args.input_fasta_path,
+                self.tokenizer,
+                self.device,
+                args=self.args,
+                model=self.model,
+            )
+
+    def generate(self, input_tokens, partial_masks=None):
+        args = self.args
+        with torch.autocast(
+            "cuda", dtype=torch.bfloat16, enabled=self.device.type == "cuda"
+        ):
+            return self.model.generate(
+                input_tokens=input_tokens,
+                max_iter=args.max_iter,
+                temperature=args.temperature,
+                unmasking_strategy=args.unmasking_strategy,
+                sampling_strategy=args.sampling_strategy,
+                partial_masks=partial_masks,
+                **get_early_exit_kwargs(args),
+            )
+
+    @torch.no_grad()
+    def __call__(self, shard):
+        utils.seed_everything(shard.rng_seed)
+        if self.args.task in ["folding", "inverse_folding"]:
+            return self.run_conditional(shard)
+        return self.run_unconditional(shard)
+
+    def run_unconditional(self, shard):
+        args, tokenizer = self.args, self.tokenizer
         max_iter = args.max_iter
-        input_tokens_batch = initialize_generation(
+        seq_len = shard.length
+        (input_tokens,) = initialize_generation(
             task=args.task,
-            num_seqs=args.num_seqs,
+            num_seqs=shard.num_seqs,
             length=seq_len,
             tokenizer=tokenizer,
-            device=device,
-            batch_size=args.batch_size,
+            device=self.device,
+            batch_size=shard.num_seqs,
         )
-        with torch.cuda.amp.autocast(dtype=torch.bfloat16):
-            all_outputs = {}
-            for input_tokens in input_tokens_batch:
-                _struct_tokens, _aatype_tokens = input_tokens.chunk(2, dim=1)
-                if args.task == "backbone_generation":
-                    input_tokens = _struct_tokens
-                if args.task == "sequence_generation":
-                    input_tokens = _aatype_tokens
-                outputs = model.generate(
-                    input_tokens=input_tokens,
-                    max_iter=max_iter,
-                    temperature=args.temperature,
-                    unmasking_strategy=args.unmasking_strategy,
-                    sampling_strategy=args.sampling_strategy,
-                )
-                if args.task == "backbone_generation":
-                    _struct_tokens = outputs["output_tokens"].chunk(2, dim=1)[
-                        0
-                    ]
-                    outputs["output_tokens"] = torch.cat(
-                        [_struct_tokens, _aatype_tokens], dim=1
-                    )
-                for k, v in outputs.items():
-                    if k in all_outputs:
-                        all_outputs[k] = torch.concat(
-                            [all_outputs[k], v], dim=0
-                        )
-                    else:
-                        all_outputs[k] = v
-
-        print("final:")
+        _struct_tokens, _aatype_tokens = input_tokens.chunk(2, dim=1)
+        if args.task == "backbone_generation":
+            input_tokens = _struct_tokens
+        if args.task == "sequence_generation":
+            input_tokens = _aatype_tokens
+        outputs = self.generate(input_tokens)
         if args.task == "backbone_generation":
+            _struct_tokens = outputs["output_tokens"].chunk(2, dim=1)[0]
+            outputs["output_tokens"] = torch.cat(
+                [_struct_tokens, _aatype_tokens], dim=1
+            )
+
+        if "num_steps" in outputs:
+            print(
+                f"Average decoding steps: "
+                f"{outputs['num_steps'].float().mean():.1f}/{max_iter}"
+            )
+        print(f"final ({shard.name}):")
+        if args.task in ["backbone_generation", "co_generation"]:
             print(
                 [
                     ",".join(seq.split(" "))
                     for seq in tokenizer.batch_decode(
-                        all_outputs["output_tokens"], skip_special_tokens=False
+                        outputs["output_tokens"], skip_special_tokens=False
                     )
                 ]
             )
@@ -264,71 +336,107 @@ def unconditional_generate(args):
                 [
                     "".join(seq.split(" "))
                     for seq in tokenizer.batch_decode(
-                        all_outputs["output_tokens"], skip_special_tokens=False
-                    )
-                ]
-            )
-        elif args.task == "co_generation":
-            print(
-                [
-                    ",".join(seq.split(" "))
-                    for seq in tokenizer.batch_decode(
-                        all_outputs["output_tokens"], skip_special_tokens=False
+                        outputs["output_tokens"], skip_special_tokens=False
                     )
                 ]
             )
         else:
             raise NotImplementedError
 
-        # save
-        save_results(
-            outputs=all_outputs,
-            task=args.task,
-            save_dir=os.path.join(args.saveto, args.task, f"length_{seq_len}"),
-            tokenizer=tokenizer,
-            struct_tokenizer=model.struct_tokenizer,
-            save_pdb=args.save_pdb,
+        # save, numbering the samples across seeds as in a single-seed run
+        seeds = args.seeds if args.seeds else [args.seed]
+        offset = seeds.index(shard.seed) * args.num_seqs + shard.start
+        save_dir = os.path.join(args.saveto, args.task, f"length_{seq_len}")
+        return self.save(
+            shard,
+            outputs,
+            save_dir,
+            headers=[
+                f"sample_{offset + i}"
+                for i in range(len(outputs["output_tokens"]))
+            ],
         )
 
+    def run_conditional(self, shard):
+        batch = self.batches[shard.start]
+        outputs = self.generate(
+            batch["input_tokens"], partial_masks=batch["partial_mask"]
+        )
+        return self.save(
+            shard,
+            outputs,
+            os.path.join(self.args.saveto, self.args.task),
+            headers=self.name_lists[shard.start],
+        )
 
-def conditional_generate_from_fasta(args):
-    if args.bit_model:
-        model = DPLM2Bit.from_pretrained(args.model_name)
-    else:
-        model = DPLM2.from_pretrained(args.model_name)
+    def save(self, shard, outputs, save_dir, headers):
+        # pdb files are written here, fasta / parquet by the launcher
+        shard_outputs = ShardOutputs()
+        records = save_results(
+            outputs=outputs,
+            task=self.args.task,
+            save_dir=save_dir,
+            headers=headers,
+            tokenizer=self.tokenizer,
+            struct_tokenizer=self.model.struct_tokenizer,
+            save_pdb=self.args.save_pdb,
+            continue_write=True,
+            sink=shard_outputs,
+        )
+        if self.args.save_parquet:
+            shard_outputs.write_parquet(
+                os.path.join(save_dir, "parquet"), shard, records
+            )
+        return shard_outputs
 
-    tokenizer = model.tokenizer
-    model = model.eval()
-    model = model.cuda()
-    device = next(model.parameters()).device
-    if issubclass(type(model.net), PeftModel):
-        model.net = model.net.merge_and_unload()
 
-    batches, name_lists = initialize_conditional_generation(
-        args.input_fasta_path, tokenizer, device, args=args, model=model
+def get_conditional_shards(args):
+    """One shard per batch of `initialize_conditional_generation`, which
+    sorts the inputs by length."""
+    lengths = sorted(
+        len(record.seq.split(","))
+        if args.task == "inverse_folding"
+        else len(record.seq)
+        for record in SeqIO.parse(args.input_fasta_path, "fasta")
     )
+    batch_size = args.batch_size if args.batch_size > 0 else len(lengths)
+    return [
+        GenerationShard(
+            name=f"batch_{i}",
+            length=max(lengths[start : start + batch_size]),
+            seed=args.seed,
+            start=i,
+            num_seqs=len(lengths[start : start + batch_size]),
+        )
+        for i, start in enumerate(range(0, len(lengths), batch_size))
+    ]
 
-    for i, batch in enumerate(tqdm(batches, desc=f"{args.task}")):
-        with torch.cuda.amp.autocast(dtype=torch.bfloat16):
-            outputs = model.generate(
-                input_tokens=batch["input_tokens"],
-                max_iter=args.max_iter,
-                temperature=args.temperature,
-                unmasking_strategy=args.unmasking_strategy,
-                sampling_strategy=args.sampling_strategy,
-                partial_masks=batch["partial_mask"],
-            )
 
-        save_results(
-            outputs=outputs,
-            task=args.task,
-            save_dir=os.path.join(args.saveto, args.task),
-            headers=name_lists[i],
-            tokenizer=tokenizer,
-            struct_tokenizer=model.struct_tokenizer,
-            save_pdb=args.save_pdb,
-            continue_write=True,
+def generate(args):
+    # every batch is saved once generated, and recorded in the manifest so
+    # that an interrupted job resumes from the pending batches
+    if args.task in ["folding", "inverse_folding"]:
+        shards = get_conditional_shards(args)
+    else:
+        seeds = args.seeds if args.seeds else [args.seed]
+        shards = build_sweep_shards(
+            args.seq_lens,
+            args.num_seqs,
+            seeds=seeds,
+            batch_size=args.batch_size,
         )
+    manifest = GenerationManifest(
+        os.path.join(args.saveto, args.task),
+        shards,
+        config=get_manifest_config(args),
+    )
+    run_sharded(
+        manifest,
+        DPLM2GenerationWorker(args),
+        num_workers=args.num_workers,
+        device=args.device,
+        num_threads=args.num_threads,
+    )
 
 
 def save_fasta(
@@ -337,20 +445,22 @@ def save_fasta(
     struct_tokens=False,
     headers=None,
     continue_write=False,
+    sink=None,
 ):
+    if headers is None:
+        headers = [f"SEQUENCE_{idx}" for idx in range(len(output_results))]
+    sep = "," if struct_tokens else ""
+    seqs = [sep.join(seq.split(" ")) for seq in output_results]
+    if sink is not None:
+        # a GenerationManifest or the ShardOutputs of a generation worker
+        sink.write_fasta(save_name, headers, seqs)
+        return
     fp_save = (
         open(save_name, "w") if not continue_write else open(save_name, "a")
     )
-    for idx, seq in enumerate(output_results):
-        if headers is not None:
-            fp_save.write(f">{headers[idx]}\n")
-        else:
-            fp_save.write(f">SEQUENCE_{idx}\n")
-        seq = seq.split(" ")
-        if struct_tokens:
-            fp_save.write(f"{','.join(seq)}\n")
-        else:
-            fp_save.write(f"{''.join(seq)}\n")
+    for header, seq in zip(headers, seqs):
+        fp_save.write(f">{header}\n")
+        fp_save.write(f"{seq}\n")
     fp_save.close()
 
 
@@ -363,7 +473,10 @@ def save_results(
     headers=None,
     save_pdb=True,
     continue_write=False,
+    sink=None,
 ):
+    """Save the outputs to fasta files (and pdb files if `save_pdb`) in
+    `save_dir`, and return the decoded sequences as columns."""
     # save to fasta
     os.makedirs(save_dir, exist_ok=True)
     print(f"Saving results to {save_dir}...")
@@ -386,7 +499,9 @@ def save_results(
             output_results=aatype_strings,
             headers=headers,
             continue_write=continue_write,
+            sink=sink,
         )
+        records = {"header": headers, "aa_seq": aatype_strings}
 
     elif task in [
         "backbone_generation",
@@ -419,13 +534,20 @@ def save_results(
             output_results=struct_tokens_strings,
             headers=headers,
             continue_write=continue_write,
+            sink=sink,
         )
         save_fasta(
             save_name=aatype_fasta_path,
             output_results=aatype_strings,
             headers=headers,
             continue_write=continue_write,
+            sink=sink,
         )
+        records = {
+            "header": headers,
+            "aa_seq": aatype_strings,
+            "struct_seq": struct_tokens_strings,
+        }
         if save_pdb:
             pdb_save_dir = os.path.join(save_dir, "pdb")
             os.makedirs(pdb_save_dir, exist_ok=True)
@@ -459,7 +581,7 @@ def save_results(
     else:
         raise NotImplementedError
 
-    return
+    return records
 
 
 def main():
@@ -471,6 +593,8 @@ def main():
     )
     parser.add_argument("--num_seqs", type=int, default=40)
     parser.add_argument("--seq_lens", nargs="*", type=int)
+    # generate num_seqs samples for each of the seeds (default: --seed)
+    parser.add_argument("--seeds", nargs="*", type=int)
     parser.add_argument("--saveto", type=str, default="gen.fasta")
     parser.add_argument("--temperature", type=float, default=1.0)
     parser.add_argument(
@@ -483,6 +607,14 @@ def main():
     parser.add_argument("--batch_size", type=int, default=50)
     parser.add_argument("--save_pdb", type=bool, default=True)
     parser.add_argument("--bit_model", action="store_true")
+    add_launcher_args(parser)
+    # also save the sequences as parquet, one file per batch
+    parser.add_argument("--save_parquet", action="store_true")
+    # stop decoding a sequence once its prediction stays unchanged for
+    # `early_exit_patience` steps
+    parser.add_argument("--early_exit", action="store_true")
+    parser.add_argument("--early_exit_patience", type=int, default=5)
+    parser.add_argument("--early_exit_tol", type=float, default=None)
 
     # generation options
     ## task option
@@ -503,16 +635,7 @@ def main():
 
     args = parser.parse_args()
 
-    if args.task in [
-        "backbone_generation",
-        "sequence_generation",
-        "co_generation",
-    ]:
-        unconditional_generate(args)
-    elif args.task in ["folding", "inverse_folding"]:
-        conditional_generate_from_fasta(args)
-    else:
-        raise NotImplementedError
+    generate(args)
 
 
 if __name__ == "__main__":
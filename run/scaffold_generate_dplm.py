@@ -13,18 +13,37 @@ import torch
 
 from byprot import utils
 from byprot.models.dplm.dplm import DiffusionProteinLanguageModel
+from byprot.utils.generation import (
+    GenerationManifest,
+    GenerationShard,
+    GenerationWorker,
+    ShardOutputs,
+    add_launcher_args,
+    run_sharded,
+)
 from byprot.utils.scaffold_utils import *
 
 
-def generate(args, saveto):
-    model = DiffusionProteinLanguageModel.from_pretrained(args.model_name)
-    tokenizer = model.tokenizer
-    model = model.eval()
-    model = model.cuda()
-    device = next(model.parameters()).device
-
-    # Generate
-    for ori_pdb, pdb in motif_name_mapping.items():
+class ScaffoldWorker(GenerationWorker):
+    def __init__(self, args, saveto):
+        self.args = args
+        self.saveto = saveto
+
+    def setup(self, device):
+        model = DiffusionProteinLanguageModel.from_pretrained(
+            self.args.model_name
+        )
+        self.model = model.eval().to(device)
+        self.tokenizer = model.tokenizer
+        self.device = torch.device(device)
+
+    @torch.no_grad()
+    def __call__(self, shard):
+        args, saveto = self.args, self.saveto
+        model, tokenizer, device = self.model, self.tokenizer, self.device
+        utils.seed_everything(shard.rng_seed)
+        ori_pdb = shard.name
+        pdb = motif_name_mapping[ori_pdb]
         max_iter = args.max_iter
         (
             batch,
@@ -67,7 +86,9 @@ def generate(args, saveto):
 
             batch.update(batch_struct)
 
-        with torch.cuda.amp.autocast():
+        with torch.autocast(
+            "cuda", dtype=torch.float16, enabled=device.type == "cuda"
+        ):
             outputs = model.generate(
                 input_tokens=batch,
                 temperature=args.temperature,
@@ -87,17 +108,19 @@ def generate(args, saveto):
         pprint(output_results)
 
         # save output
+        shard_outputs = ShardOutputs()
         scaffold_fasta_path = os.path.join(saveto, "scaffold_fasta")
-        os.makedirs(scaffold_fasta_path, exist_ok=True)
         saveto_name = os.path.join(scaffold_fasta_path, f"{ori_pdb}.fasta")
-        fp_save = open(saveto_name, "w")
-        for idx, seq in enumerate(output_results):
-            fp_save.write(f">SEQUENCE_{idx}_PDB_{ori_pdb}\n")
-            fp_save.write(f"{seq}\n")
-        fp_save.close()
+        shard_outputs.write_fasta(
+            saveto_name,
+            headers=[
+                f"SEQUENCE_{idx}_PDB_{ori_pdb}"
+                for idx in range(len(output_results))
+            ],
+            seqs=output_results,
+        )
 
         scaffold_info_path = os.path.join(saveto, "scaffold_info")
-        os.makedirs(scaffold_info_path, exist_ok=True)
         strings = output_results
         save_df = pd.DataFrame(
             list(
@@ -110,9 +133,47 @@ def generate(args, saveto):
             ),
             columns=["seqs", "start_idxs", "end_idxs", "scaffold_lengths"],
         )
-        save_df.to_csv(
-            os.path.join(scaffold_info_path, f"{ori_pdb}.csv"), index=True
+        shard_outputs.write_text(
+            os.path.join(scaffold_info_path, f"{ori_pdb}.csv"),
+            save_df.to_csv(index=True),
         )
+        return shard_outputs
+
+
+def get_manifest_config(args):
+    # every argument the outputs depend on, so that resuming with other
+    # settings is rejected rather than mixing outputs (the number of
+    # samples and seeds are in the shards)
+    return dict(
+        model_name=args.model_name,
+        max_iter=args.max_iter,
+        temperature=args.temperature,
+        sampling_strategy=args.sampling_strategy,
+        scaffold_min=args.scaffold_min,
+        scaffold_max=args.scaffold_max,
+        structure_enc=args.structure_enc,
+    )
+
+
+def generate(args, saveto):
+    # one shard per motif, saved once generated so that an interrupted run
+    # resumes from the pending motifs
+    shards = [
+        GenerationShard(name=ori_pdb, seed=args.seed, num_seqs=args.num_seqs)
+        for ori_pdb in motif_name_mapping
+    ]
+    manifest = GenerationManifest(
+        saveto,
+        shards,
+        config=get_manifest_config(args),
+    )
+    run_sharded(
+        manifest,
+        ScaffoldWorker(args, saveto),
+        num_workers=args.num_workers,
+        device=args.device,
+        num_threads=args.num_threads,
+    )
 
 
 def main():
@@ -129,6 +190,7 @@ def main():
         "--sampling_strategy", type=str, default="gumbel_argmax"
     )
     parser.add_argument("--max_iter", type=int, default=500)
+    add_launcher_args(parser)
 
     parser.add_argument(
         "--start-idxs",
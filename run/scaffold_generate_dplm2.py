@@ -8,35 +8,55 @@ import pandas as pd
 import torch
 from peft.peft_model import PeftModel
 
+from byprot import utils
 from byprot.models.dplm2.dplm2 import MultimodalDiffusionProteinLanguageModel
+from byprot.utils.generation import (
+    GenerationManifest,
+    GenerationShard,
+    GenerationWorker,
+    ShardOutputs,
+    add_launcher_args,
+    run_sharded,
+)
 from byprot.utils.scaffold_utils import *
 from generate_dplm2 import save_fasta
 
 
-@torch.no_grad()
-def generate(args, saveto):
-    model = MultimodalDiffusionProteinLanguageModel.from_pretrained(
-        args.model_name
-    )
-    tokenizer = model.tokenizer
-    model = model.eval()
-    model = model.cuda()
-    device = next(model.parameters()).device
-    if issubclass(type(model.net), PeftModel):
-        model.net = model.net.merge_and_unload()
-
-    # Read motif fasta file
-    with open(args.motif_aa, "r") as f:
-        fasta_file = fasta.FastaFile.read(f)
-        motif_aa_seq = dict(fasta_file.items())
-    with open(args.motif_struct, "r") as f:
-        fasta_file = fasta.FastaFile.read(f)
-        motif_struct_seq = dict(fasta_file.items())
-
-    for ori_pdb_name, pdb_name in motif_name_mapping.items():
-        struct_seq = motif_struct_seq[pdb_name]
-        aa_seq = motif_aa_seq[pdb_name]
+class ScaffoldWorker(GenerationWorker):
+    def __init__(self, args, saveto):
+        self.args = args
+        self.saveto = saveto
+
+    def setup(self, device):
+        model = MultimodalDiffusionProteinLanguageModel.from_pretrained(
+            self.args.model_name
+        )
+        model = model.eval().to(device)
+        if issubclass(type(model.net), PeftModel):
+            model.net = model.net.merge_and_unload()
+        self.model = model
+        self.tokenizer = model.tokenizer
+        self.device = torch.device(device)
+
+        # Read motif fasta file
+        with open(self.args.motif_aa, "r") as f:
+            fasta_file = fasta.FastaFile.read(f)
+            self.motif_aa_seq = dict(fasta_file.items())
+        with open(self.args.motif_struct, "r") as f:
+            fasta_file = fasta.FastaFile.read(f)
+            self.motif_struct_seq = dict(fasta_file.items())
+
+    @torch.no_grad()
+    def __call__(self, shard):
+        args, saveto = self.args, self.saveto
+        model, tokenizer, device = self.model, self.tokenizer, self.device
+        ori_pdb_name = shard.name.rsplit("_iter_", 1)[0]
+        pdb_name = motif_name_mapping[ori_pdb_name]
+        struct_seq = self.motif_struct_seq[pdb_name]
+        aa_seq = self.motif_aa_seq[pdb_name]
         max_iter = args.max_iter
+        # same scaffold lengths for all the iterations of a motif
+        utils.seed_everything(args.seed)
         (
             batches,
             start_idxs_list,
@@ -52,80 +72,118 @@ def generate(args, saveto):
             device,
         )
 
-        for iteration in range(1, args.sampling_each_seq + 1):
-            output_tokens = torch.tensor([], device=device)
-            for batch in batches:
-                with torch.cuda.amp.autocast():
-                    outputs = model.generate(
-                        input_tokens=batch["input_ids"],
-                        max_iter=max_iter,
-                        sampling_strategy=args.sampling_strategy,
-                        partial_masks=batch["partial_mask"],
-                    )
-                output_tokens = torch.concat([output_tokens, outputs[0]])
-            assert output_tokens.shape[0] == len(start_idxs_list)
-            print("final:")
-            pprint(
-                [
-                    ",".join(seq.split(" "))
-                    for seq in tokenizer.batch_decode(
-                        output_tokens, skip_special_tokens=False
-                    )
-                ]
-            )
-
-            # save output
-            scaffold_fasta_path = os.path.join(saveto, "scaffold_fasta")
-            os.makedirs(scaffold_fasta_path, exist_ok=True)
-            scaffold_info_path = os.path.join(saveto, "scaffold_info")
-            os.makedirs(scaffold_info_path, exist_ok=True)
-
-            # save scaffold fasta
-            save_results(
-                output_tokens=output_tokens,
-                save_dir=os.path.join(scaffold_fasta_path, ori_pdb_name),
-                tokenizer=tokenizer,
-                struct_tokenizer=model.struct_tokenizer,
-                save_pdb=True,
-                continue_write=True,
-            )
-
-            # save scaffold info
-            struct_tokens, aa_tokens = output_tokens.chunk(2, dim=-1)
-            aa_strings = [
-                "".join(seq.split(" "))
-                for seq in tokenizer.batch_decode(
-                    aa_tokens, skip_special_tokens=True
+        utils.seed_everything(shard.rng_seed)
+        output_tokens = torch.tensor([], device=device)
+        for batch in batches:
+            with torch.autocast(
+                "cuda", dtype=torch.float16, enabled=device.type == "cuda"
+            ):
+                outputs = model.generate(
+                    input_tokens=batch["input_ids"],
+                    max_iter=max_iter,
+                    sampling_strategy=args.sampling_strategy,
+                    partial_masks=batch["partial_mask"],
                 )
-            ]
-            struct_strings = [
+            output_tokens = torch.concat(
+                [output_tokens, outputs["output_tokens"]]
+            )
+        assert output_tokens.shape[0] == len(start_idxs_list)
+        print("final:")
+        pprint(
+            [
                 ",".join(seq.split(" "))
                 for seq in tokenizer.batch_decode(
-                    struct_tokens, skip_special_tokens=True
+                    output_tokens, skip_special_tokens=False
                 )
             ]
-            save_df = pd.DataFrame(
-                list(
-                    zip(
-                        aa_strings,
-                        struct_strings,
-                        start_idxs_list,
-                        end_idxs_list,
-                        scaffold_lengths_list,
-                    )
-                ),
-                columns=[
-                    "aa_seqs",
-                    "struct_seqs",
-                    "start_idxs",
-                    "end_idxs",
-                    "scaffold_lengths",
-                ],
+        )
+
+        # save output
+        shard_outputs = ShardOutputs()
+        scaffold_fasta_path = os.path.join(saveto, "scaffold_fasta")
+        scaffold_info_path = os.path.join(saveto, "scaffold_info")
+
+        # save scaffold fasta
+        save_results(
+            output_tokens=output_tokens,
+            save_dir=os.path.join(scaffold_fasta_path, ori_pdb_name),
+            tokenizer=tokenizer,
+            struct_tokenizer=model.struct_tokenizer,
+            save_pdb=True,
+            continue_write=True,
+            sink=shard_outputs,
+        )
+
+        # save scaffold info
+        struct_tokens, aa_tokens = output_tokens.chunk(2, dim=-1)
+        aa_strings = [
+            "".join(seq.split(" "))
+            for seq in tokenizer.batch_decode(
+                aa_tokens, skip_special_tokens=True
             )
-            save_df.to_csv(
-                os.path.join(scaffold_info_path, f"{ori_pdb_name}.csv"),
-                index=False,
+        ]
+        struct_strings = [
+            ",".join(seq.split(" "))
+            for seq in tokenizer.batch_decode(
+                struct_tokens, skip_special_tokens=True
             )
+        ]
+        save_df = pd.DataFrame(
+            list(
+                zip(
+                    aa_strings,
+                    struct_strings,
+                    start_idxs_list,
+                    end_idxs_list,
+                    scaffold_lengths_list,
+                )
+            ),
+            columns=[
+                "aa_seqs",
+                "struct_seqs",
+                "start_idxs",
+                "end_idxs",
+                "scaffold_lengths",
+            ],
+        )
+        shard_outputs.write_text(
+            os.path.join(scaffold_info_path, f"{ori_pdb_name}.csv"),
+            save_df.to_csv(index=False),
+        )
+        return shard_outputs
+
+
+def generate(args, saveto):
+    # one shard per (motif, iteration), saved once generated so that an
+    # interrupted run resumes from the pending ones
+    shards = [
+        GenerationShard(
+            name=f"{ori_pdb_name}_iter_{iteration}",
+            seed=args.seed,
+            start=iteration,
+            num_seqs=args.num_seqs,
+        )
+        for ori_pdb_name in motif_name_mapping
+        for iteration in range(1, args.sampling_each_seq + 1)
+    ]
+    manifest = GenerationManifest(
+        saveto,
+        shards,
+        config=dict(
+            model_name=args.model_name,
+            max_iter=args.max_iter,
+            sampling_strategy=args.sampling_strategy,
+            motif_aa=args.motif_aa,
+            motif_struct=args.motif_struct,
+        ),
+    )
+    run_sharded(
+        manifest,
+        ScaffoldWorker(args, saveto),
+        num_workers=args.num_workers,
+        device=args.device,
+        num_threads=args.num_threads,
+    )
 
 
 def save_results(
@@ -136,6 +194,7 @@ def save_results(
     headers=None,
     save_pdb=False,
     continue_write=False,
+    sink=None,
 ):
     # save to fasta
     os.makedirs(save_dir, exist_ok=True)
@@ -162,6 +221,7 @@ def save_results(
         output_results=aatype_strings,
         headers=headers,
         continue_write=continue_write,
+        sink=sink,
     )
     if save_pdb:
         pdb_save_dir = os.path.join(save_dir, "pdb")
@@ -199,6 +259,8 @@ def main():
     )
     parser.add_argument("--max_iter", type=int, default=500)
     parser.add_argument("--batch_size", type=int, default=100)
+    parser.add_argument("--sampling_each_seq", type=int, default=1)
+    add_launcher_args(parser)
     parser.add_argument(
         "--model_name", type=str, default="airkingbd/dplm2_650m"
     )
@@ -0,0 +1,68 @@
+import argparse
+
+import torch
+
+from byprot import utils
+from byprot.utils.generation import GenerationEngine, serve
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve DPLM / DPLM-2 generation with continuous batching."
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--model_name", type=str, default="airkingbd/dplm_150m"
+    )
+    parser.add_argument(
+        "--model_type", type=str, choices=["dplm", "dplm2"], default="dplm"
+    )
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--unix_socket",
+        type=str,
+        default=None,
+        help="serve on a unix socket instead of host:port",
+    )
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        default=None,
+        help="budget of padded tokens of each decoding batch",
+    )
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--sampling_strategy", type=str, default=None)
+    parser.add_argument("--unmasking_strategy", type=str, default=None)
+    parser.add_argument("--bf16", action="store_true")
+    args = parser.parse_args()
+
+    utils.seed_everything(args.seed)
+
+    backend_kwargs = dict(temperature=args.temperature)
+    if args.sampling_strategy is not None:
+        backend_kwargs["sampling_strategy"] = args.sampling_strategy
+    if args.unmasking_strategy is not None:
+        backend_kwargs["unmasking_strategy"] = args.unmasking_strategy
+
+    engine = GenerationEngine.from_pretrained(
+        args.model_name,
+        model_type=args.model_type,
+        device=args.device,
+        backend_kwargs=backend_kwargs,
+        max_batch_size=args.max_batch_size,
+        max_tokens=args.max_tokens,
+        autocast_dtype=torch.bfloat16 if args.bf16 else None,
+    )
+    serve(
+        engine,
+        host=args.host,
+        port=args.port,
+        unix_socket=args.unix_socket,
+    )
+
+
+if __name__ == "__main__":
+    main()
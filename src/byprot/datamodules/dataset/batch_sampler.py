@@ -0,0 +1,269 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+
+import heapq
+import math
+from typing import Iterable, List, Optional
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+from byprot import utils
+
+log = utils.get_logger(__name__)
+
+
+def pack_batches(
+    lengths,
+    max_tokens,
+    max_batch,
+    max_square_tokens=np.inf,
+):
+    """Greedily pack consecutive samples of `lengths` into batches, with
+    the budgets of `ApproxBatchSampler`: batch size * longest length <=
+    `max_tokens`, batch size * longest length^2 < `max_square_tokens` and
+    batch size <= `max_batch`.
+
+    Returns the batch boundaries, i.e., batch `b` holds samples
+    `bounds[b]:bounds[b + 1]`, and a mask of the samples that do not fit a
+    batch by themselves (which are skipped, as in `ApproxBatchSampler`).
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    # no batch is larger than this window, which is checked at once
+    min_length = max(int(lengths.min()), 1) if len(lengths) else 1
+    window = max(1, min(max_batch, max_tokens // min_length))
+    counts = np.arange(1, window + 1)
+    too_long = (lengths > max_tokens) | (lengths**2 >= max_square_tokens)
+
+    bounds, start = [0], 0
+    while start < len(lengths):
+        if too_long[start]:
+            start += 1
+            bounds.append(start)
+            continue
+        longest = np.maximum.accumulate(lengths[start : start + window])
+        n = counts[: len(longest)]
+        fits = (n * longest <= max_tokens) & (
+            n * longest**2 < max_square_tokens
+        )
+        # the first sample that does not fit, or the end of the window
+        size = len(longest) if fits.all() else int(np.argmin(fits))
+        start += size
+        bounds.append(start)
+    return np.asarray(bounds), too_long
+
+
+def pack_token_batches(lengths, max_tokens, max_batch):
+    """Greedily pack consecutive samples of `lengths` into batches of at
+    most `max_tokens` tokens in total (i.e., without padding, for packed
+    rows) and at most `max_batch` samples.
+
+    Returns the batch boundaries and the mask of the samples exceeding
+    `max_tokens` by themselves, as :func:`pack_batches`.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    too_long = lengths > max_tokens
+    cumsum = np.concatenate([[0], np.cumsum(lengths)])
+    bounds, start = [0], 0
+    while start < len(lengths):
+        # the last sample within the budget, but at least one
+        end = np.searchsorted(cumsum, cumsum[start] + max_tokens, "right") - 1
+        end = min(max(int(end), start + 1), start + max_batch)
+        start = end
+        bounds.append(start)
+    return np.asarray(bounds), too_long
+
+
+def first_fit_rows(lengths, capacity):
+    """Assign samples of `lengths` to rows of `capacity` tokens, first-fit
+    in decreasing order of length. Samples longer than `capacity` get a
+    row of their own. Returns the sample indices of each row."""
+    rows, free = [], []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for r, space in enumerate(free):
+            if lengths[i] <= space:
+                rows[r].append(i)
+                free[r] -= lengths[i]
+                break
+        else:
+            rows.append([i])
+            free.append(capacity - lengths[i])
+    return rows
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Batches of samples of similar lengths under token budgets, rebuilt
+    for every epoch.
+
+    Samples are sorted by their lengths (clipped to `max_len`) jittered by
+    up to `length_noise` (relatively), so that batches are tightly packed
+    but differ from epoch to epoch, and packed as in `ApproxBatchSampler`
+    (see :func:`pack_batches`). Every rank builds the same batches from
+    the same seed, so no communication is needed, and takes one batch per
+    round of the batches sorted by cost (padded tokens, or padded
+    tokens^2 with `max_square_tokens`), the most expensive one going to
+    the least loaded rank. All ranks thus get the same number of batches
+    at a balanced total cost; the last round is completed with the
+    cheapest batches, or dropped with `drop_last`.
+
+    With `packed`, the samples are to be packed into rows rather than
+    padded (see `DPLMPackingCollater`): they are not sorted by length but
+    shuffled, and batched by their total length (see
+    :func:`pack_token_batches`), which is also the cost of a batch.
+
+    The batches of an epoch are built on first use after `set_epoch`, and
+    `stats` reports their padding waste and the balance across ranks.
+    """
+
+    def __init__(
+        self,
+        sample_lengths: Iterable,
+        max_tokens: int,
+        max_batch: int,
+        max_square_tokens=np.inf,
+        max_len: int = 512,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        shuffle: bool = True,
+        length_noise: float = 0.1,
+        drop_last: bool = False,
+        seed: int = 0,
+        epoch: int = 0,
+        packed: bool = False,
+    ):
+        if num_replicas is None or rank is None:
+            if dist.is_available() and dist.is_initialized():
+                num_replicas = dist.get_world_size()
+                rank = dist.get_rank()
+            else:
+                num_replicas, rank = 1, 0
+        self.sample_lengths = np.minimum(
+            np.asarray(sample_lengths, dtype=np.int64), max_len
+        )
+        self.max_tokens = max_tokens
+        self.max_batch = max_batch
+        self.max_square_tokens = max_square_tokens
+        self.max_len = max_len
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.length_noise = length_noise
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = epoch
+        self.packed = packed
+
+        self.batches: Optional[List[np.ndarray]] = None
+        self.stats = {}
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.batches = None
+
+    def _build_batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        lengths = self.sample_lengths
+        if self.packed:
+            order = (
+                rng.permutation(len(lengths))
+                if self.shuffle
+                else np.arange(len(lengths))
+            )
+        elif self.shuffle:
+            noise = 1 + rng.uniform(
+                -self.length_noise, self.length_noise, size=len(lengths)
+            )
+            order = np.argsort(lengths * noise, kind="stable")
+        else:
+            order = np.argsort(lengths, kind="stable")
+        if self.packed:
+            bounds, too_long = pack_token_batches(
+                lengths[order], self.max_tokens, self.max_batch
+            )
+        else:
+            bounds, too_long = pack_batches(
+                lengths[order],
+                self.max_tokens,
+                self.max_batch,
+                self.max_square_tokens,
+            )
+        sizes = np.diff(bounds)
+        keep = ~too_long[bounds[:-1]]
+        starts, sizes = bounds[:-1][keep], sizes[keep]
+        longest = np.maximum.reduceat(lengths[order], bounds[:-1])[keep]
+        real_tokens = np.add.reduceat(lengths[order], bounds[:-1])[keep]
+        padded_tokens = real_tokens if self.packed else sizes * longest
+        if self.packed:
+            costs = real_tokens
+        elif np.isfinite(self.max_square_tokens):
+            costs = sizes * longest**2
+        else:
+            costs = padded_tokens
+
+        # equal counts of batches per rank, balanced by cost
+        num_batches = len(starts)
+        world = self.num_replicas
+        if self.drop_last:
+            num_rounds = num_batches // world
+        else:
+            num_rounds = math.ceil(num_batches / world)
+        by_cost = np.argsort(-costs, kind="stable")
+        num_pad = num_rounds * world - num_batches
+        if num_pad > 0:
+            cheapest = np.resize(by_cost[::-1], num_pad)
+            by_cost = np.concatenate([by_cost, cheapest])
+        by_cost = by_cost[: num_rounds * world]
+        loads = [(0, r) for r in range(world)]
+        assigned = [[] for _ in range(world)]
+        for round_batches in by_cost.reshape(num_rounds, world):
+            # the least loaded ranks take the most expensive batches
+            ranks = [heapq.heappop(loads) for _ in range(world)]
+            for (load, r), b in zip(ranks, round_batches):
+                assigned[r].append(b)
+                heapq.heappush(loads, (load + costs[b], r))
+
+        mine = np.asarray(assigned[self.rank], dtype=np.int64)
+        if self.shuffle:
+            mine = rng.permutation(mine)
+        self.batches = [
+            order[starts[b] : starts[b] + sizes[b]].tolist() for b in mine
+        ]
+
+        rank_costs = np.array([costs[a].sum() for a in assigned])
+        self.stats = {
+            "epoch": self.epoch,
+            "num_batches": len(self.batches),
+            "num_skipped": int(too_long.sum()),
+            "padding_waste": 1 - real_tokens.sum() / padded_tokens.sum(),
+            "mean_batch_size": float(sizes.mean()) if len(sizes) else 0.0,
+            "rank_cost_imbalance": (
+                float(rank_costs.max() / rank_costs.mean())
+                if rank_costs.mean() > 0
+                else 1.0
+            ),
+        }
+        if self.stats["num_skipped"] > 0:
+            log.warning(
+                f"Skipped {self.stats['num_skipped']} samples that exceed "
+                f"the token budgets by themselves."
+            )
+        log.info(
+            f"Built {num_batches} batches for epoch {self.epoch} "
+            f"({len(self.batches)} on rank {self.rank}), padding waste "
+            f"{self.stats['padding_waste']:.2%}, rank cost imbalance "
+            f"{self.stats['rank_cost_imbalance']:.3f}."
+        )
+        return self.batches
+
+    def __len__(self):
+        if self.batches is None:
+            self._build_batches()
+        return len(self.batches)
+
+    def __iter__(self):
+        if self.batches is None:
+            self._build_batches()
+        yield from self.batches
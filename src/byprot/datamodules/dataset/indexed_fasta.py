@@ -0,0 +1,251 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+
+import array
+import json
+import mmap
+import os
+
+import numpy as np
+from torch.utils.data import Dataset
+
+from byprot import utils
+
+log = utils.get_logger(__name__)
+
+INDEX_SUFFIX = ".idx"
+INDEX_ARRAYS = ["offsets", "lengths", "line_bases", "line_bytes"]
+
+
+def _fasta_version(fasta_path):
+    # an index is outdated once the FASTA file is modified
+    stat = os.stat(fasta_path)
+    return {"fasta_size": stat.st_size, "fasta_mtime_ns": stat.st_mtime_ns}
+
+
+def _save_index(index_path, index, fasta_path):
+    # one .npy per array, to be memory-mapped, and the version of the
+    # FASTA file last, once the arrays are complete
+    os.makedirs(index_path, exist_ok=True)
+    for name in INDEX_ARRAYS:
+        path = os.path.join(index_path, f"{name}.npy")
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, np.asarray(index[name], dtype=np.int64))
+        os.replace(path + ".tmp", path)
+    meta_path = os.path.join(index_path, "meta.json")
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump(_fasta_version(fasta_path), f)
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+def _open_index(index_path):
+    # memory-mapped, i.e., shared by the processes through the page cache
+    return {
+        name: np.load(os.path.join(index_path, f"{name}.npy"), mmap_mode="r")
+        for name in INDEX_ARRAYS
+    }
+
+
+def build_fasta_index(fasta_path, index_path=None):
+    """Index the records of `fasta_path` in one pass, as in `samtools faidx`:
+    the byte offset of the sequence of each record, its number of residues,
+    and its line layout (residues / bytes per line, which must be the same
+    for all lines of a record but the last). Saved to the directory
+    `index_path` (default: `<fasta_path>.idx`), one `.npy` per array, and
+    returned as a dict of memory-mapped arrays."""
+    index_path = index_path or fasta_path + INDEX_SUFFIX
+    offsets, lengths = array.array("q"), array.array("q")
+    line_bases, line_bytes = array.array("q"), array.array("q")
+    record = None  # [offset, length, line_bases, line_bytes, last_bases]
+
+    def finish(record):
+        offsets.append(record[0])
+        lengths.append(record[1])
+        line_bases.append(record[2])
+        line_bytes.append(record[3])
+
+    position = 0
+    with open(fasta_path, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                if record is not None:
+                    finish(record)
+                record = [position + len(line), 0, 0, 0, None]
+            elif record is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if bases > 0:
+                    # all lines but the last are as long as the first, and
+                    # the last is not longer
+                    if record[4] is not None and (
+                        record[4] != record[2] or bases > record[2]
+                    ):
+                        raise ValueError(
+                            f"Record {len(offsets)} of {fasta_path} has "
+                            f"lines of different lengths."
+                        )
+                    if record[4] is None:
+                        record[2], record[3] = bases, len(line)
+                    record[1] += bases
+                    record[4] = bases
+            position += len(line)
+    if record is not None:
+        finish(record)
+
+    index = {
+        "offsets": offsets,
+        "lengths": lengths,
+        "line_bases": line_bases,
+        "line_bytes": line_bytes,
+    }
+    _save_index(index_path, index, fasta_path)
+    log.info(f"Indexed {len(offsets)} records of {fasta_path}.")
+    return _open_index(index_path)
+
+
+def _is_fai_current(fasta_path):
+    # as samtools, a .fai older than the FASTA file is outdated
+    fai_path = fasta_path + ".fai"
+    if not os.path.exists(fai_path):
+        return False
+    if os.stat(fai_path).st_mtime_ns < os.stat(fasta_path).st_mtime_ns:
+        log.warning(f"{fai_path} is outdated, re-indexing {fasta_path}.")
+        return False
+    return True
+
+
+def load_fasta_index(fasta_path, index_path=None):
+    """The index of `fasta_path`, as memory-mapped arrays: reused from
+    `index_path` (default: `<fasta_path>.idx`) if up to date, i.e., of the
+    same size and modification time of the FASTA file, or converted from
+    a `samtools faidx` index (`<fasta_path>.fai`) not older than the FASTA
+    file, otherwise built once."""
+    index_path = index_path or fasta_path + INDEX_SUFFIX
+    meta_path = os.path.join(index_path, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == _fasta_version(fasta_path):
+                return _open_index(index_path)
+        log.warning(f"{index_path} is outdated, re-indexing {fasta_path}.")
+    elif _is_fai_current(fasta_path):
+        fai = np.loadtxt(
+            fasta_path + ".fai",
+            dtype=np.int64,
+            usecols=(1, 2, 3, 4),
+            delimiter="\t",
+            ndmin=2,
+        )
+        index = {
+            "offsets": fai[:, 1],
+            "lengths": fai[:, 0],
+            "line_bases": fai[:, 2],
+            "line_bytes": fai[:, 3],
+        }
+        _save_index(index_path, index, fasta_path)
+        return _open_index(index_path)
+    return build_fasta_index(fasta_path, index_path)
+
+
+class IndexedFasta(object):
+    """Random access to the records of an indexed FASTA file.
+
+    The file is memory-mapped on first access in each process (e.g., each
+    DataLoader worker), so that workers share the page cache instead of
+    copying the dataset, and only the bytes of the requested residues are
+    read and decoded. So is the index, if not given, see
+    `load_fasta_index`.
+    """
+
+    def __init__(self, fasta_path, index=None):
+        self.fasta_path = fasta_path
+        # the memory-mapped index is reopened rather than pickled
+        self._index_path = None
+        if index is None:
+            index = load_fasta_index(fasta_path)
+            self._index_path = fasta_path + INDEX_SUFFIX
+        self._set_index(index)
+        self._mmap = None
+
+    def _set_index(self, index):
+        self.offsets = index["offsets"]
+        self.lengths = index["lengths"]
+        self.line_bases = index["line_bases"]
+        self.line_bytes = index["line_bytes"]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_mmap"] = None
+        if self._index_path is not None:
+            for name in INDEX_ARRAYS:
+                del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._index_path is not None:
+            self._set_index(_open_index(self._index_path))
+
+    def _open(self):
+        if self._mmap is None:
+            with open(self.fasta_path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _byte_offset(self, idx, pos):
+        line_bases = max(int(self.line_bases[idx]), 1)
+        return (
+            int(self.offsets[idx])
+            + pos // line_bases * int(self.line_bytes[idx])
+            + pos % line_bases
+        )
+
+    def get(self, idx, start=0, stop=None):
+        """Residues `start:stop` of record `idx`."""
+        length = int(self.lengths[idx])
+        stop = length if stop is None else min(stop, length)
+        if stop <= start:
+            return ""
+        data = self._open()[
+            self._byte_offset(idx, start) : self._byte_offset(idx, stop - 1)
+            + 1
+        ]
+        if self.lengths[idx] > self.line_bases[idx]:
+            # the line breaks within multi-line records
+            data = data.replace(b"\n", b"").replace(b"\r", b"")
+        return data.decode("ascii")
+
+
+class IndexedFastaDataset(Dataset):
+    """Sequences of an indexed FASTA file, see :class:`IndexedFasta`,
+    optionally restricted to the records at `indices`. Sequences longer
+    than `max_len` are randomly cropped, reading only the cropped bytes."""
+
+    def __init__(self, fasta_path, indices=None, max_len=2048, index=None):
+        self.fasta = IndexedFasta(fasta_path, index=index)
+        self.indices = (
+            np.arange(len(self.fasta))
+            if indices is None
+            else np.asarray(indices, dtype=np.int64)
+        )
+        self.max_len = max_len
+        log.info(f"Dataset size: {len(self.indices)}")
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get_metadata_lens(self):
+        return self.fasta.lengths[self.indices]
+
+    def __getitem__(self, idx):
+        idx = self.indices[idx]
+        length = int(self.fasta.lengths[idx])
+        if length - self.max_len > 0:
+            start = np.random.choice(length - self.max_len)
+            stop = start + self.max_len
+        else:
+            start = 0
+            stop = length
+        return self.fasta.get(idx, start, stop)
@@ -14,6 +14,7 @@ from transformers import EsmTokenizer, PreTrainedTokenizer
 from transformers.tokenization_utils_base import AddedToken
 
 from byprot import utils
+from byprot.datamodules.dataset.batch_sampler import TokenBudgetBatchSampler
 
 log = utils.get_logger(__name__)
 T_co = TypeVar("T_co", covariant=True)
@@ -622,18 +623,18 @@ def setup_dataloader(
     max_len=512,
     tokenizer=None,
     epoch=0,
+    collater=None,
 ) -> DataLoader:
-    collater = DPLM2Collater(tokenizer)
+    if collater is None:
+        collater = DPLM2Collater(tokenizer)
     lens = ds.get_metadata_lens()
-    train_sortish_sampler = SortishSampler(
-        lens, bucket_size, num_replicas=world_size, rank=rank, epoch=epoch
-    )
-    train_sampler = ApproxBatchSampler(
-        train_sortish_sampler,
+    # rebuilt for every epoch, see TokenBudgetBatchSampler.set_epoch
+    train_sampler = TokenBudgetBatchSampler(
+        lens,
         max_tokens,
         max_batch_size,
-        lens,
         max_len=max_len,
+        epoch=epoch,
     )
     dl = DataLoader(
         dataset=ds,
@@ -0,0 +1,304 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from byprot import utils
+from byprot.datamodules.dataset.tokenized_protein import (
+    TokenizedProteinDataset,
+)
+
+log = utils.get_logger(__name__)
+
+SHARD_VERSION = 1
+TOKEN_DTYPE = np.int16
+
+
+def _token_lut(tokenizer):
+    """Lookup tables from amino acid bytes and structure codes to the token
+    ids of `tokenizer`, unknown ones mapped to the unk tokens."""
+    vocab = tokenizer.get_vocab()
+    aa_unk = vocab[tokenizer.aa_unk_token]
+    aa_lut = np.full(256, aa_unk, dtype=TOKEN_DTYPE)
+    for token, idx in vocab.items():
+        if len(token) == 1:
+            aa_lut[ord(token)] = idx
+
+    struct_unk = vocab[tokenizer.struct_unk_token]
+    struct_codes = [
+        int(token) for token in vocab if token.isdigit() and len(token) == 4
+    ]
+    struct_lut = np.full(max(struct_codes) + 1, struct_unk, TOKEN_DTYPE)
+    for code in struct_codes:
+        struct_lut[code] = vocab[f"{code:04d}"]
+    return aa_lut, struct_lut
+
+
+def _fixed_width(strings):
+    """Strings as a fixed-width bytes array, which can be memory-mapped."""
+    encoded = [str(s).encode() for s in strings]
+    width = max([len(s) for s in encoded] + [1])
+    return np.array(encoded, dtype=f"S{width}")
+
+
+def write_tokenized_shards(data, save_dir, tokenizer):
+    """Tokenize a dataset of `aa_seq` and comma-separated `struct_seq`
+    (e.g., `TokenizedProteinDataset.data`) once, into `save_dir`:
+
+    - `aa_tokens.npy` / `struct_tokens.npy`: the token ids of all entries
+      concatenated, without special tokens.
+    - `offsets.npy`: the start of each entry in the above, plus the end.
+    - `pdb_name.npy` / `cluster.npy`: the metadata columns, if present.
+    - `meta.json`: the vocabulary the ids refer to.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    aa_lut, struct_lut = _token_lut(tokenizer)
+    lengths = np.array([len(seq) for seq in data["aa_seq"]], dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    open_memmap = np.lib.format.open_memmap
+    tokens = {
+        key: open_memmap(
+            os.path.join(save_dir, f"{key}.npy"),
+            mode="w+",
+            dtype=TOKEN_DTYPE,
+            shape=(int(offsets[-1]),),
+        )
+        for key in ["aa_tokens", "struct_tokens"]
+    }
+    for idx, row in enumerate(
+        tqdm(data, total=len(lengths), desc="Tokenizing")
+    ):
+        start, end = offsets[idx], offsets[idx + 1]
+        aa_seq = np.frombuffer(row["aa_seq"].encode(), dtype=np.uint8)
+        struct_seq = np.array(row["struct_seq"].split(","), dtype=np.int64)
+        if len(struct_seq) != len(aa_seq):
+            raise ValueError(
+                f"Entry {idx} has {len(aa_seq)} residues but "
+                f"{len(struct_seq)} structure tokens."
+            )
+        tokens["aa_tokens"][start:end] = aa_lut[aa_seq]
+        tokens["struct_tokens"][start:end] = struct_lut[struct_seq]
+    for array in tokens.values():
+        array.flush()
+    np.save(os.path.join(save_dir, "offsets.npy"), offsets)
+
+    for column in ["pdb_name", "cluster"]:
+        if column in data.column_names:
+            np.save(
+                os.path.join(save_dir, f"{column}.npy"),
+                _fixed_width(data[column]),
+            )
+    with open(os.path.join(save_dir, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": SHARD_VERSION,
+                "num_entries": len(lengths),
+                "num_tokens": int(offsets[-1]),
+                "vocab_size": len(tokenizer),
+                "name_or_path": tokenizer.name_or_path,
+            },
+            f,
+            indent=2,
+        )
+    log.info(
+        f"Saved {len(lengths)} tokenized entries "
+        f"({offsets[-1]} residues) to {save_dir}."
+    )
+
+
+class TokenizedShardDataset(Dataset):
+    """Dataset of the token ids written by :func:`write_tokenized_shards`.
+
+    The arrays are memory-mapped (in each DataLoader worker, on first
+    access), so that samples are zero-copy slices and the memory of the
+    workers does not grow with the size of the dataset. Entries longer than
+    `max_len` are randomly cropped, with the same crop for both modalities.
+
+    `indices` selects a subset of the entries, e.g., one per cluster, and
+    `crop_lengths` overrides the length of each selected entry, e.g., for
+    length cropping, without touching the arrays on disk.
+    """
+
+    def __init__(
+        self, data_dir, max_len=2048, indices=None, crop_lengths=None
+    ):
+        self.data_dir = data_dir
+        self.max_len = max_len
+        with open(os.path.join(data_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != SHARD_VERSION:
+            raise ValueError(
+                f"Unsupported tokenized shards version {self.meta['version']}"
+                f" in {data_dir}, please re-run the conversion."
+            )
+        offsets = np.load(os.path.join(data_dir, "offsets.npy"))
+        self.lengths = np.diff(offsets)
+        self.indices = (
+            np.arange(len(self.lengths))
+            if indices is None
+            else np.asarray(indices, dtype=np.int64)
+        )
+        self.crop_lengths = (
+            None if crop_lengths is None else np.asarray(crop_lengths)
+        )
+        self._arrays = None
+
+    def _open(self):
+        if self._arrays is None:
+            arrays = {}
+            for key in [
+                "aa_tokens",
+                "struct_tokens",
+                "offsets",
+                "pdb_name",
+                "cluster",
+            ]:
+                path = os.path.join(self.data_dir, f"{key}.npy")
+                if os.path.exists(path):
+                    arrays[key] = np.load(path, mmap_mode="r")
+            self._arrays = arrays
+        return self._arrays
+
+    def __getstate__(self):
+        # memory maps are re-opened by each worker instead of pickled
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get_metadata_lens(self):
+        if self.crop_lengths is not None:
+            return self.crop_lengths
+        return self.lengths[self.indices]
+
+    def get_clusters(self):
+        return np.load(os.path.join(self.data_dir, "cluster.npy"))[
+            self.indices
+        ]
+
+    def select(self, indices=None, crop_lengths=None):
+        """A view of the entries at `indices` of this dataset."""
+        indices = self.indices if indices is None else self.indices[indices]
+        return TokenizedShardDataset(
+            self.data_dir,
+            max_len=self.max_len,
+            indices=indices,
+            crop_lengths=crop_lengths,
+        )
+
+    def __getitem__(self, idx):
+        arrays = self._open()
+        entry = self.indices[int(idx)]
+        start, end = arrays["offsets"][entry], arrays["offsets"][entry + 1]
+        length = end - start
+        max_len = self.max_len
+        if self.crop_lengths is not None:
+            max_len = min(max_len, int(self.crop_lengths[int(idx)]))
+        if length > max_len:
+            start = start + np.random.choice(length - max_len)
+            end = start + max_len
+
+        return_dict = {
+            "struct_tokens": arrays["struct_tokens"][start:end],
+            "aatype_tokens": arrays["aa_tokens"][start:end],
+            "length": end - start + 2,
+        }
+        if "pdb_name" in arrays:
+            return_dict["pdb_name"] = arrays["pdb_name"][entry].decode()
+        return return_dict
+
+
+class DPLM2ShardCollater(object):
+    """Collater of :class:`TokenizedShardDataset`, with the same outputs as
+    `DPLM2Collater`: the token ids are copied into padded arrays between
+    the cls and eos tokens of each modality, without re-tokenization."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        vocab = tokenizer.get_vocab()
+        self.pad_id = tokenizer.pad_token_id
+        self.special_ids = {
+            "aatype_tokens": (
+                vocab[tokenizer.aa_cls_token],
+                vocab[tokenizer.aa_eos_token],
+            ),
+            "struct_tokens": (
+                vocab[tokenizer.struct_cls_token],
+                vocab[tokenizer.struct_eos_token],
+            ),
+        }
+
+    def __call__(self, raw_batch):
+        lengths = np.array([len(s["aatype_tokens"]) for s in raw_batch])
+        batch_size, max_len = len(raw_batch), lengths.max() + 2
+        attention_mask = torch.from_numpy(
+            np.arange(max_len)[None] < (lengths[:, None] + 2)
+        )
+
+        batch = {}
+        for key, (cls_id, eos_id) in self.special_ids.items():
+            tokens = np.full((batch_size, max_len), self.pad_id, TOKEN_DTYPE)
+            tokens[:, 0] = cls_id
+            for i, sample in enumerate(raw_batch):
+                tokens[i, 1 : lengths[i] + 1] = sample[key]
+                tokens[i, lengths[i] + 1] = eos_id
+            batch[key] = {
+                "targets": torch.from_numpy(tokens).long(),
+                "attention_mask": attention_mask,
+            }
+
+        if "pdb_name" in raw_batch[0]:
+            batch["pdb_name"] = [sample["pdb_name"] for sample in raw_batch]
+        return batch
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a tokenized protein dataset (aa_seq and "
+        "struct_seq columns) to memory-mapped token id arrays."
+    )
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--csv_file", type=str, default="pdb_swissprot")
+    parser.add_argument(
+        "--vocab_file", type=str, default="airkingbd/dplm2_650m"
+    )
+    parser.add_argument(
+        "--splits", nargs="*", type=str, default=["train", "valid"]
+    )
+    parser.add_argument(
+        "--save_dir",
+        type=str,
+        default=None,
+        help="default: <data_dir>/<csv_file>_shards",
+    )
+    args = parser.parse_args()
+
+    save_dir = args.save_dir or os.path.join(
+        args.data_dir, f"{args.csv_file}_shards"
+    )
+    for split in args.splits:
+        dataset = TokenizedProteinDataset(
+            data_dir=args.data_dir,
+            split=split,
+            csv_file=args.csv_file,
+            vocab_file=args.vocab_file,
+        )
+        write_tokenized_shards(
+            dataset.data, os.path.join(save_dir, split), dataset.tokenizer
+        )
+
+
+if __name__ == "__main__":
+    main()
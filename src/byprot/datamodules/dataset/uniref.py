@@ -23,6 +23,8 @@ from torch.utils.data import BatchSampler, DataLoader, Dataset, Sampler
 from transformers import EsmTokenizer
 
 from byprot import utils
+from byprot.datamodules.dataset.batch_sampler import TokenBudgetBatchSampler
+from byprot.datamodules.dataset.indexed_fasta import IndexedFastaDataset
 
 log = utils.get_logger(__name__)
 
@@ -181,13 +183,17 @@ class ApproxBatchSampler(BatchSampler):
             yield batch
 
 
-class UniRefDataset(Dataset):
+class UniRefDataset(IndexedFastaDataset):
     """Dataset that pulls from UniRef/Uniclust downloads.
 
     The data folder should contain the following:
-    - 'consensus.fasta': consensus sequences, no line breaks in sequences
+    - 'consensus.fasta': consensus sequences
     - 'splits.json': a dict with keys 'train', 'valid', and 'test' mapping to lists of indices
-    - 'lengths_and_offsets.npz': byte offsets for the 'consensus.fasta' and sequence lengths
+    - 'lengths_and_offsets.npz' (optional): byte offsets for the 'consensus.fasta' and sequence lengths,
+      for sequences without line breaks. Otherwise, 'consensus.fasta' is indexed once, see `load_fasta_index`.
+
+    The fasta file is memory-mapped and only the (cropped) sequence of a
+    sample is read, see `IndexedFastaDataset`.
     """
 
     def __init__(
@@ -198,36 +204,23 @@ class UniRefDataset(Dataset):
     ):
         self.data_dir = data_dir
         self.split = split
-        metadata = np.load(
-            os.path.join(self.data_dir, "lengths_and_offsets.npz")
-        )
-        self.offsets = metadata["seq_offsets"]
+        fasta_path = os.path.join(self.data_dir, "consensus.fasta")
+        metadata_path = os.path.join(self.data_dir, "lengths_and_offsets.npz")
+        index = None
+        if os.path.exists(metadata_path):
+            metadata = np.load(metadata_path)
+            lengths = metadata["ells"]
+            index = {
+                "offsets": metadata["seq_offsets"],
+                "lengths": lengths,
+                "line_bases": lengths,
+                "line_bytes": lengths + 1,
+            }
         with open(os.path.join(data_dir, "splits.json"), "r") as f:
-            self.indices = json.load(f)[self.split]
-        log.info(f"Dataset size: {len(self.indices)}")
-        self.metadata_lens = metadata["ells"][self.indices]
-        self.max_len = max_len
-
-    def __len__(self):
-        return len(self.indices)
-
-    def get_metadata_lens(self):
-        return self.metadata_lens
-
-    def __getitem__(self, idx):
-        idx = self.indices[idx]
-        offset = self.offsets[idx]
-        with open(os.path.join(self.data_dir, "consensus.fasta")) as f:
-            f.seek(offset)
-            consensus = f.readline()[:-1]
-        if len(consensus) - self.max_len > 0:
-            start = np.random.choice(len(consensus) - self.max_len)
-            stop = start + self.max_len
-        else:
-            start = 0
-            stop = len(consensus)
-        consensus = consensus[start:stop]
-        return consensus
+            indices = json.load(f)[self.split]
+        super().__init__(
+            fasta_path, indices=indices, max_len=max_len, index=index
+        )
 
 
 class Subset(Dataset[T_co]):
@@ -308,14 +301,11 @@ def setup_dataloader(
         )
     else:
         lens = ds.get_metadata_lens()
-        train_sortish_sampler = SortishSampler(
-            lens, bucket_size, num_replicas=world_size, rank=rank
-        )
-        train_sampler = ApproxBatchSampler(
-            train_sortish_sampler,
+        # rebuilt for every epoch, see TokenBudgetBatchSampler.set_epoch
+        train_sampler = TokenBudgetBatchSampler(
+            lens,
             max_tokens,
             max_batch_size,
-            lens,
             max_len=max_len,
         )
         dl = DataLoader(
@@ -12,6 +12,10 @@ from torch.utils.data import BatchSampler, DataLoader, Dataset, Sampler
 from transformers import EsmTokenizer
 
 from byprot import utils
+from byprot.datamodules.dataset.batch_sampler import (
+    TokenBudgetBatchSampler,
+    first_fit_rows,
+)
 
 log = utils.get_logger(__name__)
 
@@ -171,12 +175,11 @@ class ApproxBatchSampler(BatchSampler):
 
 
 class UniRefHFDataset(Dataset):
-    """Dataset that pulls from UniRef/Uniclust downloads.
+    """Dataset of UniRef sequences from a huggingface dataset in
+    `data_dir`, with a `seq` and a `length` column for each split.
 
-    The data folder should contain the following:
-    - 'consensus.fasta': consensus sequences, no line breaks in sequences
-    - 'splits.json': a dict with keys 'train', 'valid', and 'test' mapping to lists of indices
-    - 'lengths_and_offsets.npz': byte offsets for the 'consensus.fasta' and sequence lengths
+    The whole split is loaded by every process, for the full UniRef50 use
+    the memory-mapped fasta of `UniRefDataset` (datamodule `uniref50`).
     """
 
     def __init__(
@@ -297,6 +300,49 @@ class DPLMCollater(object):
         return batch
 
 
+class DPLMPackingCollater(DPLMCollater):
+    """Packs the sequences of a batch, with <cls>/<eos>, into rows of at
+    most `pack_len` tokens (first-fit decreasing) instead of padding each
+    to the longest one. Rows are right-padded to the fullest row.
+
+    `segment_ids` numbers the sequences of each row from 1 (0 for pads),
+    from which `EsmForDPLM` builds block-diagonal attention and rotary
+    positions restarting at every sequence, and `DPLM.compute_loss` draws
+    the timesteps of every sequence.
+    """
+
+    def __init__(self, tokenizer_path=None, pack_len=1024):
+        super().__init__(tokenizer_path)
+        self.pack_len = pack_len
+
+    def __call__(self, sequences):
+        encoded = self.alphabet(list(sequences), add_special_tokens=True)[
+            "input_ids"
+        ]
+        lengths = [len(ids) for ids in encoded]
+        rows = first_fit_rows(lengths, self.pack_len)
+        width = max(sum(lengths[i] for i in row) for row in rows)
+
+        input_ids = torch.full(
+            (len(rows), width), self.alphabet.pad_token_id, dtype=torch.long
+        )
+        segment_ids = torch.zeros((len(rows), width), dtype=torch.long)
+        for r, row in enumerate(rows):
+            offset = 0
+            for segment, i in enumerate(row, 1):
+                end = offset + lengths[i]
+                input_ids[r, offset:end] = torch.tensor(encoded[i])
+                segment_ids[r, offset:end] = segment
+                offset = end
+
+        return {
+            "input_ids": input_ids,
+            "input_mask": segment_ids > 0,
+            "targets": input_ids.clone(),
+            "segment_ids": segment_ids,
+        }
+
+
 def setup_dataloader(
     ds: UniRefHFDataset,
     max_tokens=6000,
@@ -306,18 +352,23 @@ def setup_dataloader(
     rank=0,
     world_size=1,
     max_len=512,
+    pack_sequences=False,
 ) -> DataLoader:
-    collater = DPLMCollater()
+    """With `pack_sequences`, batches of `max_tokens` residues in total
+    are packed into rows of `max_len + 2` tokens (see
+    `DPLMPackingCollater`), otherwise padded."""
+    if pack_sequences:
+        collater = DPLMPackingCollater(pack_len=max_len + 2)
+    else:
+        collater = DPLMCollater()
     lens = ds.get_metadata_lens()
-    train_sortish_sampler = SortishSampler(
-        lens, bucket_size, num_replicas=world_size, rank=rank
-    )
-    train_sampler = ApproxBatchSampler(
-        train_sortish_sampler,
+    # rebuilt for every epoch, see TokenBudgetBatchSampler.set_epoch
+    train_sampler = TokenBudgetBatchSampler(
+        lens,
         max_tokens,
         max_batch_size,
-        lens,
         max_len=max_len,
+        packed=pack_sequences,
     )
     dl = DataLoader(
         dataset=ds,
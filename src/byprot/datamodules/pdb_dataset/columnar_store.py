@@ -0,0 +1,244 @@
+# Copyright (c) 2025 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+"""Columnar, memory-mapped store of processed PDB chains.
+
+Converts the metadata CSV and the per-chain pickles written by
+`du.process_pdb_file` / `du.process_mmcif` once, e.g.,
+
+    python -m byprot.datamodules.pdb_dataset.columnar_store \
+        --csv_path <data_dir>/metadata.csv --store_dir <data_dir>/store
+
+after which `PdbDataset` reads chains from the store with
+`dataset.store_dir`, without opening or unpickling a file per sample.
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from byprot import utils
+from byprot.datamodules.pdb_dataset import utils as du
+
+log = utils.get_logger(__name__)
+
+STORE_VERSION = 1
+INDEX_FILE = "index.npz"
+
+# per-residue columns of the pickles, and their (compact) dtypes on disk
+COLUMNS = {
+    "atom_positions": np.float32,
+    "atom_mask": np.uint8,
+    "aatype": np.int8,
+    "residue_index": np.int32,
+    "chain_index": np.int16,
+    "b_factors": np.float32,
+}
+
+
+def _read_chain(args):
+    key, path = args
+    try:
+        feats = du.read_pkl(path, verbose=False)
+    except Exception as e:
+        return key, None, repr(e)
+    return (
+        key,
+        {k: np.asarray(feats[k], dtype=v) for k, v in COLUMNS.items()},
+        None,
+    )
+
+
+def _save_chunk(store_dir, chunk_idx, chains):
+    chunk_dir = os.path.join(store_dir, f"chunk_{chunk_idx:05d}")
+    os.makedirs(chunk_dir, exist_ok=True)
+    for column in COLUMNS:
+        np.save(
+            os.path.join(chunk_dir, f"{column}.npy"),
+            np.concatenate([chain[column] for chain in chains]),
+        )
+
+
+def write_columnar_store(
+    csv_path,
+    store_dir,
+    data_dir=None,
+    chunk_residues=4_000_000,
+    num_workers=8,
+):
+    """Write the chains of `csv_path` into `store_dir`, as chunks of about
+    `chunk_residues` residues:
+
+    - `chunk_<i>/<column>.npy`: the per-residue arrays of the chains of
+      chunk `i` concatenated, one file per column of `COLUMNS`.
+    - `index.npz`: per chain, its key (the `processed_path` of the CSV, as
+      written, i.e., before formatting `{data_dir}`), chunk, start and
+      length in its chunk.
+    - `meta.json`: the columns, their dtypes and the sizes of the store.
+
+    Chains whose pickle cannot be read are skipped with a warning.
+    """
+    csv = pd.read_csv(csv_path)
+    data_dir = data_dir or os.path.dirname(csv_path)
+    keys = list(dict.fromkeys(csv["processed_path"]))
+    tasks = [(key, key.format(data_dir=data_dir)) for key in keys]
+    os.makedirs(store_dir, exist_ok=True)
+
+    index = {"key": [], "chunk": [], "start": [], "length": []}
+    chains, chunk_len, num_chunks, failures = [], 0, 0, 0
+    with mp.Pool(num_workers) as pool:
+        for key, feats, error in tqdm(
+            pool.imap(_read_chain, tasks, chunksize=16),
+            total=len(tasks),
+            desc="Converting",
+        ):
+            if feats is None:
+                failures += 1
+                log.warning(f"Skipped {key}: {error}")
+                continue
+            length = len(feats["aatype"])
+            index["key"].append(key)
+            index["chunk"].append(num_chunks)
+            index["start"].append(chunk_len)
+            index["length"].append(length)
+            chains.append(feats)
+            chunk_len += length
+            if chunk_len >= chunk_residues:
+                _save_chunk(store_dir, num_chunks, chains)
+                chains, chunk_len, num_chunks = [], 0, num_chunks + 1
+    if chains:
+        _save_chunk(store_dir, num_chunks, chains)
+        num_chunks += 1
+
+    np.savez(
+        os.path.join(store_dir, INDEX_FILE),
+        key=np.array(index["key"], dtype=str),
+        chunk=np.asarray(index["chunk"], dtype=np.int32),
+        start=np.asarray(index["start"], dtype=np.int64),
+        length=np.asarray(index["length"], dtype=np.int64),
+    )
+    with open(os.path.join(store_dir, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": STORE_VERSION,
+                "columns": {k: np.dtype(v).name for k, v in COLUMNS.items()},
+                "num_chains": len(index["key"]),
+                "num_residues": int(sum(index["length"])),
+                "num_chunks": num_chunks,
+                "csv_path": os.path.abspath(csv_path),
+            },
+            f,
+            indent=2,
+        )
+    log.info(
+        f"Saved {len(index['key'])} chains in {num_chunks} chunks to "
+        f"{store_dir} ({failures} skipped)."
+    )
+
+
+class ColumnarPdbStore(object):
+    """Random access to the chains written by :func:`write_columnar_store`.
+
+    The chunks are memory-mapped on first access in each process (e.g.,
+    each DataLoader worker), so that workers share the page cache, and
+    :meth:`get` returns the features of a chain in the format of its
+    pickle. Positions and b-factors are zero-copy slices of the store
+    (read-only); the small integer columns and the atom mask, which
+    `du.parse_chain_feats` updates in place, are converted to the dtypes of
+    the pickles.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != STORE_VERSION:
+            raise ValueError(
+                f"Unsupported store version {self.meta['version']} in "
+                f"{store_dir}, please re-run the conversion."
+            )
+        index = np.load(os.path.join(store_dir, INDEX_FILE))
+        self.chunk = index["chunk"]
+        self.start = index["start"]
+        self.length = index["length"]
+        self._rows = {key: row for row, key in enumerate(index["key"])}
+        self._chunks = {}
+
+    def __getstate__(self):
+        # memory maps are re-opened by each worker instead of pickled
+        state = self.__dict__.copy()
+        state["_chunks"] = {}
+        return state
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def _open(self, chunk_idx):
+        if chunk_idx not in self._chunks:
+            chunk_dir = os.path.join(self.store_dir, f"chunk_{chunk_idx:05d}")
+            self._chunks[chunk_idx] = {
+                column: np.load(
+                    os.path.join(chunk_dir, f"{column}.npy"), mmap_mode="r"
+                )
+                for column in self.meta["columns"]
+            }
+        return self._chunks[chunk_idx]
+
+    def get(self, key):
+        """The features of chain `key` (its `processed_path` in the CSV), or
+        None if it is not in the store."""
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        arrays = self._open(int(self.chunk[row]))
+        start = int(self.start[row])
+        end = start + int(self.length[row])
+        feats = {
+            "atom_positions": arrays["atom_positions"][start:end],
+            "atom_mask": arrays["atom_mask"][start:end].astype(np.float32),
+            "b_factors": arrays["b_factors"][start:end],
+        }
+        for column in ["aatype", "residue_index", "chain_index"]:
+            feats[column] = arrays[column][start:end].astype(np.int64)
+        # as in du.process_pdb_file
+        feats["modeled_idx"] = np.where(feats["aatype"] != 20)[0]
+        return feats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert the processed PDB pickles of a metadata CSV to "
+        "a columnar, memory-mapped store."
+    )
+    parser.add_argument("--csv_path", type=str, required=True)
+    parser.add_argument("--store_dir", type=str, required=True)
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        default=None,
+        help="formats {data_dir} in processed_path, default: the directory "
+        "of csv_path",
+    )
+    parser.add_argument("--chunk_residues", type=int, default=4_000_000)
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    write_columnar_store(
+        args.csv_path,
+        args.store_dir,
+        data_dir=args.data_dir,
+        chunk_residues=args.chunk_residues,
+        num_workers=args.num_workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# Copyright (c) 2025 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+"""Node-local cache of processed PDB features shared by DataLoader
+workers."""
+
+import fcntl
+import hashlib
+import os
+import tempfile
+
+import torch
+
+from byprot import utils
+
+log = utils.get_logger(__name__)
+
+
+def default_cache_dir(name):
+    # tmpfs, i.e., shared memory, if available
+    root = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(root, f"byprot_feature_cache_{name}")
+
+
+class FeatureCache(object):
+    """Size-bounded (in bytes) LRU cache of feature dicts of tensors,
+    stored as files in `cache_dir` (by default in `/dev/shm`).
+
+    Entries are written once by whichever worker misses first, and loaded
+    memory-mapped by all workers of the node, so that an entry is held in
+    memory once rather than once per worker. Hits refresh the modification
+    time of an entry, and the least recently used entries are evicted once
+    the entries exceed `max_bytes` in total. If an entry cannot be written
+    (e.g., a full `/dev/shm`), it is simply not cached, and an entry that
+    cannot be loaded (e.g., truncated, or of another torch version) is
+    evicted and treated as a miss.
+
+    Keys must identify everything the features depend on (the input
+    files, the config and the code processing them), as entries persist
+    across runs.
+
+    The hits / misses / evictions of each process are logged every
+    `log_every` lookups.
+    """
+
+    def __init__(self, cache_dir, max_bytes, log_every=1000):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.log_every = log_every
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "failures": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}.pt")
+
+    def _count(self, event):
+        self.stats[event] += 1
+        num_lookups = self.stats["hits"] + self.stats["misses"]
+        if event in ("hits", "misses") and num_lookups % self.log_every == 0:
+            log.info(
+                f"Feature cache (pid {os.getpid()}): "
+                + ", ".join(f"{k} {v}" for k, v in self.stats.items())
+            )
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            try:
+                feats = torch.load(path, map_location="cpu", mmap=True)
+            except TypeError:
+                # torch < 2.1
+                feats = torch.load(path, map_location="cpu")
+            os.utime(path)
+        except FileNotFoundError:
+            # missing, or evicted concurrently
+            self._count("misses")
+            return None
+        except Exception as e:
+            # truncated or incompatible, rewritten on this miss
+            log.warning(f"Evicting unreadable cached features {path}: {e}")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._count("misses")
+            return None
+        self._count("hits")
+        return feats
+
+    def put(self, key, feats):
+        path = self._path(key)
+        # not the whole storages of sliced tensors
+        feats = {
+            k: v.clone() if torch.is_tensor(v) else v for k, v in feats.items()
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                torch.save(feats, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if self.stats["failures"] == 0:
+                log.warning(f"Failed to cache features in {path}: {e}")
+            self.stats["failures"] += 1
+            return
+        self._evict()
+
+    def _evict(self):
+        with open(os.path.join(self.cache_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".pt"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self._count("evictions")
@@ -0,0 +1,387 @@
+# Copyright (c) 2025 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+"""Parallel ingestion of raw PDB / mmCIF files into processed pickles and a
+metadata CSV, for `PdbDataset` (and `columnar_store`).
+
+Structures are streamed from directory trees or tarballs through a pool of
+processes, which parse and filter them with `du.process_pdb_file` /
+`du.process_mmcif`, e.g.,
+
+    python -m byprot.datamodules.pdb_dataset.ingest \
+        --inputs /data/pdb_mmcif /data/afdb_swissprot.tar \
+        --output_dir /data/processed_pdb --num_workers 64
+
+Pickles are written to `<output_dir>/<shard>/<pdb_name>.pkl`, with 256
+shards by the hash of the name, and one row per structure is appended to
+`<output_dir>/metadata.csv` as it completes, with `processed_path`
+relative to `{data_dir}` (i.e., `dataset.data_dir` of `PdbDataset`).
+Structures rejected by a filter or failing are appended to
+`<output_dir>/rejected.csv`. Re-running the same command skips the
+structures listed in either, so an interrupted run resumes where it
+stopped.
+
+Pickles are named by structure, so of the structures of the same name
+(e.g., `X.pdb.gz` and `X.cif.gz` of an AFDB tarball), the first one is
+processed and the others are rejected as duplicates. Predicted models
+(e.g., AFDB mmCIFs, which have no resolution) are not filtered by
+resolution, see `du.process_mmcif` and `--predicted`.
+"""
+
+import argparse
+import collections
+import csv
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from tqdm import tqdm
+
+from byprot import utils
+from byprot.datamodules.pdb_dataset import utils as du
+
+log = utils.get_logger(__name__)
+
+PDB_SUFFIXES = (".pdb", ".ent")
+MMCIF_SUFFIXES = (".cif",)
+METADATA_COLUMNS = [
+    "pdb_name",
+    "processed_path",
+    "raw_path",
+    "split",
+    "num_chains",
+    "seq_len",
+    "modeled_seq_len",
+    "quaternary_category",
+    "oligomeric_count",
+    "oligomeric_detail",
+    "resolution",
+    "structure_method",
+    "coil_percent",
+    "helix_percent",
+    "strand_percent",
+    "radius_gyration",
+]
+REJECTED_COLUMNS = ["raw_path", "status", "error"]
+
+
+def _structure_suffix(name):
+    """The format suffix of `name` (ignoring `.gz`), or None if it is not
+    a structure file."""
+    if name.endswith(".gz"):
+        name = name[: -len(".gz")]
+    for suffix in PDB_SUFFIXES + MMCIF_SUFFIXES:
+        if name.endswith(suffix):
+            return suffix
+    return None
+
+
+def _structure_name(name):
+    name = os.path.basename(name)
+    if name.endswith(".gz"):
+        name = name[: -len(".gz")]
+    return os.path.splitext(name)[0]
+
+
+def iter_structures(inputs, skip=()):
+    """Yield `(raw_path, path, data)` for the structure files under the
+    directories / tarballs / files of `inputs`, but those in `skip`.
+
+    Files on disk are passed by `path`, and tarball members are read into
+    `data` (their `raw_path` is `<tarball>:<member>`), one at a time.
+    """
+    for source in inputs:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    if _structure_suffix(name) and path not in skip:
+                        yield path, path, None
+        elif tarfile.is_tarfile(source):
+            # streamed, without random access to the members
+            with tarfile.open(source, mode="r|*") as tar:
+                for member in tar:
+                    raw_path = f"{source}:{member.name}"
+                    if (
+                        not member.isfile()
+                        or not _structure_suffix(member.name)
+                        or raw_path in skip
+                    ):
+                        continue
+                    yield raw_path, None, tar.extractfile(member).read()
+        elif _structure_suffix(source) and source not in skip:
+            yield source, source, None
+
+
+def _process_structure(raw_path, path, data, output_dir, cfg):
+    """Parse, filter and save one structure, in a worker process."""
+    name = _structure_name(raw_path)
+    suffix = _structure_suffix(raw_path)
+    tmp_dir = None
+    try:
+        if data is not None or raw_path.endswith(".gz"):
+            # the parsers read uncompressed files from disk
+            tmp_dir = tempfile.mkdtemp()
+            tmp_path = os.path.join(tmp_dir, name + suffix)
+            if data is None:
+                with gzip.open(path, "rb") as f_in:
+                    with open(tmp_path, "wb") as f_out:
+                        shutil.copyfileobj(f_in, f_out)
+            else:
+                if raw_path.endswith(".gz"):
+                    data = gzip.decompress(data)
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+            path = tmp_path
+
+        if suffix in MMCIF_SUFFIXES:
+            complex_feats, metadata = du.process_mmcif(
+                path,
+                max_resolution=cfg["max_resolution"],
+                max_len=cfg["max_len"],
+                predicted=cfg["predicted"],
+            )
+        else:
+            complex_feats, metadata = du.process_pdb_file(path)
+            if metadata["seq_len"] > cfg["max_len"]:
+                raise du.LengthError(f"Too long {metadata['seq_len']}")
+        if metadata["modeled_seq_len"] < cfg["min_len"]:
+            raise du.LengthError(f"Too short {metadata['modeled_seq_len']}")
+    except du.DataError as e:
+        return raw_path, None, {"status": "filtered", "error": repr(e)}
+    except Exception as e:
+        return raw_path, None, {"status": "failed", "error": repr(e)}
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    shard = hashlib.md5(name.encode()).hexdigest()[:2]
+    relative_path = os.path.join(shard, f"{name}.pkl")
+    du.write_pkl(
+        os.path.join(output_dir, relative_path),
+        complex_feats,
+        create_dir=True,
+    )
+    metadata["pdb_name"] = name
+    metadata["raw_path"] = raw_path
+    metadata["split"] = cfg["split"]
+    metadata["processed_path"] = os.path.join("{data_dir}", relative_path)
+    return raw_path, metadata, None
+
+
+def _read_done(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, newline="") as f:
+        return {row["raw_path"] for row in csv.DictReader(f) if row}
+
+
+def _read_names(path):
+    # the raw paths of the pickles written before, by name
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline="") as f:
+        return {
+            row["pdb_name"]: row["raw_path"]
+            for row in csv.DictReader(f)
+            if row
+        }
+
+
+class _CsvAppender(object):
+    """Rows appended to a CSV file, flushed one by one."""
+
+    def __init__(self, path, columns):
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, "a", newline="")
+        self.writer = csv.DictWriter(
+            self.file, fieldnames=columns, extrasaction="ignore"
+        )
+        if not exists:
+            self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(row)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def ingest(
+    inputs,
+    output_dir,
+    num_workers=8,
+    max_resolution=5.0,
+    max_len=1024,
+    min_len=0,
+    split=None,
+    max_pending=None,
+    predicted=None,
+):
+    """Process the structures of `inputs` into `output_dir` (see the
+    module docstring) with `num_workers` processes and at most
+    `max_pending` (default: 4 per worker) structures in flight, with
+    `split` as the split column of the rows. mmCIF files are regarded as
+    predicted models if `predicted`, or by their structure method if
+    None. Returns a report of the run, also saved to
+    `<output_dir>/report.json`."""
+    os.makedirs(output_dir, exist_ok=True)
+    metadata_path = os.path.join(output_dir, "metadata.csv")
+    rejected_path = os.path.join(output_dir, "rejected.csv")
+    done = _read_done(metadata_path) | _read_done(rejected_path)
+    # the raw path of the structure each pickle name is taken by
+    names = _read_names(metadata_path)
+    if done:
+        log.info(f"Resuming, skipping {len(done)} structures done before.")
+    cfg = {
+        "max_resolution": max_resolution,
+        "max_len": max_len,
+        "min_len": min_len,
+        "split": split,
+        "predicted": predicted,
+    }
+    max_pending = max_pending or 4 * num_workers
+
+    metadata_csv = _CsvAppender(metadata_path, METADATA_COLUMNS)
+    rejected_csv = _CsvAppender(rejected_path, REJECTED_COLUMNS)
+    counts = collections.Counter()
+    errors = collections.Counter()
+    pbar = tqdm(desc="Ingesting", unit="structure")
+    start = time.perf_counter()
+
+    def reject(raw_path, rejected):
+        rejected_csv.write({"raw_path": raw_path, **rejected})
+        counts[rejected["status"]] += 1
+        errors[rejected["error"].split("(")[0]] += 1
+
+    def collect(futures):
+        for future in futures:
+            raw_path, metadata, rejected = future.result()
+            if metadata is not None:
+                metadata_csv.write(metadata)
+                counts["processed"] += 1
+            else:
+                reject(raw_path, rejected)
+            pbar.update()
+        elapsed = time.perf_counter() - start
+        pbar.set_postfix(
+            **counts, rate=f"{sum(counts.values()) / elapsed:.1f}/s"
+        )
+
+    try:
+        with ProcessPoolExecutor(num_workers) as pool:
+            pending = set()
+            for raw_path, path, data in iter_structures(inputs, skip=done):
+                name = _structure_name(raw_path)
+                if name in names:
+                    # would overwrite the pickle of the same name
+                    reject(
+                        raw_path,
+                        {
+                            "status": "duplicate",
+                            "error": f"DuplicateName({name!r} of "
+                            f"{names[name]!r})",
+                        },
+                    )
+                    pbar.update()
+                    continue
+                names[name] = raw_path
+                if len(pending) >= max_pending:
+                    finished, pending = wait(
+                        pending, return_when=FIRST_COMPLETED
+                    )
+                    collect(finished)
+                pending.add(
+                    pool.submit(
+                        _process_structure,
+                        raw_path,
+                        path,
+                        data,
+                        output_dir,
+                        cfg,
+                    )
+                )
+            collect(wait(pending).done)
+    finally:
+        metadata_csv.close()
+        rejected_csv.close()
+        pbar.close()
+
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    report = {
+        "structures": total,
+        **{
+            k: counts[k]
+            for k in ["processed", "filtered", "failed", "duplicate"]
+        },
+        "skipped_done_before": len(done),
+        "seconds": elapsed,
+        "structures_per_second": total / elapsed if elapsed > 0 else 0.0,
+        "errors": dict(errors.most_common()),
+    }
+    with open(os.path.join(output_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    log.info(
+        f"Ingested {total} structures in {elapsed:.1f} s "
+        f"({report['structures_per_second']:.1f} structures/s): "
+        f"{counts['processed']} processed, {counts['filtered']} filtered, "
+        f"{counts['failed']} failed, {counts['duplicate']} duplicates "
+        f"(see {rejected_path})."
+    )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Process directories / tarballs of PDB and mmCIF files "
+        "into pickles and a metadata CSV, in parallel and resumably."
+    )
+    parser.add_argument("--inputs", nargs="+", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--max_resolution",
+        type=float,
+        default=5.0,
+        help="of mmCIF files, PDB files are not filtered by resolution",
+    )
+    parser.add_argument("--max_len", type=int, default=1024)
+    parser.add_argument("--min_len", type=int, default=0)
+    parser.add_argument(
+        "--split",
+        type=str,
+        default=None,
+        help="the split column of the rows, e.g., pdb or afdb_swissprot",
+    )
+    parser.add_argument(
+        "--predicted",
+        action="store_true",
+        default=None,
+        help="all mmCIF files are predicted models (e.g., AFDB), not "
+        "filtered by resolution (default: by their structure method)",
+    )
+    args = parser.parse_args()
+
+    ingest(
+        args.inputs,
+        args.output_dir,
+        num_workers=args.num_workers,
+        max_resolution=args.max_resolution,
+        max_len=args.max_len,
+        min_len=args.min_len,
+        split=args.split,
+        predicted=args.predicted,
+    )
+
+
+if __name__ == "__main__":
+    main()
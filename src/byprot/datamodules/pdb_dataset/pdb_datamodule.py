@@ -4,14 +4,20 @@
 """PDB data loader."""
 
 import functools as fn
+import hashlib
+import json
 import logging
 import math
+import os
 import random
+import threading
+import time
 
 import numpy as np
 import pandas as pd
 import torch
 import tree
+from omegaconf import OmegaConf
 from openfold.config import config as OF_CONFIG
 from openfold.data import data_transforms
 from openfold.utils import rigid_utils
@@ -23,6 +29,11 @@ from byprot import utils
 from byprot.datamodules import register_datamodule
 from byprot.datamodules.dataset.data_utils import MaxTokensBatchSampler
 from byprot.datamodules.pdb_dataset import utils as du
+from byprot.datamodules.pdb_dataset.columnar_store import ColumnarPdbStore
+from byprot.datamodules.pdb_dataset.feature_cache import (
+    FeatureCache,
+    default_cache_dir,
+)
 
 from .utils import aatype_to_seq, seq_to_aatype
 
@@ -201,9 +212,64 @@ class PdbDataset(Dataset):
         self.split = split
         self.crop_size = self.dataset_cfg.crop_size
         self._init_metadata()
-        self._cache = {}
+        self._cache = self._init_cache()
+        # chains converted by columnar_store, instead of pickles
+        store_dir = self._dataset_cfg.get("store_dir")
+        self._store = ColumnarPdbStore(store_dir) if store_dir else None
         self._rng = np.random.default_rng(seed=self._dataset_cfg.seed)
 
+    def _init_cache(self):
+        # processed features of large proteins, shared by the workers
+        max_bytes = self._dataset_cfg.get("cache_max_bytes", 0)
+        if not max_bytes:
+            return None
+        self._cache_fingerprint = self._get_cache_fingerprint()
+        cache_dir = self._dataset_cfg.get("cache_dir") or default_cache_dir(
+            hashlib.sha1(self.dataset_cfg.csv_path.encode()).hexdigest()[:16]
+        )
+        return FeatureCache(cache_dir, max_bytes=max_bytes)
+
+    def _get_cache_fingerprint(self):
+        """Fingerprint of what the cached features depend on besides the
+        chain itself: the dataset config (but the cache settings), the
+        code processing the features, and the columnar store if any.
+        Entries of a cache left by another config or version are then
+        never hit, and evicted as the least recently used."""
+        cfg = self._dataset_cfg
+        if OmegaConf.is_config(cfg):
+            cfg = OmegaConf.to_container(cfg, resolve=True)
+        cfg = {k: v for k, v in cfg.items() if not k.startswith("cache_")}
+        fingerprint = hashlib.sha1(
+            json.dumps(cfg, sort_keys=True, default=str).encode()
+        )
+        for source in [__file__, du.__file__]:
+            with open(source, "rb") as f:
+                fingerprint.update(f.read())
+        store_dir = self._dataset_cfg.get("store_dir")
+        if store_dir:
+            stat = os.stat(os.path.join(store_dir, "meta.json"))
+            fingerprint.update(f"{stat.st_mtime_ns}|{stat.st_size}".encode())
+        return fingerprint.hexdigest()
+
+    def _get_cache_key(self, path):
+        # the features also depend on the cropping and training filters,
+        # and on the pickle of the chain
+        try:
+            stat = os.stat(path)
+            version = f"{stat.st_mtime_ns}|{stat.st_size}"
+        except OSError:
+            # read from the columnar store, see `_get_cache_fingerprint`
+            version = ""
+        return "|".join(
+            [
+                self._cache_fingerprint,
+                path,
+                version,
+                str(self.crop_size),
+                str(self._is_training),
+            ]
+        )
+
     @property
     def is_training(self):
         return self._is_training
@@ -526,11 +592,21 @@ class PdbDataset(Dataset):
         seq_len = csv_row["modeled_seq_len"]
 
         # Large protein files are slow to read. Cache them.
-        use_cache = seq_len > self._dataset_cfg.cache_num_res
-        if use_cache and path in self._cache:
-            return self._cache[path]
+        use_cache = (
+            self._cache is not None
+            and seq_len > self._dataset_cfg.cache_num_res
+        )
+        if use_cache:
+            cache_key = self._get_cache_key(path)
+            processed_feats = self._cache.get(cache_key)
+            if processed_feats is not None:
+                return processed_feats
 
-        processed_feats = du.read_pkl(path)
+        processed_feats = None
+        if self._store is not None:
+            processed_feats = self._store.get(csv_row["processed_path"])
+        if processed_feats is None:
+            processed_feats = du.read_pkl(path)
 
         if self._is_training and self._dataset_cfg.get("load_gvp_feat"):
             gvp_path = csv_row["gvp_feat_path"].format(
@@ -553,7 +629,12 @@ class PdbDataset(Dataset):
                     csv_row["plddt"]
                 )
                 modeled_mask = plddt > 70
-                processed_feats["atom_positions"][~modeled_mask] = np.nan
+                # not in place, positions from the store are read-only
+                processed_feats["atom_positions"] = np.where(
+                    modeled_mask[:, None, None],
+                    processed_feats["atom_positions"],
+                    np.nan,
+                )
             except Exception as e:
                 print(csv_row.pdb_name, csv_row["plddt"])
 
@@ -566,11 +647,30 @@ class PdbDataset(Dataset):
         # processed_feats["pdb_name"] = csv_row["pdb_name"]
 
         if use_cache:
-            self._cache[path] = processed_feats
+            self._cache.put(cache_key, processed_feats)
         return processed_feats
 
 
 class LengthBatcher:
+    """Batches of proteins of the same length, of at most `max_batch_size`
+    proteins and `max_num_res_squared` residues^2 (plus one protein), with
+    the same number of batches, `ceil(len(metadata_csv) / num_replicas)`,
+    on every replica.
+
+    Every epoch, the rows are shuffled with a seed shared by the replicas
+    and each replica takes every `num_replicas`-th one. These are batched
+    by length, with the proteins of a length in a random order, and the
+    batches are shuffled; this is repeated (augmented) until the replica
+    has enough batches. As the lengths of a replica do not change between
+    augmentations, the batch boundaries are computed once per epoch and
+    every augmentation only shuffles the proteins within their length and
+    the batches, for all augmentations at once.
+
+    With `prefetch`, the batches of the next epoch are built in a
+    background thread while the current epoch is iterated, and
+    `stall_time` is the time the last epoch boundary waited for them.
+    """
+
     def __init__(
         self,
         *,
@@ -580,6 +680,7 @@ class LengthBatcher:
         shuffle=True,
         num_replicas=None,
         rank=None,
+        prefetch=True,
     ):
         super().__init__()
         self._log = logging.getLogger(__name__)
@@ -593,81 +694,118 @@ class LengthBatcher:
             self.rank = rank
 
         self._sampler_cfg = sampler_cfg
-        self._data_csv = metadata_csv
+        self._lengths = metadata_csv["modeled_seq_len"].to_numpy(np.int64)
         # Each replica needs the same number of batches. We set the number
         # of batches to arbitrarily be the number of examples per replica.
-        self._num_batches = math.ceil(len(self._data_csv) / self.num_replicas)
-        self._data_csv["index"] = list(range(len(self._data_csv)))
+        self._num_batches = math.ceil(len(self._lengths) / self.num_replicas)
         self.seed = seed
         self.shuffle = shuffle
+        self.prefetch = prefetch
         self.epoch = 0
         self.max_batch_size = self._sampler_cfg.max_batch_size
+        self.stall_time = 0.0
+        self._next = None
         self._log.info(
             f"Created dataloader rank {self.rank+1} out of {self.num_replicas}"
         )
-        self._create_batches()
+        self.sample_order = self._create_batches(self.epoch)
+
+    def _max_batch_sizes(self, lengths):
+        return np.minimum(
+            self.max_batch_size,
+            self._sampler_cfg.max_num_res_squared // lengths**2 + 1,
+        )
 
-    def _replica_epoch_batches(self):
+    def _create_batches(self, epoch):
+        """The samples of all batches of `epoch` concatenated, and the
+        start / end of each batch in them."""
         # Make sure all replicas share the same seed on each epoch.
-        rng = torch.Generator()
-        rng.manual_seed(self.seed + self.epoch)
+        rng = np.random.default_rng(self.seed + epoch)
+        num_rows = len(self._lengths)
         if self.shuffle:
-            indices = torch.randperm(
-                len(self._data_csv), generator=rng
-            ).tolist()
-        else:
-            indices = list(range(len(self._data_csv)))
-
-        if len(self._data_csv) > self.num_replicas:
-            replica_csv = self._data_csv.iloc[
-                indices[self.rank :: self.num_replicas]
-            ]
+            indices = rng.permutation(num_rows)
         else:
-            replica_csv = self._data_csv
+            indices = np.arange(num_rows)
+        if num_rows > self.num_replicas:
+            indices = indices[self.rank :: self.num_replicas]
 
         # Each batch contains multiple proteins of the same length.
-        sample_order = []
-        for seq_len, len_df in replica_csv.groupby("modeled_seq_len"):
-            max_batch_size = min(
-                self.max_batch_size,
-                self._sampler_cfg.max_num_res_squared // seq_len**2 + 1,
-            )
-            num_batches = math.ceil(len(len_df) / max_batch_size)
-            shuffled_len_df = len_df.sample(frac=1).reset_index(drop=True)
-            for i in range(num_batches):
-                batch_df = shuffled_len_df.iloc[
-                    i * max_batch_size : (i + 1) * max_batch_size
-                ]
-                batch_indices = batch_df["index"].tolist()
-                sample_order.append(batch_indices)
-
-        # Remove any length bias.
-        new_order = (
-            torch.randperm(len(sample_order), generator=rng).numpy().tolist()
+        by_length = np.argsort(self._lengths[indices], kind="stable")
+        indices = indices[by_length]
+        lengths = self._lengths[indices]
+        num_samples = len(indices)
+        group_starts = np.flatnonzero(np.diff(lengths, prepend=-1) != 0)
+        group_sizes = np.diff(group_starts, append=num_samples)
+        positions = np.arange(num_samples) - np.repeat(
+            group_starts, group_sizes
+        )
+        starts = np.flatnonzero(
+            positions % self._max_batch_sizes(lengths) == 0
         )
-        return [sample_order[i] for i in new_order]
+        ends = np.append(starts[1:], num_samples)
 
-    def _create_batches(self):
         # Make sure all replicas have the same number of batches Otherwise leads to bugs.
         # See bugs with shuffling https://github.com/Lightning-AI/lightning/issues/10947
-        all_batches = []
-        num_augments = -1
-        while len(all_batches) < self._num_batches:
-            all_batches.extend(self._replica_epoch_batches())
-            num_augments += 1
-            if num_augments > 1000:
-                raise ValueError("Exceeded number of augmentations.")
-        if len(all_batches) >= self._num_batches:
-            all_batches = all_batches[: self._num_batches]
-        self.sample_order = all_batches
+        num_augments = math.ceil(self._num_batches / max(len(starts), 1))
+        if num_augments > 1001:
+            raise ValueError("Exceeded number of augmentations.")
+
+        # Shuffle within each length, for every augmentation.
+        group_ids = np.repeat(np.arange(len(group_starts)), group_sizes)
+        within = np.argsort(
+            group_ids + rng.random((num_augments, num_samples)), axis=1
+        )
+        samples = indices[within].reshape(-1)
+
+        # Remove any length bias, by shuffling the batches of every
+        # augmentation.
+        order = rng.permuted(
+            np.tile(np.arange(len(starts)), (num_augments, 1)), axis=1
+        )
+        offsets = np.arange(num_augments)[:, None] * num_samples
+        batch_starts = (starts[order] + offsets).reshape(-1)
+        batch_ends = (ends[order] + offsets).reshape(-1)
+        return (
+            samples,
+            batch_starts[: self._num_batches],
+            batch_ends[: self._num_batches],
+        )
+
+    def _start_prefetch(self, epoch):
+        result = {}
+
+        def build():
+            result["batches"] = self._create_batches(epoch)
+
+        thread = threading.Thread(target=build, daemon=True)
+        thread.start()
+        self._next = (epoch, thread, result)
+
+    def _batches_of(self, epoch):
+        start = time.perf_counter()
+        batches = None
+        if self._next is not None and self._next[0] == epoch:
+            _, thread, result = self._next
+            thread.join()
+            # rebuilt below if the thread failed
+            batches = result.get("batches")
+        self._next = None
+        if batches is None:
+            batches = self._create_batches(epoch)
+        self.stall_time = time.perf_counter() - start
+        return batches
 
     def __iter__(self):
-        yield from iter(self.sample_order)
+        samples, starts, ends = self.sample_order
+        if self.prefetch:
+            self._start_prefetch(self.epoch + 1)
+        for start, end in zip(starts, ends):
+            yield samples[start:end].tolist()
         self.epoch += 1
-        self._create_batches()
+        self.sample_order = self._batches_of(self.epoch)
 
     def __len__(self):
-        return len(self.sample_order)
+        return len(self.sample_order[1])
 
 
 from sklearn.linear_model import LinearRegression
@@ -14,7 +14,8 @@ import dataclasses
 import os
 import pickle
 import string
-from typing import Any, Dict, List
+import tempfile
+from typing import Any, Dict, List, Optional
 
 import mdtraj as md
 import numpy as np
@@ -22,6 +23,7 @@ import torch
 from Bio import PDB
 from Bio.PDB import PDBIO, MMCIFParser
 from Bio.PDB.Chain import Chain
+from openfold.data import mmcif_parsing
 from openfold.utils import rigid_utils as ru
 from torch_scatter import scatter, scatter_add
 
@@ -36,6 +38,8 @@ CHAIN_TO_INT = {chain_char: i for i, chain_char in enumerate(ALPHANUMERIC)}
 INT_TO_CHAIN = {i: chain_char for i, chain_char in enumerate(ALPHANUMERIC)}
 
 NM_TO_ANG_SCALE = 10.0
+# structure methods of predicted models (e.g., of AFDB) in mmCIF headers
+PREDICTED_METHODS = ("predicted", "theoretical model")
 ANG_TO_NM_SCALE = 1 / NM_TO_ANG_SCALE
 
 CHAIN_FEATS = [
@@ -528,17 +532,24 @@ def align_structures(
     return batch_positions_rotated, reference_positions, rotation_matrices
 
 
-def process_mmcif(mmcif_path: str, max_resolution: int, max_len: int):
+def process_mmcif(
+    mmcif_path: str,
+    max_resolution: int,
+    max_len: int,
+    predicted: Optional[bool] = None,
+):
     """Processes MMCIF files into usable, smaller pickles.
 
     Args:
         mmcif_path: Path to mmcif file to read.
         max_resolution: Max resolution to allow.
         max_len: Max length to allow.
-        write_dir: Directory to write pickles to.
+        predicted: Whether the structure is a predicted model (e.g., of
+            AFDB), which has no resolution and is not filtered by it. By
+            default, inferred from the structure method of the header.
 
     Returns:
-        Saves processed protein to pickle and returns metadata.
+        Processed complex features and metadata, as in `process_pdb_file`.
 
     Raises:
         DataError if a known filtering rule is hit.
@@ -547,12 +558,6 @@ def process_mmcif(mmcif_path: str, max_resolution: int, max_len: int):
     metadata = {}
     mmcif_name = os.path.basename(mmcif_path).replace(".cif", "")
     metadata["pdb_name"] = mmcif_name
-    mmcif_subdir = os.path.join(write_dir, mmcif_name[1:3].lower())
-    if not os.path.isdir(mmcif_subdir):
-        os.mkdir(mmcif_subdir)
-    processed_mmcif_path = os.path.join(mmcif_subdir, f"{mmcif_name}.pkl")
-    processed_mmcif_path = os.path.abspath(processed_mmcif_path)
-    metadata["processed_path"] = processed_mmcif_path
     with open(mmcif_path, "r") as f:
         parsed_mmcif = mmcif_parsing.parse(
             file_id=mmcif_name, mmcif_string=f.read()
@@ -580,10 +585,16 @@ def process_mmcif(mmcif_path: str, max_resolution: int, max_len: int):
     mmcif_resolution = mmcif_header["resolution"]
     metadata["resolution"] = mmcif_resolution
     metadata["structure_method"] = mmcif_header["structure_method"]
-    if mmcif_resolution >= max_resolution:
-        raise ResolutionError(f"Too high resolution {mmcif_resolution}")
-    if mmcif_resolution == 0.0:
-        raise ResolutionError(f"Invalid resolution {mmcif_resolution}")
+    if predicted is None:
+        predicted = any(
+            method in mmcif_header["structure_method"]
+            for method in PREDICTED_METHODS
+        )
+    if not predicted:
+        if mmcif_resolution >= max_resolution:
+            raise ResolutionError(f"Too high resolution {mmcif_resolution}")
+        if mmcif_resolution == 0.0:
+            raise ResolutionError(f"Invalid resolution {mmcif_resolution}")
 
     # Extract all chains
     struct_chains = {
@@ -622,6 +633,20 @@ def process_mmcif(mmcif_path: str, max_resolution: int, max_len: int):
     if complex_aatype.shape[0] > max_len:
         raise LengthError(f"Too long {complex_aatype.shape[0]}")
 
+    try:
+        # MDtraj reads PDB files, so the structure is written as one.
+        with tempfile.NamedTemporaryFile(suffix=".pdb") as tmp_pdb:
+            io = PDBIO()
+            io.set_structure(parsed_mmcif.structure)
+            io.save(tmp_pdb.name)
+            traj = md.load(tmp_pdb.name)
+        # SS calculation
+        pdb_ss = md.compute_dssp(traj, simplified=True)
+        # DG calculation
+        pdb_dg = md.compute_rg(traj)
+    except Exception as e:
+        raise DataError(f"Mdtraj failed with error {e}")
+
     chain_dict["ss"] = pdb_ss[0]
     metadata["coil_percent"] = (
         np.sum(pdb_ss == "C") / metadata["modeled_seq_len"]
@@ -637,7 +662,7 @@ def process_mmcif(mmcif_path: str, max_resolution: int, max_len: int):
     metadata["radius_gyration"] = pdb_dg[0]
 
     # Return metadata
-    return metadata
+    return complex_feats, metadata
 
 
 def process_pdb_file(file_path: str):
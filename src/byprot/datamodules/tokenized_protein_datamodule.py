@@ -25,6 +25,10 @@ from byprot.datamodules.dataset.tokenized_protein import (
     TokenizedProteinDataset,
     setup_dataloader,
 )
+from byprot.datamodules.dataset.tokenized_shards import (
+    DPLM2ShardCollater,
+    TokenizedShardDataset,
+)
 
 log = utils.get_logger(__name__)
 
@@ -44,6 +48,7 @@ class TokenizedProteinDataModule(LightningDataModule):
         struct_vocab_size: int = 8192,
         vocab_file: str = "",
         num_seqs: int = 40,  # used for testing
+        shard_dir: Optional[str] = None,
     ):
         super().__init__()
 
@@ -63,7 +68,20 @@ class TokenizedProteinDataModule(LightningDataModule):
         """
 
         # load datasets only if they're not loaded already
-        if stage == "fit":
+        if stage == "fit" and self.hparams.shard_dir is not None:
+            # token ids converted by `tokenized_shards.py`
+            self.train_dataset = TokenizedShardDataset(
+                os.path.join(self.hparams.shard_dir, "train"),
+                max_len=self.hparams.max_len,
+            )
+            self.valid_dataset = TokenizedShardDataset(
+                os.path.join(self.hparams.shard_dir, "valid"),
+                max_len=self.hparams.max_len,
+            )
+            self.tokenizer = DPLM2Tokenizer.from_pretrained(
+                self.hparams.vocab_file
+            )
+        elif stage == "fit":
             self.train_dataset = TokenizedProteinDataset(
                 data_dir=self.hparams.data_dir,
                 csv_file=self.hparams.csv_file,
@@ -96,10 +114,13 @@ class TokenizedProteinDataModule(LightningDataModule):
 
     def train_dataloader(self):
         if self.train_dl is not None:
-            self.epoch = self.train_dl.batch_sampler.sampler.epoch + 1
+            self.epoch = self.train_dl.batch_sampler.epoch + 1
         else:
             self.epoch = 0
 
+        if self.hparams.shard_dir is not None:
+            return self._shard_train_dataloader()
+
         self.train_dataset = TokenizedProteinDataset(
             data_dir=self.hparams.data_dir,
             csv_file=self.hparams.csv_file,
@@ -128,6 +149,36 @@ class TokenizedProteinDataModule(LightningDataModule):
         )
         return self.train_dl
 
+    def _shard_train_dataloader(self):
+        # the per-epoch cluster sampling and length cropping select and
+        # crop entries of the memory-mapped dataset, instead of rebuilding it
+        if not hasattr(self, "full_train_dataset"):
+            self.full_train_dataset = self.train_dataset
+        dataset = self.full_train_dataset
+        if self.hparams.cluster_training:
+            dataset = dataset.select(
+                sample_cluster_indices(dataset.get_clusters(), self.epoch)
+            )
+        crop_lengths = None
+        if self.hparams.length_crop:
+            crop_lengths = length_cropping_array(
+                dataset.get_metadata_lens(),
+                self.epoch,
+                min_crop_length=self.hparams.min_crop_length,
+            )
+        self.train_dataset = dataset.select(crop_lengths=crop_lengths)
+
+        self.train_dl = setup_dataloader(
+            self.train_dataset,
+            max_tokens=self.hparams.max_tokens,
+            num_workers=self.hparams.num_workers,
+            max_len=self.hparams.max_len,
+            max_batch_size=800,
+            epoch=self.epoch,
+            collater=DPLM2ShardCollater(self.tokenizer),
+        )
+        return self.train_dl
+
     def val_dataloader(self):
         return setup_dataloader(
             self.valid_dataset,
@@ -135,6 +186,11 @@ class TokenizedProteinDataModule(LightningDataModule):
             num_workers=self.hparams.num_workers,
             max_len=self.hparams.max_len,
             tokenizer=self.tokenizer,
+            collater=(
+                DPLM2ShardCollater(self.tokenizer)
+                if self.hparams.shard_dir is not None
+                else None
+            ),
         )
 
     def test_dataloader(self):
@@ -172,3 +228,24 @@ def sample_cluster(dataset_pandas, epoch):
     )
     sampled_cluster = sampled_cluster.drop(columns="__index_level_0__")
     return sampled_cluster
+
+
+def length_cropping_array(lengths, epoch, min_crop_length=60):
+    """Vectorized `length_cropping` of an array of lengths."""
+    rng = np.random.RandomState(epoch)
+    lengths = np.asarray(lengths)
+    crop = (rng.rand(len(lengths)) <= 0.5) & (lengths > min_crop_length)
+    cropped = rng.randint(
+        min_crop_length, np.maximum(lengths, min_crop_length + 1)
+    )
+    return np.where(crop, cropped, lengths)
+
+
+def sample_cluster_indices(clusters, epoch):
+    """Indices of one random entry per cluster, in the order of entries."""
+    sampled = (
+        pd.Series(np.arange(len(clusters)))
+        .groupby(np.asarray(clusters))
+        .sample(1, random_state=epoch)
+    )
+    return np.sort(sampled.to_numpy())
@@ -36,6 +36,7 @@ class UniRefHFDataModule(LightningDataModule):
         max_len: int = 2048,
         num_workers: int = 0,
         num_seqs: int = 40,  # used for testing
+        pack_sequences: bool = False,
     ):
         super().__init__()
 
@@ -89,6 +90,7 @@ class UniRefHFDataModule(LightningDataModule):
             max_batch_size=1
             if self.stage == "test" or self.stage == "predict"
             else 800,
+            pack_sequences=self.hparams.pack_sequences and self.stage == "fit",
         )
 
     def val_dataloader(self):
@@ -0,0 +1,220 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+
+import math
+
+import torch
+
+from byprot import utils
+from byprot.models.utils import topk_masking
+
+log = utils.get_logger(__name__)
+
+
+class _DecodeBuffers:
+    """Preallocated decoding state of a (batch size, length bucket)."""
+
+    def __init__(self, batch_size, length, device):
+        self.tokens = torch.empty(
+            batch_size, length, dtype=torch.long, device=device
+        )
+        self.scores = torch.empty(batch_size, length, device=device)
+        self.output_masks = torch.empty(
+            batch_size, length, dtype=torch.bool, device=device
+        )
+        self.maskable = torch.empty_like(self.output_masks)
+        # the denoising rate of the step is a tensor so that the compiled
+        # step is not specialized to (and recompiled for) every step
+        self.rate = torch.zeros((), device=device)
+
+
+class DecodeStepCache:
+    """Compiled decoding step of :class:`DiffusionProteinLanguageModel`,
+    cached per (batch size, length bucket).
+
+    `DPLM.generate` runs `forward_decoder` and `_reparam_decoding` in
+    Python at every step, re-allocating the tokens / scores / masks and the
+    decoding history. Here a step is split into two pure tensor functions
+    compiled with `torch.compile` (`mode="reduce-overhead"` additionally
+    captures CUDA graphs):
+
+    - `sample`: network forward, logits masking and sampling.
+    - `update`: the `reparam-uncond-deterministic-linear` re-masking,
+      written into preallocated buffers in place.
+
+    The repeat suppression of `gumbel_argmax` (`DPLM.resample`) is data
+    dependent and runs eagerly between the two. Sequences are right-padded
+    to a multiple of `bucket_size`, so that requests of similar lengths
+    share the same compiled graphs and buffers. Padding is excluded from
+    attention and decoding, so outputs do not depend on the bucket, except
+    for the random noise drawn for the sampling strategies.
+    """
+
+    def __init__(self, model, bucket_size=32, compile=True, compile_mode=None):
+        self.model = model
+        self.bucket_size = bucket_size
+        self.buffers = {}
+
+        vocab_size = model.net.config.vocab_size
+        device = next(model.parameters()).device
+        vocab_bias = torch.zeros(vocab_size, device=device)
+        for idx in [
+            model.mask_id,
+            model.x_id,
+            model.pad_id,
+            model.bos_id,
+            model.eos_id,
+        ]:
+            vocab_bias[idx] = -math.inf
+        self.vocab_bias = vocab_bias
+
+        self._sample = self._sample_impl
+        self._update = self._update_impl
+        if compile and hasattr(torch, "compile"):
+            self._sample = torch.compile(
+                self._sample_impl, mode=compile_mode, dynamic=False
+            )
+            self._update = torch.compile(
+                self._update_impl, mode=compile_mode, dynamic=False
+            )
+
+    def bucket_length(self, length):
+        return math.ceil(length / self.bucket_size) * self.bucket_size
+
+    def get_buffers(self, batch_size, length):
+        key = (batch_size, self.bucket_length(length))
+        if key not in self.buffers:
+            log.info(f"New decoding buffers for (batch, length) = {key}")
+            device = self.vocab_bias.device
+            self.buffers[key] = _DecodeBuffers(*key, device=device)
+        return self.buffers[key]
+
+    def _sample_impl(self, tokens, sampling_strategy, temperature):
+        logits = self.model.net(input_ids=tokens)["logits"].float()
+        logits = logits + self.vocab_bias
+        if sampling_strategy == "gumbel_argmax":
+            # stochastic_sample_from_categorical with temperature 0
+            u = torch.rand_like(logits)
+            logits = logits - torch.log(-torch.log(u + 1e-8) + 1e-8)
+            scores, cur_tokens = logits.log_softmax(dim=-1).max(dim=-1)
+        elif sampling_strategy == "argmax":
+            scores, cur_tokens = logits.max(-1)
+        elif sampling_strategy == "vanilla":
+            if temperature:
+                # categorical sampling with the gumbel-max trick
+                log_probs = logits.div(temperature).log_softmax(dim=-1)
+                u = torch.rand_like(log_probs)
+                gumbel = -torch.log(-torch.log(u + 1e-8) + 1e-8)
+                cur_tokens = (log_probs + gumbel).argmax(dim=-1)
+                scores = log_probs.gather(-1, cur_tokens[..., None])[..., 0]
+            else:
+                scores, cur_tokens = logits.log_softmax(dim=-1).max(dim=-1)
+        else:
+            raise NotImplementedError
+        return cur_tokens, scores
+
+    def _update_impl(
+        self,
+        tokens,
+        scores,
+        xt_neq_x0,
+        maskable,
+        rate,
+        cur_tokens,
+        cur_scores,
+        mask_id,
+    ):
+        # forward_decoder: only maskable positions take the new predictions
+        cur_tokens = torch.where(maskable, cur_tokens, tokens)
+        cur_scores = torch.where(maskable, cur_scores, scores)
+
+        # _reparam_decoding with reparam-uncond-deterministic-linear
+        cutoff_len = (
+            maskable.sum(1, keepdim=True).type_as(scores) * rate
+        ).long()
+        lowest_k_mask = topk_masking(
+            cur_scores.masked_fill(~maskable, 1000.0),
+            cutoff_len,
+            stochastic=False,
+        )
+        masked_to_x0 = xt_neq_x0 & ~lowest_k_mask
+        tokens.copy_(
+            torch.where(
+                lowest_k_mask,
+                mask_id,
+                torch.where(masked_to_x0, cur_tokens, tokens),
+            )
+        )
+        scores.copy_(
+            torch.where(
+                lowest_k_mask,
+                -math.inf,
+                torch.where(masked_to_x0, cur_scores, scores),
+            )
+        )
+        xt_neq_x0.copy_(lowest_k_mask)
+
+    @torch.no_grad()
+    def generate(
+        self,
+        input_tokens,
+        max_iter,
+        partial_masks=None,
+        sampling_strategy="gumbel_argmax",
+        temperature=None,
+        disable_resample=False,
+        resample_ratio=0.25,
+    ):
+        """Same as `DPLM.generate` without early exit, given the (masked)
+        `input_tokens` of shape [B, L]."""
+        model = self.model
+        batch_size, length = input_tokens.shape
+        buffers = self.get_buffers(batch_size, length)
+
+        maskable = model.get_non_special_sym_mask(
+            input_tokens, partial_masks=partial_masks
+        )
+        buffers.tokens.fill_(model.pad_id)
+        buffers.tokens[:, :length] = input_tokens.masked_fill(
+            maskable, model.mask_id
+        )
+        buffers.scores.zero_()
+        buffers.maskable.zero_()
+        buffers.maskable[:, :length] = maskable
+        buffers.output_masks.copy_(buffers.maskable)
+
+        resample = (
+            sampling_strategy == "gumbel_argmax" and not disable_resample
+        )
+        for step in range(max_iter):
+            # the linear schedule, computed as in _reparam_decoding
+            buffers.rate.fill_(1 - (step + 1) / max_iter)
+            cur_tokens, cur_scores = self._sample(
+                buffers.tokens, sampling_strategy, temperature
+            )
+            if resample:
+                # in place on the unpadded views, as DPLM.resample counts
+                # the repeats over all positions
+                cur_tokens, cur_scores = cur_tokens.clone(), cur_scores.clone()
+                model.resample(
+                    cur_tokens[:, :length],
+                    cur_scores[:, :length],
+                    ratio=resample_ratio,
+                    scale=1.0,
+                )
+            self._update(
+                buffers.tokens,
+                buffers.scores,
+                buffers.output_masks,
+                buffers.maskable,
+                buffers.rate,
+                cur_tokens,
+                cur_scores,
+                model.mask_id,
+            )
+
+        return (
+            buffers.tokens[:, :length].clone(),
+            buffers.scores[:, :length].clone(),
+        )
@@ -14,15 +14,18 @@ from tqdm import tqdm
 from transformers import AutoConfig, AutoTokenizer
 
 from byprot.models import register_model
+from byprot.models.dplm.decode_step import DecodeStepCache
 from byprot.models.utils import (
     LoRAConfig,
     NetConfig,
     get_net,
     get_net_class,
+    get_repeat_mask,
     sample_from_categorical,
     stochastic_sample_from_categorical,
     top_k_top_p_filtering,
     topk_masking,
+    update_num_stable_steps,
 )
 
 
@@ -33,6 +36,9 @@ class DPLMConfig:
     net: NetConfig = field(default=NetConfig())
     gradient_ckpt: bool = field(default=False)
     rdm_couple: bool = field(default=False)
+    # attention backend of the network: eager, sdpa, or chunked
+    attn_impl: str = field(default="sdpa")
+    attn_chunk_size: int = field(default=256)
 
 
 @register_model("dplm")
@@ -56,6 +62,21 @@ class DiffusionProteinLanguageModel(nn.Module):
             self.net.supports_gradient_checkpointing = True
             self.net.gradient_checkpointing_enable()
 
+        self.set_attn_impl(self.cfg.attn_impl, self.cfg.attn_chunk_size)
+        self._decode_step_cache = None
+
+    def set_attn_impl(self, attn_impl, attn_chunk_size=None):
+        """Switch the attention backend (eager, sdpa, or chunked) of all
+        layers of the network, e.g., after `from_pretrained`."""
+        from byprot.models.dplm.modules.dplm_modeling_esm import (
+            ModifiedEsmSelfAttention,
+        )
+
+        # also reaches the attention layers of a peft-wrapped net
+        for module in self.net.modules():
+            if isinstance(module, ModifiedEsmSelfAttention):
+                module.set_attn_impl(attn_impl, attn_chunk_size)
+
     @classmethod
     def from_pretrained(
         cls, net_name, cfg_override={}, net_override={}, from_huggingface=True
@@ -106,6 +127,12 @@ class DiffusionProteinLanguageModel(nn.Module):
     def _update_cfg(self, cfg):
         self.cfg = OmegaConf.merge(self._default_cfg, cfg)
 
+    @staticmethod
+    def _per_token(x):
+        # timesteps are given per row [B], or per token [B, L] for packed
+        # rows (see `compute_loss`)
+        return x[:, None] if x.dim() == 1 else x
+
     def q_sample_coupled(self, x_0, t1, t2, maskable_mask):
         t1_eq_t2_mask = t1 == t2
         t1, t2 = torch.maximum(t1, t2).float(), torch.minimum(t1, t2).float()
@@ -113,17 +140,18 @@ class DiffusionProteinLanguageModel(nn.Module):
         # sample t1
         u = torch.rand_like(x_0, dtype=torch.float)
         t1_mask = (
-            u < (t1 / self.cfg.num_diffusion_timesteps)[:, None]
+            u < self._per_token(t1 / self.cfg.num_diffusion_timesteps)
         ) & maskable_mask
         x_t1 = x_0.masked_fill(t1_mask, self.mask_id)
 
         # sample t2
         u = torch.rand_like(x_0, dtype=torch.float)
-        t2_mask = t1_mask & (u > ((t1 - t2) / t1)[:, None])
+        t2_mask = t1_mask & (u > self._per_token((t1 - t2) / t1))
         u = torch.rand_like(x_0[t1_eq_t2_mask], dtype=torch.float)
-        t2_mask[t1_eq_t2_mask] = (
-            u < (t1[t1_eq_t2_mask] / self.cfg.num_diffusion_timesteps)[:, None]
-        ) & (maskable_mask[t1_eq_t2_mask])
+        t1_eq = t1[t1_eq_t2_mask] / self.cfg.num_diffusion_timesteps
+        if t1_eq_t2_mask.dim() == 1:
+            t1_eq = t1_eq[:, None]
+        t2_mask[t1_eq_t2_mask] = (u < t1_eq) & (maskable_mask[t1_eq_t2_mask])
         x_t2 = x_0.masked_fill(t2_mask, self.mask_id)
 
         return {
@@ -136,7 +164,7 @@ class DiffusionProteinLanguageModel(nn.Module):
         # sample t1
         u = torch.rand_like(x_0, dtype=torch.float)
         t1_mask = (
-            u < (t1 / self.cfg.num_diffusion_timesteps)[:, None]
+            u < self._per_token(t1 / self.cfg.num_diffusion_timesteps)
         ) & maskable_mask
         x_t1 = x_0.masked_fill(t1_mask, self.mask_id)
         x_t1 = x_t1.masked_fill(t1_mask, self.mask_id)
@@ -147,9 +175,20 @@ class DiffusionProteinLanguageModel(nn.Module):
             "mask_mask": t1_mask,
         }
 
-    def forward(self, input_ids, return_last_hidden_state=False, **kwargs):
+    def forward(
+        self,
+        input_ids,
+        return_last_hidden_state=False,
+        segment_ids=None,
+        **kwargs,
+    ):
+        # segment_ids: packed rows, see `EsmForDPLM.forward`
+        net_kwargs = (
+            {} if segment_ids is None else {"segment_ids": segment_ids}
+        )
         outputs = self.net(
             input_ids=input_ids,
+            **net_kwargs,
         )
         logits = outputs["logits"]
         if return_last_hidden_state:
@@ -160,13 +199,28 @@ class DiffusionProteinLanguageModel(nn.Module):
 
     def compute_loss(self, batch, weighting="constant"):
         target = batch["targets"]
-
-        t1, t2 = torch.randint(
-            1,
-            self.cfg.num_diffusion_timesteps + 1,
-            (2 * target.size(0),),
-            device=target.device,
-        ).chunk(2)
+        segment_ids = batch.get("segment_ids")
+
+        if segment_ids is None:
+            t1, t2 = torch.randint(
+                1,
+                self.cfg.num_diffusion_timesteps + 1,
+                (2 * target.size(0),),
+                device=target.device,
+            ).chunk(2)
+        else:
+            # packed rows (see `DPLMPackingCollater`): timesteps are drawn
+            # for every sequence and broadcast to its tokens, so that each
+            # sequence is noised (and weighted) as if it had a row of its own
+            num_segments = int(segment_ids.max()) + 1
+            t1, t2 = torch.randint(
+                1,
+                self.cfg.num_diffusion_timesteps + 1,
+                (2 * target.size(0), num_segments),
+                device=target.device,
+            ).chunk(2)
+            t1 = t1.gather(1, segment_ids)
+            t2 = t2.gather(1, segment_ids)
 
         if self.cfg.rdm_couple:
             # couple training
@@ -181,6 +235,8 @@ class DiffusionProteinLanguageModel(nn.Module):
                 ).values()
             )
             target = target.repeat(2, 1)
+            if segment_ids is not None:
+                segment_ids = segment_ids.repeat(2, 1)
         else:
             x_t, t, loss_mask = list(
                 self.q_sample(
@@ -190,15 +246,20 @@ class DiffusionProteinLanguageModel(nn.Module):
                 ).values()
             )
 
-        logits = self.forward(x_t)
+        logits = self.forward(x_t, segment_ids=segment_ids)
 
         num_timesteps = self.cfg.num_diffusion_timesteps
-        weight = {
-            "linear": (
-                num_timesteps - (t - 1)
-            ),  # num_timesteps * (1 - (t-1)/num_timesteps)
-            "constant": num_timesteps * torch.ones_like(t),
-        }[weighting][:, None].float() / num_timesteps
+        weight = (
+            self._per_token(
+                {
+                    "linear": (
+                        num_timesteps - (t - 1)
+                    ),  # num_timesteps * (1 - (t-1)/num_timesteps)
+                    "constant": num_timesteps * torch.ones_like(t),
+                }[weighting]
+            ).float()
+            / num_timesteps
+        )
 
         return logits, target, loss_mask, weight
 
@@ -231,45 +292,20 @@ class DiffusionProteinLanguageModel(nn.Module):
         we mask the 'V' tokens to get MLKN<mask><mask><mask><mask><mask><mask><mask><mask><mask><mask>LDN,
         and resample to get MLKNVTKYYGEVKALDN.
         """
-        to_be_resample_idx = []
-        resample_input = []
-        resample_input_mask = []
-        resample_input_scores = []
-
-        # Calculate the frequency of all tokens
-        for i, seq in enumerate(_tokens):
-            most_token_dict = {}
-            most_token_num = -1
-            for j, token in enumerate(seq):
-                token = int(token)
-                if token not in most_token_dict:
-                    most_token_dict[token] = [j]
-                else:
-                    most_token_dict[token].append(j)
-                if len(most_token_dict[token]) > most_token_num:
-                    most_token_num = len(most_token_dict[token])
-            if most_token_num > len(seq) * ratio:
-                # For all tokens with a frequency higher than the threshold, transform them to mask token.
-                to_be_resample_idx.append(i)
-                resample_input_scores.append(_scores[i])
-                mask = torch.zeros_like(seq).bool()
-                for k, v in most_token_dict.items():
-                    if len(v) > len(seq) * ratio:
-                        mask |= seq.eq(k)
-                resample_input_mask.append(mask)
-                resample_input.append(seq.masked_fill(mask, self.mask_id))
+        # Calculate the frequency of all tokens, and transform the tokens
+        # with a frequency higher than the threshold to mask token.
+        resample_mask = get_repeat_mask(
+            _tokens, ratio, vocab_size=self.net.config.vocab_size
+        )
+        to_be_resample_idx = resample_mask.any(-1).nonzero().squeeze(-1)
 
         if len(to_be_resample_idx) > 0:
             # Resample the sequences that have tokens with higher frequency than threthold.
-            resample_input = torch.stack(resample_input, dim=0).type_as(
-                _tokens
-            )
-            resample_input_scores = torch.stack(
-                resample_input_scores, dim=0
-            ).type_as(_scores)
-            resample_input_mask = (
-                torch.stack(resample_input_mask, dim=0).type_as(_tokens).bool()
+            resample_input_mask = resample_mask[to_be_resample_idx]
+            resample_input = _tokens[to_be_resample_idx].masked_fill(
+                resample_input_mask, self.mask_id
             )
+            resample_input_scores = _scores[to_be_resample_idx]
             resample_logits = self.net(
                 input_ids=resample_input,
             )["logits"]
@@ -363,7 +399,8 @@ class DiffusionProteinLanguageModel(nn.Module):
         output_tokens.masked_scatter_(output_masks, _tokens[output_masks])
         output_scores.masked_scatter_(output_masks, _scores[output_masks])
 
-        history.append(output_tokens.clone())
+        if history is not None:
+            history.append(output_tokens)
 
         return dict(
             output_tokens=output_tokens,
@@ -414,7 +451,11 @@ class DiffusionProteinLanguageModel(nn.Module):
         if schedule == "linear":
             rate = 1 - t / max_step
         elif schedule == "cosine":
-            rate = np.cos(t / max_step * np.pi * 0.5)
+            if torch.is_tensor(t):
+                # per-row steps, e.g., [B, 1] when continuous batching
+                rate = torch.cos(t / max_step * np.pi * 0.5)
+            else:
+                rate = np.cos(t / max_step * np.pi * 0.5)
         else:
             raise NotImplementedError
 
@@ -511,7 +552,81 @@ class DiffusionProteinLanguageModel(nn.Module):
         sampling_strategy="gumbel_argmax",
         disable_resample=False,
         resample_ratio=0.25,
+        early_exit=False,
+        early_exit_patience=5,
+        early_exit_tol=None,
+        compile_step=False,
+        history=None,
+        decoding_strategy="reparam",
+        draft_model=None,
+        draft_steps=4,
     ):
+        """Iterative reparameterized decoding for `max_iter` steps.
+
+        If `early_exit` is enabled, a sequence is regarded as converged once
+        its prediction (with the remaining masks filled by the current
+        predicted tokens) stays unchanged for `early_exit_patience`
+        consecutive steps (and its scores change less than `early_exit_tol`
+        if given), and it has no masks left. Converged sequences are
+        finalized with that prediction and dropped from the decoding
+        batch, and the loop stops when all sequences have converged.
+
+        Returns the decoded `(output_tokens, output_scores)`. With
+        `early_exit`, the number of decoding steps used by each sequence is
+        returned as well, i.e., `(output_tokens, output_scores, num_steps)`.
+
+        If `compile_step` is enabled, the decoding steps run as compiled
+        graphs with preallocated buffers, cached per (batch size, length
+        bucket) and reused across calls, see :class:`DecodeStepCache`.
+
+        The intermediate predictions are not kept by default. To record the
+        decoding trajectory, pass a `history` with an `append(tokens)`
+        method, e.g., a :class:`DecodingHistory`.
+
+        With `decoding_strategy="speculative"`, a smaller `draft_model`
+        (sharing the tokenizer, e.g., DPLM-150M for DPLM-3B) proposes
+        `draft_steps` decoding steps at a time, which this model verifies
+        with a single forward pass, see :meth:`_speculative_generate`.
+        """
+        if decoding_strategy == "speculative":
+            if early_exit or compile_step:
+                raise ValueError(
+                    "early_exit and compile_step are not supported with "
+                    "speculative decoding."
+                )
+            return self._speculative_generate(
+                batch,
+                draft_model=draft_model,
+                draft_steps=draft_steps,
+                max_iter=max_iter,
+                temperature=temperature,
+                partial_masks=partial_masks,
+                sampling_strategy=sampling_strategy,
+                disable_resample=disable_resample,
+                resample_ratio=resample_ratio,
+                history=history,
+            )
+        elif decoding_strategy != "reparam":
+            raise NotImplementedError
+
+        if compile_step:
+            if early_exit or history is not None:
+                raise ValueError(
+                    "early_exit and history are not supported with "
+                    "compile_step."
+                )
+            if self._decode_step_cache is None:
+                self._decode_step_cache = DecodeStepCache(self)
+            return self._decode_step_cache.generate(
+                batch["input_ids"],
+                max_iter=max_iter,
+                partial_masks=partial_masks,
+                sampling_strategy=sampling_strategy,
+                temperature=temperature,
+                disable_resample=disable_resample,
+                resample_ratio=resample_ratio,
+            )
+
         tokenizer = tokenizer
         max_iter = max_iter
         temperature = temperature
@@ -532,14 +647,31 @@ class DiffusionProteinLanguageModel(nn.Module):
             attentions=None,
             step=0,
             max_step=max_iter,
-            history=[initial_output_tokens.clone()],
+            history=history,
             temperature=temperature,
         )
+        if history is not None:
+            history.append(initial_output_tokens)
 
         prev_decoder_out["output_masks"] = self.get_non_special_sym_mask(
             prev_decoder_out["output_tokens"], partial_masks=partial_masks
         )
 
+        if early_exit:
+            batch_size = initial_output_tokens.size(0)
+            device = initial_output_tokens.device
+            # original row index of each row still being decoded
+            active_index = torch.arange(batch_size, device=device)
+            final_tokens = initial_output_tokens.clone()
+            final_scores = initial_output_scores.clone()
+            num_steps = torch.full(
+                (batch_size,), max_iter, dtype=torch.long, device=device
+            )
+            num_stable = torch.zeros(
+                batch_size, dtype=torch.long, device=device
+            )
+            prev_filled = None
+
         for step in tqdm(range(max_iter), desc="Decoding"):
             # 2.1: predict
             with torch.no_grad():
@@ -588,5 +720,209 @@ class DiffusionProteinLanguageModel(nn.Module):
                 history=decoder_out["history"],
             )
 
+            if not early_exit:
+                continue
+
+            # 2.3: early exit of converged sequences
+            filled_tokens = torch.where(
+                output_masks, decoder_out["output_tokens"], output_tokens
+            )
+            filled_scores = torch.where(
+                output_masks, decoder_out["output_scores"], output_scores
+            )
+            if prev_filled is not None:
+                num_stable = update_num_stable_steps(
+                    filled_tokens,
+                    filled_scores,
+                    *prev_filled,
+                    num_stable=num_stable,
+                    maskable_mask=non_special_sym_mask,
+                    tol=early_exit_tol,
+                )
+            prev_filled = (filled_tokens, filled_scores)
+
+            # rows with remaining masks keep decoding, not to finalize
+            # them with argmax-filled masks
+            converged = (
+                num_stable >= early_exit_patience
+            ) & ~output_masks.any(-1)
+            if converged.any():
+                converged_index = active_index[converged]
+                final_tokens[converged_index] = filled_tokens[converged]
+                final_scores[converged_index] = filled_scores[converged]
+                num_steps[converged_index] = step + 1
+
+                keep = ~converged
+                active_index = active_index[keep]
+                if active_index.numel() == 0:
+                    break
+                for k in ["output_tokens", "output_scores", "output_masks"]:
+                    prev_decoder_out[k] = prev_decoder_out[k][keep]
+                if partial_masks is not None:
+                    partial_masks = partial_masks[keep]
+                num_stable = num_stable[keep]
+                prev_filled = tuple(x[keep] for x in prev_filled)
+
         decoder_out = prev_decoder_out
+        if early_exit:
+            if active_index.numel() > 0:
+                final_tokens[active_index] = decoder_out["output_tokens"]
+                final_scores[active_index] = decoder_out["output_scores"]
+            return final_tokens, final_scores, num_steps
         return decoder_out["output_tokens"], decoder_out["output_scores"]
+
+    @torch.no_grad()
+    def _speculative_generate(
+        self,
+        batch,
+        draft_model,
+        draft_steps=4,
+        max_iter=None,
+        temperature=None,
+        partial_masks=None,
+        sampling_strategy="argmax",
+        disable_resample=False,
+        resample_ratio=0.25,
+        history=None,
+    ):
+        """Speculative reparameterized decoding with a draft model.
+
+        Each round, `draft_model` runs `draft_steps` steps of the
+        reparameterized decoding from the current tokens, and this model
+        predicts the current tokens once. Draft step `j` is accepted if
+        every position it unmasked holds the token this model predicts,
+        and is kept by the top-k rule of `_reparam_decoding` at step `j`
+        with the scores of this model. Each sequence advances to its last
+        draft step of an unbroken run of accepted ones, with the scores of
+        this model, or otherwise falls back to the step of this model.
+
+        The accepted positions are thus those both models agree on, so the
+        quality loss is bounded by the disagreement of the top-k sets.
+        The agreement is checked against the sampled tokens, so
+        speculation works best with `argmax` sampling.
+        """
+        if draft_model is None:
+            raise ValueError("Speculative decoding requires a draft_model.")
+        if draft_model.mask_id != self.mask_id:
+            raise ValueError(
+                "The draft model must share the tokenizer of the model."
+            )
+        decode_kwargs = dict(
+            partial_masks=partial_masks,
+            sampling_strategy=sampling_strategy,
+            disable_resample=disable_resample,
+            resample_ratio=resample_ratio,
+        )
+
+        def predict(model, tokens, scores, steps):
+            return model.forward_decoder(
+                prev_decoder_out=dict(
+                    output_tokens=tokens,
+                    output_scores=scores,
+                    step=steps,
+                    max_step=max_iter,
+                    history=None,
+                    temperature=temperature,
+                ),
+                **decode_kwargs,
+            )
+
+        def reparam(tokens, scores, output_masks, decoder_out, t):
+            return self._reparam_decoding(
+                output_tokens=tokens.clone(),
+                output_scores=scores.clone(),
+                cur_tokens=decoder_out["output_tokens"].clone(),
+                cur_scores=decoder_out["output_scores"].clone(),
+                decoding_strategy="reparam-uncond-deterministic-linear",
+                xt_neq_x0=output_masks,
+                non_special_sym_mask=maskable,
+                t=t,
+                max_step=max_iter,
+                noise=self.mask_id,
+            )
+
+        encoder_out = self.forward_encoder(batch)
+        tokens, scores = self.initialize_output_tokens(
+            batch, encoder_out=encoder_out, partial_masks=partial_masks
+        )
+        if history is not None:
+            history.append(tokens)
+        maskable = self.get_non_special_sym_mask(
+            tokens, partial_masks=partial_masks
+        )
+        output_masks = maskable.clone()
+        # per-sequence decoding steps, [B, 1]
+        steps = torch.zeros_like(tokens[:, :1])
+
+        while (steps < max_iter).any():
+            # 1) draft_steps steps of the draft model
+            proposals = []
+            draft_tokens, draft_scores, draft_masks = (
+                tokens,
+                scores,
+                output_masks,
+            )
+            for j in range(1, draft_steps + 1):
+                t = (steps + j).clamp(max=max_iter)
+                draft_out = predict(
+                    draft_model, draft_tokens, draft_scores, t - 1
+                )
+                draft_masks, draft_tokens, draft_scores = reparam(
+                    draft_tokens, draft_scores, draft_masks, draft_out, t
+                )
+                proposals.append((draft_tokens, draft_masks))
+
+            # 2) verify all the draft steps with one forward pass
+            decoder_out = predict(self, tokens, scores, steps)
+            cur_tokens = decoder_out["output_tokens"]
+            cur_scores = decoder_out["output_scores"]
+            topk_scores = cur_scores.masked_fill(~maskable, 1000.0)
+            num_maskable = maskable.sum(1, keepdim=True).type_as(scores)
+            num_accepted = torch.zeros_like(steps)
+            accepting = steps < max_iter
+            for j, (draft_tokens, draft_masks) in enumerate(proposals, 1):
+                t = steps + j
+                cutoff_len = (
+                    num_maskable * (1 - t.clamp(max=max_iter) / max_iter)
+                ).long()
+                lowest_k_mask = topk_masking(
+                    topk_scores, cutoff_len, stochastic=False
+                )
+                unmasked = output_masks & ~draft_masks
+                agree = draft_tokens.eq(cur_tokens) & ~lowest_k_mask
+                accepting = (
+                    accepting
+                    & (agree | ~unmasked).all(1, keepdim=True)
+                    & (t <= max_iter)
+                )
+                num_accepted += accepting.long()
+
+            # 3) otherwise, the step of this model
+            new_masks, new_tokens, new_scores = reparam(
+                tokens,
+                scores,
+                output_masks,
+                decoder_out,
+                (steps + 1).clamp(max=max_iter),
+            )
+            for j, (draft_tokens, draft_masks) in enumerate(proposals, 1):
+                accepted = num_accepted.eq(j)
+                unmasked = output_masks & ~draft_masks
+                draft_scores = torch.where(
+                    unmasked, cur_scores, scores
+                ).masked_fill(draft_masks, -math.inf)
+                new_tokens = torch.where(accepted, draft_tokens, new_tokens)
+                new_scores = torch.where(accepted, draft_scores, new_scores)
+                new_masks = torch.where(accepted, draft_masks, new_masks)
+
+            active = steps < max_iter
+            tokens = torch.where(active, new_tokens, tokens)
+            scores = torch.where(active, new_scores, scores)
+            output_masks = torch.where(active, new_masks, output_masks)
+            steps = torch.where(
+                active, steps + num_accepted.clamp(min=1), steps
+            )
+            if history is not None:
+                history.append(tokens)
+
+        return tokens, scores
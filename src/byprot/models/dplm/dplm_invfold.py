@@ -227,7 +227,8 @@ class DPLMInvFold(nn.Module):
         output_tokens.masked_scatter_(output_masks, _tokens[output_masks])
         output_scores.masked_scatter_(output_masks, _scores[output_masks])
 
-        history.append(output_tokens.clone())
+        if history is not None:
+            history.append(output_tokens)
 
         return dict(
             output_tokens=output_tokens,
@@ -405,6 +406,7 @@ class DPLMInvFold(nn.Module):
         partial_masks=None,
         sampling_strategy="argmax",
         use_draft_seq=False,
+        history=None,
     ):
         tokenizer = tokenizer
         max_iter = max_iter
@@ -429,9 +431,11 @@ class DPLMInvFold(nn.Module):
             attentions=None,
             step=0,
             max_step=max_iter,
-            history=[initial_output_tokens.clone()],
+            history=history,
             temperature=temperature,
         )
+        if history is not None:
+            history.append(initial_output_tokens)
 
         prev_decoder_out["output_masks"] = self.get_non_special_sym_mask(
             prev_decoder_out["output_tokens"], partial_masks=partial_masks
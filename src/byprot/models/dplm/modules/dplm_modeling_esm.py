@@ -16,8 +16,93 @@ from transformers.models.esm.modeling_esm import *
 
 from byprot.models import register_model
 
+ATTN_IMPLS = ("eager", "sdpa", "chunked")
+
+
+def segment_position_ids(segment_ids):
+    """Positions of the tokens of packed rows, restarting at 0 at the
+    first token of every (contiguous) segment of `segment_ids` [B, L]."""
+    positions = torch.arange(
+        segment_ids.size(1), device=segment_ids.device
+    ).expand_as(segment_ids)
+    is_start = torch.ones_like(segment_ids, dtype=torch.bool)
+    is_start[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+    starts = positions.masked_fill(~is_start, 0).cummax(dim=1).values
+    return positions - starts
+
+
+def _rotate_half(x):
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
 
 class ModifiedEsmSelfAttention(EsmSelfAttention):
+    """ESM self-attention with a selectable attention backend.
+
+    - `eager`: explicit `softmax(q @ k^T + mask) @ v`, the reference path
+      and the only one that can return attention probabilities.
+    - `sdpa`: `F.scaled_dot_product_attention`, dispatching to the fused
+      flash / memory-efficient kernels when available.
+    - `chunked`: SDPA over chunks of `attn_chunk_size` queries, bounding the
+      attention scores to [B, H, chunk, L] for kernels that materialize
+      them (e.g., on CPU).
+
+    All backends share the same projections and rotary embeddings. For
+    packed rows, `ModifiedEsmModel` sets `packed_rotary` to the cos / sin
+    of the positions of every token, restarting at every sequence.
+    """
+
+    def __init__(self, config, position_embedding_type=None):
+        super().__init__(config, position_embedding_type)
+        self.set_attn_impl(
+            getattr(config, "attn_impl", "sdpa"),
+            getattr(config, "attn_chunk_size", 256),
+        )
+        self.packed_rotary = None
+
+    def set_attn_impl(self, attn_impl, attn_chunk_size=None):
+        if attn_impl not in ATTN_IMPLS:
+            raise ValueError(
+                f"Invalid attention backend: {attn_impl}. "
+                f"Choose from {ATTN_IMPLS}."
+            )
+        self.attn_impl = attn_impl
+        if attn_chunk_size is not None:
+            self.attn_chunk_size = attn_chunk_size
+
+    def _eager_attention(self, query, key, value, attention_mask):
+        attention_scores = torch.matmul(query, key.transpose(-1, -2))
+        if attention_mask is not None:
+            attention_scores = attention_scores + attention_mask
+        attention_probs = attention_scores.softmax(dim=-1)
+        return torch.matmul(attention_probs, value), attention_probs
+
+    def _chunked_attention(self, query, key, value, attention_mask):
+        chunk_size = self.attn_chunk_size
+        # masks of [B, 1, 1, L] broadcast over queries, while per-query
+        # masks of [B, H, L, L] are sliced along with the query chunks
+        per_query_mask = (
+            attention_mask is not None and attention_mask.shape[-2] > 1
+        )
+        context = []
+        for start in range(0, query.shape[2], chunk_size):
+            end = start + chunk_size
+            mask = (
+                attention_mask[..., start:end, :]
+                if per_query_mask
+                else attention_mask
+            )
+            context.append(
+                F.scaled_dot_product_attention(
+                    query[:, :, start:end],
+                    key,
+                    value,
+                    attn_mask=mask,
+                    scale=1.0,
+                )
+            )
+        return torch.cat(context, dim=2)
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -65,9 +150,18 @@ class ModifiedEsmSelfAttention(EsmSelfAttention):
             past_key_value = (key_layer, value_layer)
 
         if self.position_embedding_type == "rotary":
-            query_layer, key_layer = self.rotary_embeddings(
-                query_layer, key_layer
-            )
+            if self.packed_rotary is not None:
+                cos, sin = self.packed_rotary
+                query_layer = (
+                    query_layer * cos + _rotate_half(query_layer) * sin
+                ).to(query_layer.dtype)
+                key_layer = (
+                    key_layer * cos + _rotate_half(key_layer) * sin
+                ).to(key_layer.dtype)
+            else:
+                query_layer, key_layer = self.rotary_embeddings(
+                    query_layer, key_layer
+                )
 
         if (
             self.position_embedding_type == "relative_key"
@@ -82,13 +176,23 @@ class ModifiedEsmSelfAttention(EsmSelfAttention):
         query_layer = query_layer.contiguous()
         key_layer = key_layer.contiguous()
         value_layer = value_layer.contiguous()
-        context_layer = F.scaled_dot_product_attention(
-            query_layer,
-            key_layer,
-            value_layer,
-            attn_mask=attention_mask,
-            scale=1.0,
-        )
+        attention_probs = None
+        if self.attn_impl == "eager":
+            context_layer, attention_probs = self._eager_attention(
+                query_layer, key_layer, value_layer, attention_mask
+            )
+        elif self.attn_impl == "chunked":
+            context_layer = self._chunked_attention(
+                query_layer, key_layer, value_layer, attention_mask
+            )
+        else:
+            context_layer = F.scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attn_mask=attention_mask,
+                scale=1.0,
+            )
 
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (
@@ -96,8 +200,12 @@ class ModifiedEsmSelfAttention(EsmSelfAttention):
         )
         context_layer = context_layer.view(new_context_layer_shape)
 
-        # outputs = (context_layer, attention_probs) if output_attentions else (context_layer,)
-        outputs = (context_layer,)
+        # only the eager backend materializes the attention probabilities
+        outputs = (
+            (context_layer, attention_probs)
+            if output_attentions and attention_probs is not None
+            else (context_layer,)
+        )
 
         if self.is_decoder:
             outputs = outputs + (past_key_value,)
@@ -167,6 +275,53 @@ class ModifiedEsmModel(EsmModel):
         # Initialize weights and apply final processing
         self.post_init()
 
+    def _set_packed_rotary(self, position_ids):
+        # kept until the next forward, for the recomputation of
+        # checkpointed layers in backward
+        packed_rotary = None
+        if position_ids is not None:
+            inv_freq = self.encoder.layer[
+                0
+            ].attention.self.rotary_embeddings.inv_freq
+            freqs = position_ids[..., None].type_as(inv_freq) * inv_freq
+            emb = torch.cat((freqs, freqs), dim=-1)[:, None]
+            packed_rotary = (emb.cos(), emb.sin())
+        for layer in self.encoder.layer:
+            layer.attention.self.packed_rotary = packed_rotary
+
+    def _packed_embeddings(self, input_ids, segment_ids):
+        """`EsmEmbeddings` of packed rows, with the token dropout rescaling
+        by the mask ratio of every sequence rather than of every row."""
+        emb = self.embeddings
+        embeddings = emb.word_embeddings(input_ids)
+        if emb.token_dropout:
+            is_mask = input_ids == emb.mask_token_id
+            embeddings = embeddings.masked_fill(is_mask[..., None], 0.0)
+            mask_ratio_train = 0.15 * 0.8
+            num_segments = int(segment_ids.max()) + 1
+            counts = torch.zeros(
+                segment_ids.size(0),
+                num_segments,
+                device=input_ids.device,
+            )
+            lengths = counts.scatter_add(
+                1, segment_ids, torch.ones_like(is_mask, dtype=counts.dtype)
+            )
+            num_masked = counts.scatter_add(
+                1, segment_ids, is_mask.to(counts.dtype)
+            )
+            mask_ratio_observed = (num_masked / lengths.clamp(min=1)).gather(
+                1, segment_ids
+            )
+            embeddings = (
+                embeddings
+                * (1 - mask_ratio_train)
+                / (1 - mask_ratio_observed)[..., None]
+            ).to(embeddings.dtype)
+        if emb.layer_norm is not None:
+            embeddings = emb.layer_norm(embeddings)
+        return (embeddings * (segment_ids > 0)[..., None]).to(embeddings.dtype)
+
     def forward(
         self,
         input_ids: Optional[torch.Tensor] = None,
@@ -181,9 +336,16 @@ class ModifiedEsmModel(EsmModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        segment_ids: Optional[torch.Tensor] = None,
     ) -> Union[
         Tuple[torch.Tensor], BaseModelOutputWithPoolingAndCrossAttentions
     ]:
+        r"""
+        segment_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+            Packed rows: the index (from 1) of the sequence of every token,
+            0 for padding. Every sequence attends only to itself, with
+            rotary positions starting at its first token.
+        """
         output_attentions = (
             output_attentions
             if output_attentions is not None
@@ -232,6 +394,22 @@ class ModifiedEsmModel(EsmModel):
             else 0
         )
 
+        if segment_ids is not None:
+            if input_ids is None or past_key_values is not None:
+                raise ValueError(
+                    "Packed sequences require input_ids and no "
+                    "past_key_values."
+                )
+            if self.config.position_embedding_type != "rotary":
+                raise ValueError(
+                    "Packed sequences require rotary position embeddings."
+                )
+            # block-diagonal, [batch_size, seq_length, seq_length]
+            attention_mask = segment_ids[:, :, None] == segment_ids[:, None, :]
+            self._set_packed_rotary(segment_position_ids(segment_ids))
+        else:
+            self._set_packed_rotary(None)
+
         if attention_mask is None:
             attention_mask = torch.ones(
                 ((batch_size, seq_length + past_key_values_length)),
@@ -276,13 +454,16 @@ class ModifiedEsmModel(EsmModel):
             head_mask, self.config.num_hidden_layers
         )
 
-        embedding_output = self.embeddings(
-            input_ids=input_ids,
-            position_ids=position_ids,
-            attention_mask=attention_mask,
-            inputs_embeds=inputs_embeds,
-            past_key_values_length=past_key_values_length,
-        )
+        if segment_ids is not None:
+            embedding_output = self._packed_embeddings(input_ids, segment_ids)
+        else:
+            embedding_output = self.embeddings(
+                input_ids=input_ids,
+                position_ids=position_ids,
+                attention_mask=attention_mask,
+                inputs_embeds=inputs_embeds,
+                past_key_values_length=past_key_values_length,
+            )
         encoder_outputs = self.encoder(
             embedding_output,
             attention_mask=extended_attention_mask,
@@ -348,13 +529,19 @@ class EsmForDPLM(EsmForMaskedLM):
         return_dict=None,
         encoder_hidden_states=None,
         encoder_attention_mask=None,
+        segment_ids=None,
     ):
-        attention_mask = input_ids.ne(self.pad_id)
+        # with packed rows (`segment_ids`), the attention mask is built
+        # from the segments instead
+        attention_mask = (
+            input_ids.ne(self.pad_id) if segment_ids is None else None
+        )
         outputs = self.esm(
             input_ids,
             attention_mask=attention_mask,
             encoder_hidden_states=encoder_hidden_states,
             encoder_attention_mask=encoder_attention_mask,
+            segment_ids=segment_ids,
         )
         sequence_output = outputs[0]
         logits = self.lm_head(sequence_output)
@@ -430,7 +617,8 @@ class EsmForDPLM(EsmForMaskedLM):
         output_tokens.masked_scatter_(output_masks, _tokens[output_masks])
         output_scores.masked_scatter_(output_masks, _scores[output_masks])
 
-        history.append(output_tokens.clone())
+        if history is not None:
+            history.append(output_tokens)
 
         return dict(
             output_tokens=output_tokens,
@@ -448,6 +636,7 @@ class EsmForDPLM(EsmForMaskedLM):
         temperature=None,
         partial_masks=None,
         sampling_strategy="gumbel_argmax",
+        history=None,
     ):
         tokenizer = tokenizer
         max_iter = max_iter
@@ -469,9 +658,11 @@ class EsmForDPLM(EsmForMaskedLM):
             attentions=None,
             step=0,
             max_step=max_iter,
-            history=[initial_output_tokens.clone()],
+            history=history,
             temperature=temperature,
         )
+        if history is not None:
+            history.append(initial_output_tokens)
 
         prev_decoder_out["output_masks"] = self.get_non_special_sym_mask(
             prev_decoder_out["output_tokens"], partial_masks=partial_masks
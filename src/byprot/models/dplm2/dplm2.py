@@ -231,29 +231,17 @@ class MultimodalDiffusionProteinLanguageModel(nn.Module):
 
         type_ids = self.get_modality_type(input_ids)
 
-        L = input_ids.shape[1]
-        num_heads = self.net.config.num_attention_heads
-        # [B, num_heads, L+2, L+2]
+        # [B, 1, 1, L], -inf for padding positions, 0 otherwise. It is
+        # broadcast over heads and queries in attention, rather than being
+        # materialized as a dense [B, num_heads, L, L] bias.
         attention_bias: torch.FloatType = (
             self.net.esm.get_extended_attention_mask(
                 input_mask, input_ids.shape
-            ).repeat(1, num_heads, L, 1)
-        )  # -inf for padding positions, 0 otherwise
-
-        if "single_modality" in kwargs:
-            single_modality_index = kwargs["single_modality"]
-            struct_attention_bias, aa_attention_bias = attention_bias.chunk(
-                2, dim=-2
-            )
-            struct_attention_bias[
-                single_modality_index, :, :, L // 2 :
-            ] = -math.inf
-            aa_attention_bias[
-                single_modality_index, :, :, : L // 2
-            ] = -math.inf
-            attention_bias = torch.concat(
-                [struct_attention_bias, aa_attention_bias], dim=-2
             )
+        )
+        # [B], samples whose struct and aa tokens cannot attend to each
+        # other, which is handled blockwise inside attention
+        single_modality_index = kwargs.get("single_modality", None)
 
         # [B, L, d_model]
         input_embeds = self.net.esm.embeddings(
@@ -265,6 +253,7 @@ class MultimodalDiffusionProteinLanguageModel(nn.Module):
             inputs_embeds=input_embeds,
             attention_mask=attention_bias,
             type_ids=type_ids,
+            single_modality=single_modality_index,
         )
 
         return outputs
@@ -539,7 +528,8 @@ class MultimodalDiffusionProteinLanguageModel(nn.Module):
         output_tokens.masked_scatter_(output_masks, _tokens[output_masks])
         output_scores.masked_scatter_(output_masks, _scores[output_masks])
 
-        history.append(output_tokens.clone())
+        if history is not None:
+            history.append(output_tokens)
 
         return dict(
             output_tokens=output_tokens,
@@ -603,7 +593,11 @@ class MultimodalDiffusionProteinLanguageModel(nn.Module):
             if schedule == "linear":
                 rate = 1 - t / max_step
             elif schedule == "cosine":
-                rate = np.cos(t / max_step * np.pi * 0.5)
+                if torch.is_tensor(t):
+                    # per-row steps, e.g., [B, 1] when continuous batching
+                    rate = torch.cos(t / max_step * np.pi * 0.5)
+                else:
+                    rate = np.cos(t / max_step * np.pi * 0.5)
             else:
                 raise NotImplementedError
 
@@ -746,7 +740,25 @@ class MultimodalDiffusionProteinLanguageModel(nn.Module):
         partial_masks=None,
         unmasking_strategy="stochastic1.0",  # [stochastic{temperature}, deterministic]
         sampling_strategy="annealing@2.2:1.0",
+        early_exit=False,
+        early_exit_patience=5,
+        early_exit_tol=None,
+        history=None,
     ):
+        """Iterative reparameterized decoding for `max_iter` steps.
+
+        If `early_exit` is enabled, a sequence is regarded as converged once
+        its prediction (with the remaining masks filled by the current
+        predicted tokens) stays unchanged for `early_exit_patience`
+        consecutive steps (and its scores change less than `early_exit_tol`
+        if given), and it has no masks left. Converged sequences are
+        finalized with that prediction and dropped from the decoding
+        batch, and the loop stops when all sequences have converged.
+
+        Returns a dict with the decoded `output_tokens`. With `early_exit`,
+        it also has the number of decoding steps used by each sequence as
+        `num_steps`.
+        """
         self.eval()
         max_iter = max_iter
         temperature = temperature
@@ -767,15 +779,31 @@ class MultimodalDiffusionProteinLanguageModel(nn.Module):
             attentions=None,
             step=0,
             max_step=max_iter,
-            history=[initial_output_tokens.clone()],
+            history=history,
             temperature=temperature,
             type_ids=self.get_modality_type(initial_output_tokens),
         )
+        if history is not None:
+            history.append(initial_output_tokens)
 
         prev_decoder_out["output_masks"] = self.get_non_special_symbol_mask(
             prev_decoder_out["output_tokens"], partial_masks=partial_masks
         )
 
+        if early_exit:
+            batch_size = initial_output_tokens.size(0)
+            device = initial_output_tokens.device
+            # original row index of each row still being decoded
+            active_index = torch.arange(batch_size, device=device)
+            final_tokens = initial_output_tokens.clone()
+            num_steps = torch.full(
+                (batch_size,), max_iter, dtype=torch.long, device=device
+            )
+            num_stable = torch.zeros(
+                batch_size, dtype=torch.long, device=device
+            )
+            prev_filled = None
+
         for step in tqdm(range(max_iter), desc="Decoding"):
             # 2.1: predict
             with torch.no_grad():
@@ -821,7 +849,61 @@ class MultimodalDiffusionProteinLanguageModel(nn.Module):
                 history=decoder_out["history"],
             )
 
+            if not early_exit:
+                continue
+
+            # 2.3: early exit of converged sequences
+            filled_tokens = torch.where(
+                output_masks, decoder_out["output_tokens"], output_tokens
+            )
+            filled_scores = torch.where(
+                output_masks, decoder_out["output_scores"], output_scores
+            )
+            if prev_filled is not None:
+                num_stable = update_num_stable_steps(
+                    filled_tokens,
+                    filled_scores,
+                    *prev_filled,
+                    num_stable=num_stable,
+                    maskable_mask=non_special_sym_mask,
+                    tol=early_exit_tol,
+                )
+            prev_filled = (filled_tokens, filled_scores)
+
+            # rows with remaining masks keep decoding, not to finalize
+            # them with argmax-filled masks
+            converged = (
+                num_stable >= early_exit_patience
+            ) & ~output_masks.any(-1)
+            if converged.any():
+                converged_index = active_index[converged]
+                final_tokens[converged_index] = filled_tokens[converged]
+                num_steps[converged_index] = step + 1
+
+                keep = ~converged
+                active_index = active_index[keep]
+                if active_index.numel() == 0:
+                    break
+                for k in [
+                    "output_tokens",
+                    "output_scores",
+                    "output_masks",
+                    "type_ids",
+                ]:
+                    prev_decoder_out[k] = prev_decoder_out[k][keep]
+                if partial_masks is not None:
+                    partial_masks = partial_masks[keep]
+                num_stable = num_stable[keep]
+                prev_filled = tuple(x[keep] for x in prev_filled)
+
         decoder_out = prev_decoder_out
+        if early_exit:
+            if active_index.numel() > 0:
+                final_tokens[active_index] = decoder_out["output_tokens"]
+            return {
+                "output_tokens": final_tokens,
+                "num_steps": num_steps,
+            }
         return {
             "output_tokens": decoder_out["output_tokens"],
         }
@@ -89,29 +89,17 @@ class DPLM2Bit(DPLM2):
 
         type_ids = self.get_modality_type(input_ids)
 
-        L = input_ids.shape[1]
-        num_heads = self.net.config.num_attention_heads
-        # [B, num_heads, L+2, L+2]
+        # [B, 1, 1, L], -inf for padding positions, 0 otherwise. It is
+        # broadcast over heads and queries in attention, rather than being
+        # materialized as a dense [B, num_heads, L, L] bias.
         attention_bias: torch.FloatType = (
             self.net.esm.get_extended_attention_mask(
                 input_mask, input_ids.shape
-            ).repeat(1, num_heads, L, 1)
-        )  # -inf for padding positions, 0 otherwise
-
-        if "single_modality" in kwargs:
-            single_modality_index = kwargs["single_modality"]
-            struct_attention_bias, aa_attention_bias = attention_bias.chunk(
-                2, dim=-2
-            )
-            struct_attention_bias[
-                single_modality_index, :, :, L // 2 :
-            ] = -math.inf
-            aa_attention_bias[
-                single_modality_index, :, :, : L // 2
-            ] = -math.inf
-            attention_bias = torch.concat(
-                [struct_attention_bias, aa_attention_bias], dim=-2
             )
+        )
+        # [B], samples whose struct and aa tokens cannot attend to each
+        # other, which is handled blockwise inside attention
+        single_modality_index = kwargs.get("single_modality", None)
 
         ######## construct the input embedding
         # [B, L, d_model]
@@ -142,6 +130,7 @@ class DPLM2Bit(DPLM2):
             attention_mask=attention_bias,
             output_hidden_states=True,
             type_ids=type_ids,
+            single_modality=single_modality_index,
         )
 
         return outputs
@@ -306,7 +295,8 @@ class DPLM2Bit(DPLM2):
         output_tokens.masked_scatter_(output_masks, _tokens[output_masks])
         output_scores.masked_scatter_(output_masks, _scores[output_masks])
 
-        history.append(output_tokens.clone())
+        if history is not None:
+            history.append(output_tokens)
 
         return dict(
             output_tokens=output_tokens,
@@ -348,10 +338,26 @@ class DPLM2Bit(DPLM2):
         partial_masks=None,
         unmasking_strategy="stochastic1.0",  # [stochastic{temperature}, deterministic]
         sampling_strategy="annealing@1.1:0.1",
+        early_exit=False,
+        early_exit_patience=5,
+        early_exit_tol=None,
+        history=None,
     ):
+        """Iterative reparameterized decoding for `max_iter` steps, as
+        :meth:`DPLM2.generate`, with the structure tokens of the output
+        also returned as codebook features (`final_struct_feature`) for
+        the structure tokenizer, over the residues of `res_mask`.
+
+        Early exit works as in :meth:`DPLM2.generate`: converged
+        sequences are finalized and dropped from the decoding batch, and
+        the returned dict then also has the number of decoding steps used
+        by each sequence as `num_steps`.
+        """
         self.eval()
         max_iter = max_iter
         temperature = temperature
+        # the partial masks of the whole batch, for the final outputs
+        batch_partial_masks = partial_masks
 
         # 0) encoding
         encoder_out = self.forward_encoder(input_tokens)
@@ -369,15 +375,31 @@ class DPLM2Bit(DPLM2):
             attentions=None,
             step=0,
             max_step=max_iter,
-            history=[initial_output_tokens.clone()],
+            history=history,
             temperature=temperature,
             type_ids=self.get_modality_type(initial_output_tokens),
         )
+        if history is not None:
+            history.append(initial_output_tokens)
 
         prev_decoder_out["output_masks"] = self.get_non_special_symbol_mask(
             prev_decoder_out["output_tokens"], partial_masks=partial_masks
         )
 
+        if early_exit:
+            batch_size = initial_output_tokens.size(0)
+            device = initial_output_tokens.device
+            # original row index of each row still being decoded
+            active_index = torch.arange(batch_size, device=device)
+            final_tokens = initial_output_tokens.clone()
+            num_steps = torch.full(
+                (batch_size,), max_iter, dtype=torch.long, device=device
+            )
+            num_stable = torch.zeros(
+                batch_size, dtype=torch.long, device=device
+            )
+            prev_filled = None
+
         for step in tqdm(range(max_iter), desc="Decoding"):
             # 2.1: predict
             with torch.no_grad():
@@ -424,16 +446,73 @@ class DPLM2Bit(DPLM2):
                 all_hidden_states=decoder_out["all_hidden_states"],
             )
 
+            if not early_exit:
+                continue
+
+            # 2.3: early exit of converged sequences
+            filled_tokens = torch.where(
+                output_masks, decoder_out["output_tokens"], output_tokens
+            )
+            filled_scores = torch.where(
+                output_masks, decoder_out["output_scores"], output_scores
+            )
+            if prev_filled is not None:
+                num_stable = update_num_stable_steps(
+                    filled_tokens,
+                    filled_scores,
+                    *prev_filled,
+                    num_stable=num_stable,
+                    maskable_mask=non_special_sym_mask,
+                    tol=early_exit_tol,
+                )
+            prev_filled = (filled_tokens, filled_scores)
+
+            # rows with remaining masks keep decoding, not to finalize
+            # them with argmax-filled masks
+            converged = (
+                num_stable >= early_exit_patience
+            ) & ~output_masks.any(-1)
+            if converged.any():
+                converged_index = active_index[converged]
+                final_tokens[converged_index] = filled_tokens[converged]
+                num_steps[converged_index] = step + 1
+
+                keep = ~converged
+                active_index = active_index[keep]
+                if active_index.numel() == 0:
+                    break
+                for k in [
+                    "output_tokens",
+                    "output_scores",
+                    "output_masks",
+                    "type_ids",
+                ]:
+                    prev_decoder_out[k] = prev_decoder_out[k][keep]
+                if partial_masks is not None:
+                    partial_masks = partial_masks[keep]
+                num_stable = num_stable[keep]
+                prev_filled = tuple(x[keep] for x in prev_filled)
+
         decoder_out = prev_decoder_out
+        if early_exit:
+            if active_index.numel() > 0:
+                final_tokens[active_index] = decoder_out["output_tokens"]
+            decoder_out = dict(output_tokens=final_tokens)
+            non_special_sym_mask = self.get_non_special_symbol_mask(
+                final_tokens, partial_masks=batch_partial_masks
+            )
 
         decoder_out = self.prepare_for_struct_tokenizer(
             decoder_out, non_special_sym_mask
         )
-        return {
+        outputs = {
             "output_tokens": decoder_out["output_tokens"],
             "res_mask": decoder_out["res_mask"],
             "final_struct_feature": decoder_out["final_struct_feature"],
         }
+        if early_exit:
+            outputs["num_steps"] = num_steps
+        return outputs
 
     def prepare_for_struct_tokenizer(self, decoder_out, non_special_sym_mask):
         lm_output_struct_tokens = decoder_out["output_tokens"].chunk(2, dim=1)[
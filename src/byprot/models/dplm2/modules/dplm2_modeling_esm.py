@@ -102,6 +102,7 @@ class ModifiedEsmSelfAttention(EsmSelfAttention):
         past_key_value: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
         output_attentions: Optional[bool] = False,
         type_ids: Optional[torch.Tensor] = None,
+        single_modality: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor]:
         mixed_query_layer = self.query(hidden_states)
 
@@ -183,13 +184,24 @@ class ModifiedEsmSelfAttention(EsmSelfAttention):
         key_layer = key_layer.contiguous()
         value_layer = value_layer.contiguous()
         # start_time = time.time()
-        context_layer = F.scaled_dot_product_attention(
-            query_layer,
-            key_layer,
-            value_layer,
-            attn_mask=attention_mask,
-            scale=1.0,
-        )
+        if single_modality is not None and single_modality.any():
+            context_layer = self._modality_block_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attention_mask,
+                single_modality,
+            )
+        else:
+            # attention_mask is a compact [B, 1, 1, L] key padding bias,
+            # which is broadcast over heads and queries by SDPA
+            context_layer = F.scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attn_mask=attention_mask,
+                scale=1.0,
+            )
         # end_time = time.time()
         # print('FlashAttn: ', start_time - end_time)
 
@@ -216,6 +228,69 @@ class ModifiedEsmSelfAttention(EsmSelfAttention):
             outputs = outputs + (past_key_value,)
         return outputs
 
+    def _modality_block_attention(
+        self,
+        query_layer,
+        key_layer,
+        value_layer,
+        attention_mask,
+        single_modality,
+    ):
+        """Attention in which, for the samples in `single_modality`, struct
+        and aa tokens only attend to tokens of the same modality.
+
+        This is equivalent to adding a block-diagonal -inf bias, but never
+        materializes a dense [B, H, L, L] bias: the two modality blocks of
+        these samples are computed as two half-length SDPA calls.
+
+        single_modality: [B], bool
+        """
+
+        def _slice_mask(mask, sl):
+            if mask is None:
+                return None
+            # compact [B, 1, 1, L] key padding mask or dense [B, H, L, L]
+            return mask[..., sl] if mask.size(-2) == 1 else mask[..., sl, sl]
+
+        half = query_layer.size(-2) // 2
+        context_layer = torch.empty_like(query_layer)
+
+        joint = ~single_modality
+        if joint.any():
+            context_layer[joint] = F.scaled_dot_product_attention(
+                query_layer[joint],
+                key_layer[joint],
+                value_layer[joint],
+                attn_mask=(
+                    attention_mask[joint]
+                    if attention_mask is not None
+                    else None
+                ),
+                scale=1.0,
+            )
+
+        q, k, v = (
+            query_layer[single_modality],
+            key_layer[single_modality],
+            value_layer[single_modality],
+        )
+        mask = (
+            attention_mask[single_modality]
+            if attention_mask is not None
+            else None
+        )
+        for sl in [slice(None, half), slice(half, None)]:
+            context_layer[
+                single_modality, :, sl
+            ] = F.scaled_dot_product_attention(
+                q[:, :, sl],
+                k[:, :, sl],
+                v[:, :, sl],
+                attn_mask=_slice_mask(mask, sl),
+                scale=1.0,
+            )
+        return context_layer
+
 
 class ModifiedEsmAttention(EsmAttention):
     def __init__(self, config):
@@ -237,6 +312,7 @@ class ModifiedEsmAttention(EsmAttention):
         past_key_value=None,
         output_attentions=False,
         type_ids=None,
+        single_modality=None,
     ):
         hidden_states_ln = self.LayerNorm(hidden_states)
         self_outputs = self.self(
@@ -248,6 +324,7 @@ class ModifiedEsmAttention(EsmAttention):
             past_key_value,
             output_attentions,
             type_ids,
+            single_modality,
         )
         attention_output = self.output(self_outputs[0], hidden_states)
         outputs = (attention_output,) + self_outputs[
@@ -286,6 +363,7 @@ class ModifiedEsmLayer(EsmLayer):
         past_key_value=None,
         output_attentions=False,
         type_ids=None,
+        single_modality=None,
     ):
         # decoder uni-directional self-attention cached key/values tuple is at positions 1,2
         self_attn_past_key_value = (
@@ -298,6 +376,7 @@ class ModifiedEsmLayer(EsmLayer):
             output_attentions=output_attentions,
             past_key_value=self_attn_past_key_value,
             type_ids=type_ids,
+            single_modality=single_modality,
         )
         attention_output = self_attention_outputs[0]
 
@@ -377,6 +456,7 @@ class ModifiedEsmEncoder(EsmEncoder):
         output_hidden_states=False,
         return_dict=True,
         type_ids=None,
+        single_modality=None,
     ):
         if self.gradient_checkpointing and self.training:
             if use_cache:
@@ -414,6 +494,7 @@ class ModifiedEsmEncoder(EsmEncoder):
                     past_key_value,
                     output_attentions,
                     type_ids,
+                    single_modality,
                 )
             else:
                 layer_outputs = layer_module(
@@ -425,6 +506,7 @@ class ModifiedEsmEncoder(EsmEncoder):
                     past_key_value,
                     output_attentions,
                     type_ids,
+                    single_modality,
                 )
 
             hidden_states = layer_outputs[0]
@@ -497,6 +579,7 @@ class ModifiedEsmModel(EsmModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         type_ids: Optional[torch.Tensor] = None,
+        single_modality: Optional[torch.Tensor] = None,
     ) -> Union[
         Tuple[torch.Tensor], BaseModelOutputWithPoolingAndCrossAttentions
     ]:
@@ -615,6 +698,7 @@ class ModifiedEsmModel(EsmModel):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
             type_ids=type_ids,
+            single_modality=single_modality,
         )
         sequence_output = encoder_outputs[0]
         pooled_output = (
@@ -663,6 +747,7 @@ class EsmForDPLM2(EsmForMaskedLM):
         return_dict=None,
         encoder_hidden_states=None,
         encoder_attention_mask=None,
+        single_modality=None,
     ):
         if attention_mask is None:
             attention_mask = input_ids.ne(self.pad_id)
@@ -674,6 +759,7 @@ class EsmForDPLM2(EsmForMaskedLM):
             encoder_hidden_states=encoder_hidden_states,
             encoder_attention_mask=encoder_attention_mask,
             type_ids=type_ids,
+            single_modality=single_modality,
         )
 
         sequence_output = outputs[0]
@@ -4,9 +4,11 @@
 
 import importlib
 import os
+from collections import deque
 from dataclasses import dataclass, field
 from pathlib import Path
 
+import numpy as np
 import torch
 import torch.nn as nn
 from huggingface_hub import snapshot_download
@@ -301,6 +303,118 @@ def topk_masking_prior(
     return masking
 
 
+def update_num_stable_steps(
+    tokens,
+    scores,
+    prev_tokens,
+    prev_scores,
+    num_stable,
+    maskable_mask,
+    tol=None,
+):
+    """Count the consecutive decoding steps in which the fully unmasked
+    prediction of each sequence stays unchanged, used for early exit.
+
+    tokens, scores, prev_tokens, prev_scores: [b, n]
+    num_stable: [b]
+    maskable_mask: [b, n], positions to be compared
+    tol: if not None, scores also need to change less than `tol`.
+        Note that scores are noisy under stochastic sampling strategies.
+    returns:
+        num_stable: [b], reset to 0 where any token (or score) changed
+    """
+    unchanged = tokens == prev_tokens
+    if tol is not None:
+        unchanged &= (scores - prev_scores).abs() <= tol
+    unchanged = (unchanged | ~maskable_mask).all(-1)
+    return torch.where(unchanged, num_stable + 1, torch.zeros_like(num_stable))
+
+
+def get_repeat_mask(tokens, ratio, vocab_size):
+    """Find the tokens that repeat too often in each sequence, e.g., GGGGG....
+
+    tokens: [b, n]
+    ratio: a token is regarded as over-represented if its frequency in the
+        sequence is higher than n * ratio
+    vocab_size: int, all token ids should be smaller than it
+    returns:
+        mask: [b, n], with 1 if the token at that position is over-represented
+    """
+    counts = tokens.new_zeros(tokens.size(0), vocab_size)
+    counts.scatter_add_(1, tokens, torch.ones_like(tokens))
+    # frequency of the token at each position
+    freqs = counts.gather(1, tokens)
+    return freqs > tokens.size(1) * ratio
+
+
+class DecodingHistory:
+    """Compact trajectory of the output tokens during iterative decoding,
+    e.g., for visualization. Pass it as `history` to `generate`, which
+    records nothing by default.
+
+    The tokens are recorded every `every` steps (plus the initial tokens)
+    as CPU tensors of uint8 if `vocab_size` <= 256, or int16 otherwise.
+    With `capacity`, only the latest `capacity` records are kept in memory
+    (a ring buffer). With `save_path`, every record is also appended to
+    that file as (step, tokens) numpy arrays, see :meth:`load`.
+
+    Note that the batch size of the records shrinks when finished
+    sequences are dropped, e.g., with early exit.
+    """
+
+    def __init__(
+        self, every=1, capacity=None, save_path=None, vocab_size=None
+    ):
+        self.every = every
+        self.dtype = (
+            torch.uint8
+            if vocab_size is not None and vocab_size <= 256
+            else torch.int16
+        )
+        self.steps = deque(maxlen=capacity)
+        self.records = deque(maxlen=capacity)
+        self.save_path = save_path
+        self._file = None
+        self._num_calls = 0
+
+    def append(self, tokens):
+        # the first call records the initial tokens, i.e., step 0
+        step = self._num_calls
+        self._num_calls += 1
+        if step % self.every != 0:
+            return
+        record = tokens.detach().to("cpu", self.dtype)
+        self.steps.append(step)
+        self.records.append(record)
+        if self.save_path is not None:
+            if self._file is None:
+                self._file = open(self.save_path, "wb")
+            np.save(self._file, np.asarray(step))
+            np.save(self._file, record.numpy())
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, idx):
+        return self.records[idx]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def load(path):
+        """Read the (steps, tokens) streamed to `path`."""
+        steps, records = [], []
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            while f.tell() < size:
+                steps.append(int(np.load(f)))
+                records.append(np.load(f))
+        return steps, records
+
+
 def mask_fill_811(inputs, masked_indices, mask_id):
     prev_tokens = inputs.clone()
     # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
@@ -323,7 +437,8 @@ def mask_fill_811(inputs, masked_indices, mask_id):
 
 
 def sample_from_categorical(logits=None, temperature=1.0):
-    if temperature:
+    # temperature can also be a per-row tensor broadcastable to logits
+    if torch.is_tensor(temperature) or temperature:
         dist = torch.distributions.Categorical(logits=logits.div(temperature))
         tokens = dist.sample()
         scores = dist.log_prob(tokens)
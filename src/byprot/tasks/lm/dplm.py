@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
+import time
 from typing import Any, Union
 
 import torch
@@ -59,6 +60,7 @@ class DPLMTrainingTask(TaskLitModule):
 
         self.build_model()
         self.tokenizer = self.model.tokenizer
+        self._last_train_step_time = None
         # self.model = None
         # self.build_generator()
 
@@ -146,6 +148,18 @@ class DPLMTrainingTask(TaskLitModule):
         )
         self.log("lr", self.lrate, on_step=True, on_epoch=False, prog_bar=True)
 
+        # effective throughput, i.e., of non-pad tokens, between steps
+        now = time.perf_counter()
+        if self._last_train_step_time is not None:
+            num_tokens = batch["targets"].ne(self.tokenizer.pad_token_id).sum()
+            self.log(
+                "train/tokens_per_sec",
+                num_tokens.float() / (now - self._last_train_step_time),
+                on_step=True,
+                on_epoch=False,
+            )
+        self._last_train_step_time = now
+
         for log_key in logging_output:
             log_value = logging_output[log_key]
             self.log(
@@ -0,0 +1,21 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+
+from .engine import (
+    BACKENDS,
+    DPLM2Backend,
+    DPLMBackend,
+    GenerationEngine,
+    GenerationRequest,
+    request_from_dict,
+)
+from .launcher import (
+    GenerationWorker,
+    ShardOutputs,
+    add_launcher_args,
+    balance_shards,
+    run_sharded,
+)
+from .manifest import GenerationManifest, GenerationShard, build_sweep_shards
+from .server import serve
@@ -0,0 +1,635 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from byprot import utils
+
+log = utils.get_logger(__name__)
+
+
+@dataclass
+class GenerationRequest:
+    """A single generation job submitted to :class:`GenerationEngine`.
+
+    Unconditional tasks only need `length`. Conditional tasks (folding,
+    inverse folding, motif-scaffolding) take templates in `aa_seq` and/or
+    `struct_seq`, where the positions to be generated are written as the
+    mask token of the corresponding modality (`<mask>` for DPLM,
+    `<mask_aa>` / `<mask_struct>` for DPLM-2). Struct tokens are
+    comma-separated, following the fasta files produced by DPLM-2.
+    """
+
+    task: str = "unconditional"
+    length: int = 100
+    aa_seq: Optional[str] = None
+    struct_seq: Optional[str] = None
+    max_iter: int = 500
+    request_id: Optional[str] = None
+
+
+class _Slot:
+    """Per-request decoding state, stored as one 1-D tensor per segment
+    (e.g., [struct, aa] for DPLM-2) so that it can be re-packed into any
+    decoding batch."""
+
+    def __init__(self, request, future, group, tokens, partial_masks):
+        self.request = request
+        self.future = future
+        self.group = group
+        self.tokens = tokens
+        self.partial_masks = partial_masks
+        self.scores = [torch.zeros_like(t, dtype=torch.float) for t in tokens]
+        self.output_masks = None
+        self.step = 0
+        self.submit_time = time.time()
+
+    @property
+    def num_tokens(self):
+        return sum(len(t) for t in self.tokens)
+
+
+class _DecodeBatch:
+    """Slots of the same group packed into padded [B, L] tensors.
+
+    Each segment is padded to the longest one in the batch separately, so
+    the [struct, aa] layout of DPLM-2 is preserved.
+    """
+
+    def __init__(self, slots, pad_id, device):
+        self.slots = slots
+        self.lengths = [[len(t) for t in slot.tokens] for slot in slots]
+        self.widths = [max(lens) for lens in zip(*self.lengths)]
+
+        def _collate(name, padding_value):
+            segments = zip(*[getattr(slot, name) for slot in slots])
+            return torch.cat(
+                [
+                    pad_sequence(
+                        list(seg),
+                        batch_first=True,
+                        padding_value=padding_value,
+                    )
+                    for seg in segments
+                ],
+                dim=1,
+            ).to(device)
+
+        self.tokens = _collate("tokens", pad_id)
+        self.scores = _collate("scores", 0.0)
+        self.partial_masks = _collate("partial_masks", False)
+        self.output_masks = _collate("output_masks", False)
+        self.steps = torch.tensor([slot.step for slot in slots], device=device)
+        self.max_steps = torch.tensor(
+            [slot.request.max_iter for slot in slots], device=device
+        )
+
+    def __len__(self):
+        return len(self.slots)
+
+    @property
+    def num_padded_tokens(self):
+        return len(self.slots) * sum(self.widths)
+
+    def scatter_back(self, indices=None):
+        """Copy the batched state of (a subset of) rows back to their
+        slots, removing the padding."""
+        if indices is None:
+            indices = range(len(self.slots))
+        for i in indices:
+            slot = self.slots[i]
+            offset = 0
+            for k, width in enumerate(self.widths):
+                n = self.lengths[i][k]
+                slot.tokens[k] = self.tokens[i, offset : offset + n]
+                slot.scores[k] = self.scores[i, offset : offset + n]
+                slot.output_masks[k] = self.output_masks[
+                    i, offset : offset + n
+                ]
+                offset += width
+
+
+class DPLMBackend:
+    """Adapts :class:`DiffusionProteinLanguageModel` to the engine."""
+
+    tasks = ("unconditional", "scaffolding")
+
+    def __init__(
+        self,
+        model,
+        sampling_strategy="gumbel_argmax",
+        unmasking_strategy="deterministic",
+        temperature=1.0,
+        disable_resample=False,
+        resample_ratio=0.25,
+    ):
+        self.model = model
+        self.tokenizer = model.tokenizer
+        self.pad_id = model.pad_id
+        self.sampling_strategy = sampling_strategy
+        self.unmasking_strategy = unmasking_strategy
+        self.temperature = temperature
+        self.disable_resample = disable_resample
+        self.resample_ratio = resample_ratio
+
+    def encode(self, request):
+        if request.task == "unconditional":
+            seq = self.tokenizer.mask_token * request.length
+        elif request.task == "scaffolding":
+            if request.aa_seq is None:
+                raise ValueError("`aa_seq` is required for scaffolding.")
+            seq = request.aa_seq
+        else:
+            raise NotImplementedError(
+                f"Task {request.task} is not supported by DPLM, "
+                f"choose from {self.tasks}."
+            )
+        tokens = torch.tensor(
+            self.tokenizer(seq, add_special_tokens=True)["input_ids"]
+        )
+        partial_masks = tokens.ne(self.model.mask_id)
+        return "aa", [tokens], [partial_masks]
+
+    def get_non_special_sym_mask(self, tokens, partial_masks=None):
+        return self.model.get_non_special_sym_mask(
+            tokens, partial_masks=partial_masks
+        )
+
+    @torch.no_grad()
+    def step(self, batch):
+        model = self.model
+        steps, max_steps = batch.steps[:, None], batch.max_steps[:, None]
+        prev_decoder_out = dict(
+            output_tokens=batch.tokens,
+            output_scores=batch.scores,
+            step=steps,
+            max_step=max_steps,
+            history=None,
+            temperature=self.temperature,
+        )
+        decoder_out = model.forward_decoder(
+            prev_decoder_out=prev_decoder_out,
+            partial_masks=batch.partial_masks,
+            sampling_strategy=self.sampling_strategy,
+            disable_resample=self.disable_resample,
+            resample_ratio=self.resample_ratio,
+        )
+        non_special_sym_mask = model.get_non_special_sym_mask(
+            batch.tokens, partial_masks=batch.partial_masks
+        )
+        return model._reparam_decoding(
+            output_tokens=batch.tokens.clone(),
+            output_scores=batch.scores.clone(),
+            cur_tokens=decoder_out["output_tokens"].clone(),
+            cur_scores=decoder_out["output_scores"].clone(),
+            decoding_strategy=f"reparam-uncond-{self.unmasking_strategy}-linear",
+            xt_neq_x0=batch.output_masks,
+            non_special_sym_mask=non_special_sym_mask,
+            t=(steps + 1).float(),
+            max_step=max_steps.float(),
+            noise=model.mask_id,
+        )
+
+    def decode(self, slot):
+        aa_seq = self.tokenizer.decode(
+            slot.tokens[0], skip_special_tokens=True
+        )
+        return {"aa_seq": "".join(aa_seq.split())}
+
+
+class DPLM2Backend:
+    """Adapts :class:`MultimodalDiffusionProteinLanguageModel` to the
+    engine.
+
+    Requests are grouped by the modalities they carry (struct-only,
+    aa-only or both), since they use different input layouts.
+    """
+
+    tasks = (
+        "unconditional",
+        "co_generation",
+        "sequence_generation",
+        "backbone_generation",
+        "folding",
+        "inverse_folding",
+        "scaffolding",
+    )
+
+    def __init__(
+        self,
+        model,
+        sampling_strategy="annealing@2.2:1.0",
+        unmasking_strategy="stochastic1.0",
+        temperature=1.0,
+    ):
+        if "bit" in getattr(model.net.config, "dplm_type", ""):
+            raise NotImplementedError(
+                "DPLM-2 bit model is not supported by the generation engine."
+            )
+        self.model = model
+        self.tokenizer = model.tokenizer
+        self.pad_id = model.pad_id
+        self.sampling_strategy = sampling_strategy
+        self.unmasking_strategy = unmasking_strategy
+        self.temperature = temperature
+
+    def encode(self, request):
+        tokenizer = self.tokenizer
+        task, length = request.task, request.length
+        struct_seq, aa_seq = None, None
+        if task in ["unconditional", "co_generation"]:
+            struct_seq = [tokenizer.struct_mask_token] * length
+            aa_seq = tokenizer.aa_mask_token * length
+        elif task == "sequence_generation":
+            aa_seq = tokenizer.aa_mask_token * length
+        elif task == "backbone_generation":
+            struct_seq = [tokenizer.struct_mask_token] * length
+        elif task == "folding":
+            if request.aa_seq is None:
+                raise ValueError("`aa_seq` is required for folding.")
+            aa_seq = request.aa_seq
+            struct_seq = [tokenizer.struct_mask_token] * len(aa_seq)
+        elif task == "inverse_folding":
+            if request.struct_seq is None:
+                raise ValueError(
+                    "`struct_seq` is required for inverse folding."
+                )
+            struct_seq = request.struct_seq.split(",")
+            aa_seq = tokenizer.aa_mask_token * len(struct_seq)
+        elif task == "scaffolding":
+            if request.aa_seq is None or request.struct_seq is None:
+                raise ValueError(
+                    "Both `aa_seq` and `struct_seq` are required for scaffolding."
+                )
+            aa_seq = request.aa_seq
+            struct_seq = request.struct_seq.split(",")
+        else:
+            raise NotImplementedError(
+                f"Task {task} is not supported by DPLM-2, "
+                f"choose from {self.tasks}."
+            )
+
+        group, tokens, partial_masks = [], [], []
+        if struct_seq is not None:
+            struct_seq = (
+                tokenizer.struct_cls_token
+                + "".join(struct_seq)
+                + tokenizer.struct_eos_token
+            )
+            struct_tokens = torch.tensor(
+                tokenizer(struct_seq, add_special_tokens=False)["input_ids"]
+            )
+            group.append("struct")
+            tokens.append(struct_tokens)
+            partial_masks.append(struct_tokens.ne(self.model.struct_mask_id))
+        if aa_seq is not None:
+            aa_seq = tokenizer.aa_cls_token + aa_seq + tokenizer.aa_eos_token
+            aa_tokens = torch.tensor(
+                tokenizer(aa_seq, add_special_tokens=False)["input_ids"]
+            )
+            group.append("aa")
+            tokens.append(aa_tokens)
+            partial_masks.append(aa_tokens.ne(self.model.aa_mask_id))
+        if len(tokens) == 2 and len(tokens[0]) != len(tokens[1]):
+            raise ValueError(
+                f"Length mismatch between struct ({len(tokens[0]) - 2}) "
+                f"and aa ({len(tokens[1]) - 2}) templates."
+            )
+        return "+".join(group), tokens, partial_masks
+
+    def get_non_special_sym_mask(self, tokens, partial_masks=None):
+        return self.model.get_non_special_symbol_mask(
+            tokens, partial_masks=partial_masks
+        )
+
+    @torch.no_grad()
+    def step(self, batch):
+        model = self.model
+        steps, max_steps = batch.steps[:, None], batch.max_steps[:, None]
+        prev_decoder_out = dict(
+            output_tokens=batch.tokens,
+            output_scores=batch.scores,
+            # [B, 1, 1] to broadcast the annealed temperature over logits
+            step=steps[..., None],
+            max_step=max_steps[..., None],
+            history=None,
+            temperature=self.temperature,
+        )
+        decoder_out = model.forward_decoder(
+            prev_decoder_out=prev_decoder_out,
+            partial_masks=batch.partial_masks,
+            sampling_strategy=self.sampling_strategy,
+        )
+        non_special_sym_mask = model.get_non_special_symbol_mask(
+            batch.tokens, partial_masks=batch.partial_masks
+        )
+        return model._reparam_decoding(
+            output_tokens=batch.tokens.clone(),
+            output_scores=batch.scores.clone(),
+            cur_tokens=decoder_out["output_tokens"].clone(),
+            cur_scores=decoder_out["output_scores"].clone(),
+            decoding_strategy=f"reparam-uncond-{self.unmasking_strategy}-linear",
+            xt_neq_x0=batch.output_masks,
+            type_ids=model.get_modality_type(batch.tokens),
+            non_special_sym_mask=non_special_sym_mask,
+            t=(steps + 1).float(),
+            max_step=max_steps.float(),
+        )
+
+    def decode(self, slot):
+        result = {}
+        for modality, tokens in zip(slot.group.split("+"), slot.tokens):
+            seq = self.tokenizer.decode(tokens, skip_special_tokens=True)
+            if modality == "struct":
+                result["struct_seq"] = ",".join(seq.split())
+            else:
+                result["aa_seq"] = "".join(seq.split())
+        return result
+
+
+BACKENDS = {
+    "dplm": DPLMBackend,
+    "dplm2": DPLM2Backend,
+}
+
+
+class GenerationEngine:
+    """Long-lived, in-process generation engine with continuous batching.
+
+    The model stays loaded across jobs. Requests of different lengths,
+    tasks and step counts are packed into shared decoding batches (one
+    batch per input layout), where every row keeps its own step counter
+    and reparameterized decoding schedule. Between two decoding steps,
+    rows that reached their `max_iter` are evicted and their futures are
+    resolved, and pending requests are admitted into the freed capacity.
+
+    Args:
+        backend: a backend from `BACKENDS` wrapping the model.
+        max_batch_size: maximum number of rows of each decoding batch.
+        max_tokens: optional budget of padded tokens (rows x width) of
+            each decoding batch.
+        autocast_dtype: run the forward passes under `torch.autocast`
+            with this dtype, e.g., `torch.bfloat16`.
+    """
+
+    def __init__(
+        self,
+        backend,
+        max_batch_size=64,
+        max_tokens=None,
+        autocast_dtype=None,
+    ):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_tokens = max_tokens
+        self.autocast_dtype = autocast_dtype
+        self.device = next(backend.model.parameters()).device
+
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._batches: Dict[str, _DecodeBatch] = {}
+        self._thread = None
+        self._stopped = False
+
+        self.stats = dict(
+            num_requests=0,
+            num_finished=0,
+            num_failed=0,
+            num_steps=0,
+            num_rows=0,
+            num_tokens=0,
+            num_padded_tokens=0,
+        )
+
+    @classmethod
+    def from_pretrained(
+        cls,
+        model_name,
+        model_type="dplm",
+        device=None,
+        backend_kwargs={},
+        **kwargs,
+    ):
+        from peft.peft_model import PeftModel
+
+        from byprot.models import MODEL_REGISTRY
+
+        model = MODEL_REGISTRY[model_type].from_pretrained(model_name)
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        model = model.eval().to(device)
+        if issubclass(type(model.net), PeftModel):
+            model.net = model.net.merge_and_unload()
+        backend = BACKENDS[model_type](model, **backend_kwargs)
+        return cls(backend, **kwargs)
+
+    # ------------------------------------------------------------------ #
+    # client side
+    # ------------------------------------------------------------------ #
+    def submit(self, request: GenerationRequest) -> Future:
+        """Enqueue a request, returning a future of its result dict."""
+        future = Future()
+        group, tokens, partial_masks = self.backend.encode(request)
+        tokens = [t.to(self.device) for t in tokens]
+        partial_masks = [p.to(self.device) for p in partial_masks]
+        slot = _Slot(request, future, group, tokens, partial_masks)
+        slot.output_masks = [
+            self.backend.get_non_special_sym_mask(t[None], p[None])[0]
+            for t, p in zip(slot.tokens, slot.partial_masks)
+        ]
+        if self.max_tokens is not None and slot.num_tokens > self.max_tokens:
+            raise ValueError(
+                f"Request of {slot.num_tokens} tokens exceeds the token "
+                f"budget of a decoding batch ({self.max_tokens})."
+            )
+        with self._cond:
+            self._pending.append(slot)
+            self.stats["num_requests"] += 1
+            self._cond.notify()
+        return future
+
+    def generate(self, requests: List[GenerationRequest]) -> List[dict]:
+        """Blocking helper: submit `requests` and wait for all results.
+
+        If the background loop is not running, decoding is driven from
+        the calling thread.
+        """
+        futures = [self.submit(request) for request in requests]
+        if self._thread is None:
+            while not all(f.done() for f in futures):
+                self.step()
+        return [f.result() for f in futures]
+
+    # ------------------------------------------------------------------ #
+    # engine side
+    # ------------------------------------------------------------------ #
+    def start(self):
+        """Run the decoding loop in a background thread."""
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._loop, name="generation-engine", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def num_active(self):
+        return sum(len(batch) for batch in self._batches.values())
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not (self._stopped or self._pending or self._batches):
+                    self._cond.wait()
+                if self._stopped:
+                    break
+            try:
+                self.step()
+            except Exception as e:
+                log.exception("Generation engine step failed.")
+                self._fail_all(e)
+
+    def _fail_all(self, exc):
+        slots = [s for b in self._batches.values() for s in b.slots]
+        with self._cond:
+            slots.extend(self._pending)
+            self._pending.clear()
+        self._batches = {}
+        for slot in slots:
+            if not slot.future.done():
+                slot.future.set_exception(exc)
+                self.stats["num_failed"] += 1
+
+    def _fits(self, slots, new_slot):
+        if len(slots) + 1 > self.max_batch_size:
+            return False
+        if self.max_tokens is None:
+            return True
+        widths = [len(t) for t in new_slot.tokens]
+        for slot in slots:
+            widths = [max(w, len(t)) for w, t in zip(widths, slot.tokens)]
+        return (len(slots) + 1) * sum(widths) <= self.max_tokens
+
+    def _admit(self):
+        """Move pending requests (FIFO within each group) into the freed
+        capacity of the decoding batches, returning the changed groups."""
+        members = {
+            group: list(batch.slots) for group, batch in self._batches.items()
+        }
+        blocked, changed, remaining = set(), set(), deque()
+        with self._cond:
+            while self._pending:
+                slot = self._pending.popleft()
+                if slot.future.cancelled():
+                    continue
+                slots = members.setdefault(slot.group, [])
+                if slot.group not in blocked and self._fits(slots, slot):
+                    slots.append(slot)
+                    changed.add(slot.group)
+                else:
+                    # keep FIFO order within a group to avoid starvation
+                    blocked.add(slot.group)
+                    remaining.append(slot)
+            self._pending = remaining
+        return {group: members[group] for group in changed}
+
+    def _rebuild(self, group, slots):
+        batch = self._batches.pop(group, None)
+        if batch is not None:
+            batch.scatter_back()
+        if len(slots) > 0:
+            self._batches[group] = _DecodeBatch(
+                slots, self.backend.pad_id, self.device
+            )
+
+    def step(self):
+        """Admit pending requests, run one decoding step for every active
+        batch and evict finished rows. Returns the number of finished
+        requests."""
+        for group, slots in self._admit().items():
+            self._rebuild(group, slots)
+
+        num_finished = 0
+        for group, batch in list(self._batches.items()):
+            with torch.autocast(
+                device_type=self.device.type,
+                dtype=self.autocast_dtype,
+                enabled=self.autocast_dtype is not None,
+            ):
+                output_masks, tokens, scores = self.backend.step(batch)
+            batch.tokens, batch.scores = tokens, scores
+            batch.output_masks = output_masks
+            batch.steps += 1
+
+            self.stats["num_steps"] += 1
+            self.stats["num_rows"] += len(batch)
+            self.stats["num_tokens"] += sum(s.num_tokens for s in batch.slots)
+            self.stats["num_padded_tokens"] += batch.num_padded_tokens
+
+            finished = []
+            for i, slot in enumerate(batch.slots):
+                slot.step += 1
+                if slot.step >= slot.request.max_iter:
+                    finished.append(i)
+            if len(finished) == 0:
+                continue
+
+            batch.scatter_back(finished)
+            for i in finished:
+                self._finish(batch.slots[i])
+            num_finished += len(finished)
+            self._rebuild(
+                group,
+                [s for i, s in enumerate(batch.slots) if i not in finished],
+            )
+        return num_finished
+
+    def _finish(self, slot):
+        result = dict(
+            request_id=slot.request.request_id,
+            task=slot.request.task,
+            num_steps=slot.step,
+            latency=time.time() - slot.submit_time,
+        )
+        result.update(self.backend.decode(slot))
+        self.stats["num_finished"] += 1
+        if not slot.future.done():
+            slot.future.set_result(result)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        with self._cond:
+            stats["num_pending"] = len(self._pending)
+        stats["num_active"] = self.num_active
+        num_steps = max(stats["num_steps"], 1)
+        stats["avg_batch_size"] = stats["num_rows"] / num_steps
+        stats["padding_efficiency"] = stats["num_tokens"] / max(
+            stats["num_padded_tokens"], 1
+        )
+        return stats
+
+
+def request_from_dict(obj) -> GenerationRequest:
+    fields = GenerationRequest.__dataclass_fields__
+    unknown = set(obj) - set(fields)
+    if unknown:
+        raise ValueError(f"Unknown request fields: {sorted(unknown)}")
+    return GenerationRequest(**obj)
@@ -0,0 +1,228 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+
+import heapq
+import os
+import queue
+import traceback
+from typing import Callable, List, Optional, Sequence
+
+import torch
+import torch.multiprocessing as mp
+
+from byprot import utils
+
+from .manifest import GenerationManifest, GenerationShard
+
+log = utils.get_logger(__name__)
+
+
+def shard_cost(shard: GenerationShard):
+    """Decoding cost of a shard, dominated by attention over its length."""
+    length = shard.length or 1
+    return max(shard.num_seqs, 1) * length**2
+
+
+def balance_shards(
+    shards: Sequence[GenerationShard],
+    num_workers: int,
+    cost_fn: Callable = shard_cost,
+) -> List[List[int]]:
+    """Assign shards to workers with the longest-processing-time-first
+    heuristic, i.e., the most expensive remaining shard goes to the least
+    loaded worker. Returns the indices of the shards of each worker, in
+    their original order."""
+    heap = [(0, rank) for rank in range(num_workers)]
+    assignment = [[] for _ in range(num_workers)]
+    order = sorted(range(len(shards)), key=lambda i: (-cost_fn(shards[i]), i))
+    for index in order:
+        load, rank = heapq.heappop(heap)
+        assignment[rank].append(index)
+        heapq.heappush(heap, (load + cost_fn(shards[index]), rank))
+    return [sorted(indices) for indices in assignment]
+
+
+def get_worker_devices(num_workers, device="auto"):
+    """One device per worker: GPUs round-robin if `device` is `cuda` (or
+    `auto` with GPUs available), otherwise CPU."""
+    if device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cuda":
+        num_gpus = torch.cuda.device_count()
+        if num_gpus == 0:
+            raise ValueError("No GPU available, please use device='cpu'.")
+        return [f"cuda:{rank % num_gpus}" for rank in range(num_workers)]
+    return [device] * num_workers
+
+
+class ShardOutputs:
+    """Outputs of a shard buffered by a worker, with the same writing
+    interface as :class:`GenerationManifest`. They are written by the
+    launcher process only, as soon as the shard is done."""
+
+    def __init__(self):
+        self.writes = []
+
+    def write_fasta(self, path, headers, seqs):
+        self.writes.append(("write_fasta", path, list(headers), list(seqs)))
+
+    def write_parquet(self, path, shard, records):
+        self.writes.append(("write_parquet", path, shard, records))
+
+    def write_text(self, path, text):
+        self.writes.append(("write_text", path, text))
+
+    def commit(self, manifest: GenerationManifest, shard):
+        for method, *args in self.writes:
+            getattr(manifest, method)(*args)
+        manifest.mark_done(shard)
+
+
+class GenerationWorker:
+    """Base class of the per-process generation workers.
+
+    `setup` is called once in the worker process (e.g., to load the model
+    on `device`), then `__call__` runs a shard and returns its
+    :class:`ShardOutputs`. Subclasses are pickled to the worker processes
+    before `setup`, so they should only hold picklable arguments.
+    """
+
+    def setup(self, device):
+        raise NotImplementedError
+
+    def __call__(self, shard: GenerationShard) -> ShardOutputs:
+        raise NotImplementedError
+
+
+def add_launcher_args(parser):
+    """Command line options of :func:`run_sharded`."""
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="number of worker processes, e.g., one per GPU",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="auto",
+        choices=["auto", "cuda", "cpu"],
+        help="run on GPUs if available (auto), or force cuda / cpu",
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=None,
+        help="intra-op threads of each CPU worker "
+        "(default: cores split evenly)",
+    )
+    return parser
+
+
+def _worker_loop(rank, worker, device, num_threads, shards, results):
+    try:
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        worker.setup(device)
+        for index, shard in shards:
+            results.put((rank, index, worker(shard), None))
+    except Exception:
+        results.put((rank, None, None, traceback.format_exc()))
+    results.put((rank, None, None, None))
+
+
+def run_sharded(
+    manifest: GenerationManifest,
+    worker: GenerationWorker,
+    num_workers: int = 1,
+    device: str = "auto",
+    num_threads: Optional[int] = None,
+    cost_fn: Callable = shard_cost,
+):
+    """Run the pending shards of `manifest` on `num_workers` processes.
+
+    Shards are balanced across workers by `cost_fn` (length^2 by default)
+    and each worker runs on its own device, i.e., one GPU per worker, or
+    CPU processes with `num_threads` intra-op threads each (the CPU cores
+    split evenly by default). The outputs of each shard are committed to
+    the manifest by this process as soon as it is done, so they are not
+    held in memory, and are kept if another shard fails. With the seeds
+    and output names of each shard, the results do not depend on the
+    number of workers, only the order of the records in the output files
+    does.
+
+    With a single worker, shards run in the current process.
+    """
+    shards = manifest.pending_shards()
+    if len(shards) == 0:
+        log.info("All shards are done.")
+        return
+    num_workers = max(1, min(num_workers, len(shards)))
+    devices = get_worker_devices(num_workers, device)
+    if num_threads is None and devices[0] == "cpu" and num_workers > 1:
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+    if num_workers == 1:
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        worker.setup(devices[0])
+        for shard in shards:
+            worker(shard).commit(manifest, shard)
+        return
+
+    assignment = balance_shards(shards, num_workers, cost_fn)
+    log.info(
+        f"Running {len(shards)} shards on {num_workers} workers "
+        f"({', '.join(sorted(set(devices)))})."
+    )
+
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(
+            target=_worker_loop,
+            args=(
+                rank,
+                worker,
+                devices[rank],
+                num_threads,
+                [(i, shards[i]) for i in assignment[rank]],
+                results,
+            ),
+            daemon=True,
+        )
+        for rank in range(num_workers)
+    ]
+    for p in processes:
+        p.start()
+
+    num_running = num_workers
+    try:
+        while num_running > 0:
+            try:
+                rank, index, outputs, error = results.get(timeout=10)
+            except queue.Empty:
+                dead = [
+                    rank
+                    for rank, p in enumerate(processes)
+                    if not p.is_alive() and p.exitcode not in (0, None)
+                ]
+                if dead:
+                    raise RuntimeError(
+                        f"Generation workers {dead} exited unexpectedly."
+                    )
+                continue
+            if error is not None:
+                raise RuntimeError(
+                    f"Generation worker {rank} failed:\n{error}"
+                )
+            if index is None:
+                num_running -= 1
+                continue
+            outputs.commit(manifest, shards[index])
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
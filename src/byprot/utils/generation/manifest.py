@@ -0,0 +1,216 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Sequence
+
+from byprot import utils
+
+log = utils.get_logger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+
+
+@dataclass
+class GenerationShard:
+    """A unit of work of a generation job, e.g., one batch of
+    `num_seqs` samples of a given `length` under a given `seed`.
+
+    `start` is the index of the first sample of the shard among all samples
+    of the same (length, seed), used to name the outputs consistently
+    across restarts.
+    """
+
+    name: str
+    length: Optional[int] = None
+    seed: int = 0
+    start: int = 0
+    num_seqs: int = 0
+
+    @property
+    def rng_seed(self):
+        """Seed of the shard, derived from (seed, length, start) so that a
+        resumed shard reproduces the samples of an uninterrupted run."""
+        key = f"{self.seed}-{self.length}-{self.start}".encode()
+        return int.from_bytes(hashlib.sha256(key).digest()[:4], "little")
+
+
+def build_sweep_shards(lengths, num_seqs, seeds=(0,), batch_size=None):
+    """Shards of a lengths x seeds sweep generating `num_seqs` samples for
+    each (length, seed), split into batches of at most `batch_size`."""
+    batch_size = batch_size or num_seqs
+    shards = []
+    for length in lengths:
+        for seed in seeds:
+            for start in range(0, num_seqs, batch_size):
+                shards.append(
+                    GenerationShard(
+                        name=f"L_{length}_seed_{seed}_start_{start}",
+                        length=length,
+                        seed=seed,
+                        start=start,
+                        num_seqs=min(batch_size, num_seqs - start),
+                    )
+                )
+    return shards
+
+
+class GenerationManifest:
+    """Resumable record of a generation job stored as
+    `<save_dir>/manifest.json`.
+
+    Outputs are written shard by shard to append-only sinks under
+    `save_dir` (FASTA files, or one Parquet file per shard), and a shard is
+    only marked as done after its outputs are flushed to disk. The
+    manifest keeps the committed size of every FASTA file, so that the
+    partial records of an interrupted shard are truncated on restart and
+    the shard is regenerated from scratch:
+
+        manifest = GenerationManifest(save_dir, shards, config=vars(args))
+        for shard in manifest.pending_shards():
+            ...
+            manifest.write_fasta(f"{save_dir}/L_100.fasta", headers, seqs)
+            manifest.mark_done(shard)
+
+    Restarting with different `shards` or `config` raises a ValueError
+    rather than mixing outputs of different jobs.
+    """
+
+    def __init__(
+        self,
+        save_dir,
+        shards: Sequence[GenerationShard],
+        config: Optional[Dict] = None,
+    ):
+        self.save_dir = save_dir
+        self.path = os.path.join(save_dir, MANIFEST_NAME)
+        self.shards = list(shards)
+        names = [shard.name for shard in self.shards]
+        if len(set(names)) != len(names):
+            raise ValueError("Shard names of a manifest must be unique.")
+
+        os.makedirs(save_dir, exist_ok=True)
+        spec = {
+            "config": _jsonable(config or {}),
+            "shards": [asdict(shard) for shard in self.shards],
+        }
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            if state["spec"] != spec:
+                raise ValueError(
+                    f"{self.path} was created for a different job, "
+                    f"please use another save directory."
+                )
+            self.state = state
+            self._rollback()
+        else:
+            self.state = {"spec": spec, "done": [], "files": {}}
+            self._save()
+
+        num_done = len(self.state["done"])
+        if num_done > 0:
+            log.info(
+                f"Resuming from {self.path}: "
+                f"{num_done}/{len(self.shards)} shards done."
+            )
+
+    def pending_shards(self) -> List[GenerationShard]:
+        done = set(self.state["done"])
+        return [shard for shard in self.shards if shard.name not in done]
+
+    def is_done(self, shard):
+        return shard.name in self.state["done"]
+
+    @property
+    def finished(self):
+        return len(self.pending_shards()) == 0
+
+    def _relpath(self, path):
+        relpath = os.path.relpath(
+            os.path.abspath(path), os.path.abspath(self.save_dir)
+        )
+        if relpath.startswith(os.pardir):
+            raise ValueError(f"{path} is not inside {self.save_dir}.")
+        return relpath
+
+    def _abspath(self, relpath):
+        return os.path.join(self.save_dir, relpath)
+
+    def write_fasta(self, path, headers, seqs):
+        """Append records to a FASTA file inside `save_dir`."""
+        relpath = self._relpath(path)
+        if relpath not in self.state["files"]:
+            # register the file before writing to it, so that writes of an
+            # interrupted shard can always be rolled back
+            self.state["files"][relpath] = 0
+            self._save()
+        abspath = self._abspath(relpath)
+        os.makedirs(os.path.dirname(abspath), exist_ok=True)
+        with open(abspath, "a") as f:
+            for header, seq in zip(headers, seqs):
+                f.write(f">{header}\n{seq}\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write_parquet(self, path, shard, records: Dict[str, Sequence]):
+        """Write the columns in `records` to `<path>/<shard.name>.parquet`.
+
+        Parquet files cannot be appended to, so each shard gets its own
+        file in the `path` directory, which can be read back as a single
+        table with `pandas.read_parquet(path)`.
+        """
+        import pandas as pd
+
+        abspath = self._abspath(self._relpath(path))
+        os.makedirs(abspath, exist_ok=True)
+        filename = os.path.join(abspath, f"{shard.name}.parquet")
+        pd.DataFrame(records).to_parquet(filename + ".tmp", index=False)
+        os.replace(filename + ".tmp", filename)
+
+    def write_text(self, path, text):
+        """(Over)write a small per-shard file, e.g., a csv table."""
+        self._relpath(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+    def mark_done(self, shard):
+        """Commit the outputs written so far and mark `shard` as done."""
+        for relpath in self.state["files"]:
+            abspath = self._abspath(relpath)
+            if os.path.exists(abspath):
+                self.state["files"][relpath] = os.path.getsize(abspath)
+        if shard.name not in self.state["done"]:
+            self.state["done"].append(shard.name)
+        self._save()
+
+    def _rollback(self):
+        for relpath, size in self.state["files"].items():
+            abspath = self._abspath(relpath)
+            if os.path.exists(abspath) and os.path.getsize(abspath) > size:
+                log.info(
+                    f"Truncating {abspath} to {size} bytes "
+                    f"(records of an interrupted shard)."
+                )
+                with open(abspath, "r+") as f:
+                    f.truncate(size)
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def _jsonable(obj):
+    # round-trip through json so that a fresh spec compares equal to the
+    # one loaded from disk (e.g., tuples become lists)
+    return json.loads(json.dumps(obj, default=str))
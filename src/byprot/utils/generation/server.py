@@ -0,0 +1,106 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+
+import json
+import os
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from byprot import utils
+
+from .engine import GenerationEngine, request_from_dict
+
+log = utils.get_logger(__name__)
+
+
+class GenerationRequestHandler(BaseHTTPRequestHandler):
+    """Local HTTP front end of a :class:`GenerationEngine`.
+
+    - `GET /health` returns the engine statistics.
+    - `POST /generate` takes either a single request object or
+      `{"requests": [...]}` and blocks until all results are ready.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # client_address is an empty string for unix sockets
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def log_message(self, format, *args):
+        log.info(f"{self.address_string()} - {format % args}")
+
+    def _send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/health":
+            self._send_json(self.server.engine.get_stats())
+        else:
+            self._send_json({"error": f"Unknown path {self.path}"}, 404)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/generate":
+            self._send_json({"error": f"Unknown path {self.path}"}, 404)
+            return
+
+        engine: GenerationEngine = self.server.engine
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            single = "requests" not in payload
+            requests = [payload] if single else payload["requests"]
+            futures = [
+                engine.submit(request_from_dict(request))
+                for request in requests
+            ]
+        except (ValueError, TypeError, NotImplementedError) as e:
+            self._send_json({"error": str(e)}, 400)
+            return
+
+        try:
+            results = [future.result() for future in futures]
+        except Exception as e:
+            self._send_json({"error": repr(e)}, 500)
+            return
+        self._send_json(results[0] if single else {"results": results})
+
+
+class UnixHTTPServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    daemon_threads = True
+
+
+def serve(engine, host="127.0.0.1", port=8000, unix_socket=None):
+    """Serve `engine` over HTTP on `host:port`, or on `unix_socket` if
+    given, until interrupted."""
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, GenerationRequestHandler)
+        address = f"unix://{unix_socket}"
+    else:
+        server = ThreadingHTTPServer((host, port), GenerationRequestHandler)
+        address = f"http://{host}:{port}"
+    server.engine = engine
+
+    engine.start()
+    log.info(f"Serving generation engine at {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.stop()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)
@@ -12,12 +12,16 @@
 """This script is highly inspired by MultiFlow
 (https://github.com/jasonkyuyim/multiflow)."""
 
+import json
 import os
 import re
 import shutil
+import threading
 import time
 import warnings
+from contextlib import contextmanager, nullcontext
 from copy import deepcopy
+from functools import partial
 from glob import glob
 
 import hydra
@@ -39,10 +43,16 @@ from byprot.datamodules.pdb_dataset.pdb_datamodule import (
     collate_fn,
 )
 from byprot.models.utils import get_struct_tokenizer
-from byprot.utils import load_from_experiment, recursive_to, seed_everything
+from byprot.utils import load_from_experiment, seed_everything
 from byprot.utils.protein import folding_model
 from byprot.utils.protein import utils as eu
 from byprot.utils.protein.residue_constants import restypes, restypes_with_x
+from byprot.utils.protein.sc_pipeline import SelfConsistencyPipeline
+from byprot.utils.protein.tokenize_pdb import (
+    detokenize_batches,
+    iter_length_batches,
+    tokenize_batches,
+)
 
 warnings.filterwarnings("ignore")
 
@@ -113,6 +123,9 @@ class EvalRunner:
         self._folding_cfg = self._infer_cfg.folding
 
         self._struct_tokenizer = None
+        self._sc_pipeline = None
+        # bounds the concurrent ProteinMPNN subprocesses in the pipeline
+        self._pmpnn_slots = None
 
         self.aatype_pred_num_tokens = 21  # cfg.model.aatype_pred_num_tokens
         self.aatype_corrupt = False
@@ -232,18 +245,26 @@ class EvalRunner:
         os.makedirs(output_dir, exist_ok=True)
         log.info(f"Predicting strctures from {fasta_path}")
 
-        cutoff = 450
-        dataloader = torch.utils.data.DataLoader(
+        output_format = self._infer_cfg.get("detokenize_output_format", "pdb")
+        if output_format != "pdb" and self._infer_cfg.get("is_trajectory"):
+            raise ValueError("Trajectories are only written as PDB files.")
+        # batched by length, see tokenize_pdb.iter_length_batches
+        batches = iter_length_batches(
             all_data,
-            batch_size=1,  # if not self._infer_cfg.get("is_trajectory") else len(all_data),
-            shuffle=False,
-            drop_last=False,
-            collate_fn=self.struct_tokenizer.init_data,
+            max_batch_size=self._infer_cfg.get("detokenize_batch_size", 64),
+            max_num_res_squared=self._infer_cfg.get(
+                "detokenize_max_num_res_squared", 1_000_000
+            ),
+            buffer_size=len(all_data),
+        )
+        detokenize_batches(
+            self.struct_tokenizer,
+            batches,
+            output_dir,
+            with_aatype=self.aatype_corrupt
+            or self._infer_cfg.task == "forward_folding",
+            output_format=output_format,
         )
-        pbar = tqdm(dataloader, desc="struct tokenizer")
-        for batch in pbar:
-            pbar.set_description(f"struct tokenizer ({batch['header']})")
-            self._run_struct_tokenizer(batch, output_dir)
 
         if self._infer_cfg.get("is_trajectory"):
             self.write_trajectory(output_dir)
@@ -284,25 +305,6 @@ class EvalRunner:
             f.write(pdb_prot)
         f.close()
 
-    @torch.no_grad()
-    def _run_struct_tokenizer(self, batch, output_dir, is_trajectory=False):
-        batch = recursive_to(batch, device=self.device)
-        decoder_out = self.struct_tokenizer.detokenize(
-            batch["structok"], batch["res_mask"]
-        )
-
-        save_with_aatype = (
-            self.aatype_corrupt or self._infer_cfg.task == "forward_folding"
-        )
-        if save_with_aatype:
-            decoder_out["aatype"] = batch["aatype"]
-        decoder_out["header"] = batch["header"]
-
-        self.struct_tokenizer.output_to_pdb(
-            decoder_out, output_dir, is_trajectory=is_trajectory
-        )
-        log.info(f"Saved predicted structures to {output_dir}")
-
     @torch.no_grad()
     def run_tokenize(self, pdb_folder, output_dir):
 
@@ -320,45 +322,17 @@ class EvalRunner:
 
             all_data.append(feats)
 
-        dataloader = torch.utils.data.DataLoader(
+        # batched by length, see tokenize_pdb.iter_length_batches
+        batches = iter_length_batches(
             all_data,
-            batch_size=1,
-            shuffle=False,
-            drop_last=False,
-            collate_fn=collate_fn,
+            max_batch_size=self._infer_cfg.get("tokenize_batch_size", 64),
+            max_num_res_squared=self._infer_cfg.get(
+                "tokenize_max_num_res_squared", 1_000_000
+            ),
         )
-
-        all_header_struct_seq = []
-        all_header_aa_seq = []
-        pbar = tqdm(dataloader)
-        for batch in pbar:
-            pdb_name = batch["pdb_name"][0]
-            pbar.set_description(
-                f"Tokenize: {pdb_name} (L={batch['seq_length'][0]})"
-            )
-            batch = recursive_to(batch, device=self.device)
-
-            struct_ids = self.struct_tokenizer.tokenize(
-                batch["all_atom_positions"],
-                batch["res_mask"],
-                batch["seq_length"],
-            )
-            struct_seq = self.struct_tokenizer.struct_ids_to_seq(
-                struct_ids.cpu().tolist()[0]
-            )
-            all_header_struct_seq.append((pdb_name, struct_seq))
-
-            aa_seq = du.aatype_to_seq(batch["aatype"].cpu().tolist()[0])
-            all_header_aa_seq.append((pdb_name, aa_seq))
-
-        output_struct_fasta_path = os.path.join(output_dir, "struct_seq.fasta")
-        fasta.FastaFile.write_iter(
-            output_struct_fasta_path, all_header_struct_seq
+        output_struct_fasta_path, _ = tokenize_batches(
+            self.struct_tokenizer, batches, output_dir
         )
-
-        output_aa_fasta_path = os.path.join(output_dir, "aa_seq.fasta")
-        fasta.FastaFile.write_iter(output_aa_fasta_path, all_header_aa_seq)
-
         return output_struct_fasta_path, all_data
 
     def evaluate_reconstruction(self, pdb_folder, inplace_save=False):
@@ -408,11 +382,12 @@ class EvalRunner:
 
         eval_dir = os.path.join(self.inference_dir, "eval")
         pbar = tqdm(dataloader)
-        for batch in pbar:
-            pbar.set_description(
-                f"Eval Reconstruction: {batch['pdb_name'][0]} (L={batch['seq_length'][0]})"
-            )
-            self.run_evaluation(batch, eval_dir)
+        with self.self_consistency_pipeline(eval_dir):
+            for batch in pbar:
+                pbar.set_description(
+                    f"Eval Reconstruction: {batch['pdb_name'][0]} (L={batch['seq_length'][0]})"
+                )
+                self.run_evaluation(batch, eval_dir)
 
         return eval_dir
 
@@ -437,11 +412,12 @@ class EvalRunner:
         )
 
         pbar = tqdm(dataloader)
-        for batch in pbar:
-            pbar.set_description(
-                f"{batch['pdb_name'][0]} (L={batch['seq_length'][0]})"
-            )
-            self.run_evaluation(batch, eval_dir)
+        with self.self_consistency_pipeline(eval_dir):
+            for batch in pbar:
+                pbar.set_description(
+                    f"{batch['pdb_name'][0]} (L={batch['seq_length'][0]})"
+                )
+                self.run_evaluation(batch, eval_dir)
 
         return eval_dir
 
@@ -478,11 +454,12 @@ class EvalRunner:
             collate_fn=collate_fn,
         )
         pbar = tqdm(dataloader)
-        for batch in pbar:
-            pbar.set_description(
-                f"{batch['pdb_name'][0]} (L={batch['seq_length'][0]})"
-            )
-            self.run_evaluation(batch, eval_dir)
+        with self.self_consistency_pipeline(eval_dir):
+            for batch in pbar:
+                pbar.set_description(
+                    f"{batch['pdb_name'][0]} (L={batch['seq_length'][0]})"
+                )
+                self.run_evaluation(batch, eval_dir)
 
         return eval_dir
 
@@ -542,13 +519,14 @@ class EvalRunner:
         )
 
         pbar = tqdm(dataloader)
-        for batch in pbar:
-            # if batch['pdb_name'][0] != '7fh0_B':
-            #     continue
-            pbar.set_description(
-                f"{batch['pdb_name'][0]} (L={batch['seq_length'][0]})"
-            )
-            self.run_evaluation(batch, eval_dir)
+        with self.self_consistency_pipeline(eval_dir):
+            for batch in pbar:
+                # if batch['pdb_name'][0] != '7fh0_B':
+                #     continue
+                pbar.set_description(
+                    f"{batch['pdb_name'][0]} (L={batch['seq_length'][0]})"
+                )
+                self.run_evaluation(batch, eval_dir)
 
         return eval_dir
 
@@ -782,8 +760,29 @@ class EvalRunner:
             zip(range(num_batch), sample_ids),
             total=num_batch,
             desc=f"{sample_length}",
+            disable=self._sc_pipeline is not None,
         ):
             sample_dir = sample_dirs[i]
+            if self._sc_pipeline is not None:
+                # evaluated in the background, see sc_pipeline
+                self._sc_pipeline.submit(
+                    dict(
+                        model_traj=model_trajs[i],
+                        bb_traj=bb_trajs[i],
+                        aa_traj=aa_trajs[i],
+                        clean_aa_traj=clean_aa_trajs[i],
+                        true_bb_pos=true_bb_pos,
+                        true_aa=true_aatype,
+                        diffuse_mask=diffuse_mask,
+                        sample_id=sample_id,
+                        sample_length=sample_lengths[i],
+                        sample_dir=sample_dir,
+                        aatypes_corrupt=self.aatype_corrupt,
+                        also_fold_pmpnn_seq=self._infer_cfg.also_fold_pmpnn_seq,
+                        write_sample_trajectories=self._infer_cfg.write_sample_trajectories,
+                    )
+                )
+                continue
             top_sample_df = self.compute_sample_metrics(
                 batch,
                 model_trajs[i],
@@ -800,18 +799,71 @@ class EvalRunner:
                 also_fold_pmpnn_seq=self._infer_cfg.also_fold_pmpnn_seq,
                 write_sample_trajectories=self._infer_cfg.write_sample_trajectories,
             )
-            top_sample_csv_path = os.path.join(sample_dir, "top_sample.csv")
-            top_sample_df.to_csv(top_sample_csv_path)
+            self._save_top_sample(sample_dir, top_sample_df)
+
+    @staticmethod
+    def _save_top_sample(sample_dir, top_sample_df):
+        top_sample_csv_path = os.path.join(sample_dir, "top_sample.csv")
+        top_sample_df.to_csv(top_sample_csv_path)
+
+    @contextmanager
+    def self_consistency_pipeline(self, eval_dir):
+        """Within this context, `run_evaluation` submits the samples to a
+        `SelfConsistencyPipeline` instead of evaluating them one by one,
+        if `inference.pipeline.enabled`. The stats of the pipeline are
+        saved to `<eval_dir>/pipeline_stats.json` on exit, also if it
+        fails. ProteinMPNN subprocesses (without `pmpnn_in_process`) run at
+        most `pipeline.max_pmpnn_subprocesses` at once, as each loads the
+        model on the GPU."""
+        pipeline_cfg = self._infer_cfg.get("pipeline", None)
+        if pipeline_cfg is None or not pipeline_cfg.get("enabled", False):
+            yield
+            return
+        self._sc_pipeline = SelfConsistencyPipeline(
+            prepare_fn=self.prepare_sample,
+            fold_fn=self.design_and_fold_samples,
+            score_fn=partial(self.score_sample, task=self._infer_cfg.task),
+            on_result=lambda job, top_sample_df: self._save_top_sample(
+                job["sample_dir"], top_sample_df
+            ),
+            num_prepare_workers=pipeline_cfg.get("num_prepare_workers", 8),
+            num_score_workers=pipeline_cfg.get("num_score_workers", 8),
+            max_fold_jobs=pipeline_cfg.get("max_fold_jobs", 16),
+            queue_size=pipeline_cfg.get("queue_size", 32),
+            log_interval=pipeline_cfg.get("log_interval", 60.0),
+        )
+        self._pmpnn_slots = threading.BoundedSemaphore(
+            pipeline_cfg.get("max_pmpnn_subprocesses", 2)
+        )
+        try:
+            yield
+        finally:
+            pipeline, self._sc_pipeline = self._sc_pipeline, None
+            try:
+                pipeline.close()
+            finally:
+                self._pmpnn_slots = None
+                stats = pipeline.summary()
+                os.makedirs(eval_dir, exist_ok=True)
+                stats_path = os.path.join(eval_dir, "pipeline_stats.json")
+                with open(stats_path, "w") as f:
+                    json.dump(stats, f, indent=2)
+            log.info(
+                f"Self-consistency pipeline finished in "
+                f"{stats['elapsed_seconds']:.0f} s, "
+                f"{stats['score']['samples_per_hour']:.0f} samples/hour."
+            )
 
     def run_pmpnn(
         self,
         write_dir,
         pdb_input_path,
     ):
-        self.folding_model.run_pmpnn(
-            write_dir,
-            pdb_input_path,
-        )
+        with self._pmpnn_slots or nullcontext():
+            self.folding_model.run_pmpnn(
+                write_dir,
+                pdb_input_path,
+            )
         mpnn_fasta_path = os.path.join(
             write_dir,
             "seqs",
@@ -844,6 +896,37 @@ class EvalRunner:
         also_fold_pmpnn_seq,
         write_sample_trajectories,
     ):
+        job = self.prepare_sample(
+            dict(
+                model_traj=model_traj,
+                bb_traj=bb_traj,
+                aa_traj=aa_traj,
+                clean_aa_traj=clean_aa_traj,
+                true_bb_pos=true_bb_pos,
+                true_aa=true_aa,
+                diffuse_mask=diffuse_mask,
+                sample_id=sample_id,
+                sample_length=sample_length,
+                sample_dir=sample_dir,
+                aatypes_corrupt=aatypes_corrupt,
+                also_fold_pmpnn_seq=also_fold_pmpnn_seq,
+                write_sample_trajectories=write_sample_trajectories,
+            )
+        )
+        job = self.design_samples([job])[0]
+        folded = self.fold_samples([job])[0]
+        return self.score_sample(job, folded, self._infer_cfg.task)
+
+    def prepare_sample(self, job):
+        """Write the PDB of a sample and design its sequences with PMPNN,
+        i.e., the stages of `compute_sample_metrics` before folding."""
+        model_traj = job["model_traj"]
+        bb_traj = job["bb_traj"]
+        aa_traj = job["aa_traj"]
+        clean_aa_traj = job["clean_aa_traj"]
+        diffuse_mask = job["diffuse_mask"]
+        sample_dir = job["sample_dir"]
+        write_sample_trajectories = job["write_sample_trajectories"]
 
         noisy_traj_length, sample_length, _, _ = bb_traj.shape
         clean_traj_length = model_traj.shape[0]
@@ -876,13 +959,20 @@ class EvalRunner:
         )
         shutil.copy(pdb_path, pmpnn_pdb_path)
         assert (diffuse_mask == 1.0).all()
-        if not self._infer_cfg.no_self_consistency:
+        design_backbone = None
+        if self._infer_cfg.no_self_consistency:
+            pmpnn_fasta_path = None
+        elif self._folding_cfg.get("pmpnn_in_process", False):
+            # designed in batches with other samples, see `design_samples`
+            design_backbone = bb_traj[-1]
+            pmpnn_fasta_path = os.path.join(
+                sc_output_dir, "seqs", "sample_modified.fasta"
+            )
+        else:
             pmpnn_fasta_path = self.run_pmpnn(
                 sc_output_dir,
                 pmpnn_pdb_path,
             )
-        else:
-            pmpnn_fasta_path = None
 
         os.makedirs(
             os.path.join(sc_output_dir, "codesign_seqs"), exist_ok=True
@@ -900,21 +990,147 @@ class EvalRunner:
         if os.path.exists(folded_dir):
             shutil.rmtree(folded_dir)
         os.makedirs(folded_dir, exist_ok=False)
+
+        # the trajectories are no longer needed
+        job = {
+            k: v
+            for k, v in job.items()
+            if k not in ("model_traj", "bb_traj", "clean_aa_traj")
+        }
+        job.update(
+            pdb_path=pdb_path,
+            pmpnn_fasta_path=pmpnn_fasta_path,
+            codesign_fasta_path=codesign_fasta_path,
+            folded_dir=folded_dir,
+            aa_traj=aa_traj,
+            design_backbone=design_backbone,
+        )
+        return job
+
+    def design_samples(self, jobs):
+        """Design the sequences of the prepared samples `jobs` left to the
+        in-process ProteinMPNN (`FoldingModel.design_sequences`), all at
+        once. Their sequences are kept as `pmpnn_seqs` (header -> sequence)
+        and written to `pmpnn_fasta_path`, as `run_pmpnn` does."""
+        pending = [job for job in jobs if job["design_backbone"] is not None]
+        if pending:
+            designed = self.folding_model.design_sequences(
+                [job["design_backbone"] for job in pending],
+                aatypes=[job["aa_traj"][-1] for job in pending],
+            )
+            for job, seqs in zip(pending, designed):
+                job["pmpnn_seqs"] = {
+                    f"pmpnn_seq_{i + 1}": seq for i, seq in enumerate(seqs)
+                }
+                os.makedirs(
+                    os.path.dirname(job["pmpnn_fasta_path"]), exist_ok=True
+                )
+                fasta.FastaFile.write_iter(
+                    job["pmpnn_fasta_path"], job["pmpnn_seqs"].items()
+                )
+        for job in jobs:
+            job["design_backbone"] = None
+        return jobs
+
+    def design_and_fold_samples(self, jobs):
+        # the GPU stages of the self-consistency pipeline
+        return self.fold_samples(self.design_samples(jobs))
+
+    @staticmethod
+    def _fold_requests(job):
+        # the sequences folded for the metrics of a sample
+        if job["aatypes_corrupt"]:
+            requests = {"codesign": job["codesign_fasta_path"]}
+            if job["also_fold_pmpnn_seq"]:
+                requests["pmpnn"] = job["pmpnn_fasta_path"]
+        elif job["pmpnn_fasta_path"] is not None:
+            requests = {"pmpnn": job["pmpnn_fasta_path"]}
+        else:
+            # do not perform self-consistency evaluation
+            requests = {}
+        return requests
+
+    def fold_samples(self, jobs):
+        """Fold the sequences of the prepared samples `jobs`, all at once
+        with ESMFold (see `FoldingModel.fold_sequences`). Returns, per job,
+        the outputs of `FoldingModel.fold_fasta` of each of its fasta."""
+        folded = [{} for _ in jobs]
+        if self._folding_cfg.folding_model != "esmf":
+            for job, job_folded in zip(jobs, folded):
+                for name, fasta_path in self._fold_requests(job).items():
+                    job_folded[name] = self.folding_model.fold_fasta(
+                        fasta_path, job["folded_dir"]
+                    )
+            return folded
+
+        sequences, keys, requests = {}, {}, []
+        for j, job in enumerate(jobs):
+            for name, fasta_path in self._fold_requests(job).items():
+                if name == "pmpnn" and "pmpnn_seqs" in job:
+                    fasta_seqs = job["pmpnn_seqs"]
+                else:
+                    fasta_seqs = fasta.FastaFile.read(fasta_path)
+                headers = []
+                for header, seq in fasta_seqs.items():
+                    sequences[f"{j}/{name}/{header}"] = seq
+                    keys[f"{j}/{name}/{header}"] = (j, name, header)
+                    headers.append(header)
+                requests.append((j, name, headers))
+
+        outputs = {}
+        for batch in self.folding_model.fold_sequences(sequences):
+            for result in batch:
+                j, name, header = keys[result["header"]]
+                folded_path = os.path.join(
+                    jobs[j]["folded_dir"], f"folded_{header}.pdb"
+                )
+                with open(folded_path, "w") as f:
+                    f.write(result["pdb"])
+                outputs[j, name, header] = (
+                    folded_path,
+                    result["plddt"],
+                    result["seq"],
+                )
+
+        # in the order of the fasta files, as fold_fasta
+        for j, name, headers in requests:
+            rows = [outputs[j, name, header] for header in headers]
+            folded[j][name] = pd.DataFrame(
+                {
+                    "folded_path": [row[0] for row in rows],
+                    "header": headers,
+                    "plddt": [row[1] for row in rows],
+                    "seq": [row[2] for row in rows],
+                }
+            )
+        return folded
+
+    @staticmethod
+    def score_sample(job, folded, task):
+        """Score a sample against its folded sequences `folded` (see
+        `fold_samples`) and select its top sample, i.e., the stages of
+        `compute_sample_metrics` after folding. Runs in the processes of
+        the self-consistency pipeline, hence static."""
+        pdb_path = job["pdb_path"]
+        true_bb_pos = job["true_bb_pos"]
+        true_aa = job["true_aa"]
+        aa_traj = job["aa_traj"]
+        sample_id = job["sample_id"]
+        sample_length = job["sample_length"]
+        sample_dir = job["sample_dir"]
+        aatypes_corrupt = job["aatypes_corrupt"]
+        also_fold_pmpnn_seq = job["also_fold_pmpnn_seq"]
+        pmpnn_fasta_path = job["pmpnn_fasta_path"]
+
         if aatypes_corrupt:
             # codesign metrics
-            folded_output = self.folding_model.fold_fasta(
-                codesign_fasta_path, folded_dir
-            )
             mpnn_results = eu.process_folded_outputs(
-                pdb_path, folded_output, true_bb_pos
+                pdb_path, folded["codesign"], true_bb_pos
             )
 
             if also_fold_pmpnn_seq:
-                pmpnn_folded_output = self.folding_model.fold_fasta(
-                    pmpnn_fasta_path, folded_dir
-                )
                 pmpnn_results = eu.process_folded_outputs(
-                    pdb_path, pmpnn_folded_output, true_bb_pos
+                    pdb_path, folded["pmpnn"], true_bb_pos
                 )
                 pmpnn_results.to_csv(
                     os.path.join(sample_dir, "pmpnn_results.csv")
@@ -922,16 +1138,8 @@ class EvalRunner:
 
         else:
             # non-codesign metrics (unconditional, inverse folding)
-            if pmpnn_fasta_path is not None:
-                folded_output = self.folding_model.fold_fasta(
-                    pmpnn_fasta_path, folded_dir
-                )
-            else:
-                folded_output = (
-                    None  # do not perform self-consistency evaluation
-                )
             mpnn_results = eu.process_folded_outputs(
-                pdb_path, folded_output, true_bb_pos
+                pdb_path, folded.get("pmpnn"), true_bb_pos
             )
 
         # mpnn_results = eu.process_folded_outputs(pdb_path, folded_output, true_bb_pos)
@@ -963,7 +1171,10 @@ class EvalRunner:
 
             # get seq recovery for PMPNN as well
             if also_fold_pmpnn_seq:
-                pmpnn_fasta = fasta.FastaFile.read(pmpnn_fasta_path)
+                if "pmpnn_seqs" in job:
+                    pmpnn_fasta = job["pmpnn_seqs"]
+                else:
+                    pmpnn_fasta = fasta.FastaFile.read(pmpnn_fasta_path)
                 pmpnn_fasta_str = pmpnn_fasta["pmpnn_seq_1"]
                 pmpnn_fasta_idx = torch.tensor(
                     [restypes_with_x.index(x) for x in pmpnn_fasta_str]
@@ -989,19 +1200,19 @@ class EvalRunner:
         del mpnn_results["sequence"]
 
         # Select the top sample
-        if self._infer_cfg.task.startswith("unconditional"):
+        if task.startswith("unconditional"):
             top_sample = mpnn_results.sort_values(
                 "bb_tmscore", ascending=False
             ).iloc[:1]
-        elif self._infer_cfg.task.startswith("reconstruction"):
+        elif task.startswith("reconstruction"):
             top_sample = mpnn_results.sort_values(
                 "bb_tmscore_to_gt", ascending=False
             ).iloc[:1]
-        elif self._infer_cfg.task == "forward_folding":
+        elif task == "forward_folding":
             top_sample = mpnn_results.sort_values(
                 "bb_tmscore_to_gt", ascending=False
             ).iloc[:1]
-        elif self._infer_cfg.task == "inverse_folding":
+        elif task == "inverse_folding":
             top_sample = mpnn_results.sort_values(
                 "bb_rmsd", ascending=True
             ).iloc[:1]
@@ -1030,7 +1241,11 @@ class EvalRunner:
         metrics_df.to_csv(designable_csv_path, index=False)
         if self._infer_cfg.calculate_diversity:
             eu.calculate_diversity(
-                output_dir, metrics_df, top_sample_csv, designable_csv_path
+                output_dir,
+                metrics_df,
+                top_sample_csv,
+                designable_csv_path,
+                score_store=self._infer_cfg.get("diversity_score_store", None),
             )
         if self.aatype_corrupt and self._infer_cfg.also_fold_pmpnn_seq:
             # co-design metrics
@@ -20,15 +20,67 @@ import numpy as np
 import pandas as pd
 import torch
 from biotite.sequence.io import fasta
+from openfold.np.protein import Protein as OFProtein
+from openfold.np.protein import to_pdb
+from openfold.utils.feats import atom14_to_atom37
+
+from byprot.datamodules.dataset.batch_sampler import pack_batches
+from byprot.utils.protein.pmpnn import ProteinMPNNRunner
+
+
+def esmf_output_to_pdbs(output, lengths):
+    """PDB strings of the sequences of a batched `ESMFold.infer` output, as
+    `ESMFold.output_to_pdb`, but each cut to its `lengths` (i.e., without
+    the trailing padding residues of the batch)."""
+    final_atom_positions = (
+        atom14_to_atom37(output["positions"][-1], output).cpu().numpy()
+    )
+    keys = ["aatype", "atom37_atom_exists", "residue_index", "plddt"]
+    if "chain_index" in output:
+        keys.append("chain_index")
+    output = {k: output[k].cpu().numpy() for k in keys}
+    pdbs = []
+    for i, length in enumerate(lengths):
+        pred = OFProtein(
+            aatype=output["aatype"][i, :length],
+            atom_positions=final_atom_positions[i, :length],
+            atom_mask=output["atom37_atom_exists"][i, :length],
+            residue_index=output["residue_index"][i, :length] + 1,
+            b_factors=output["plddt"][i, :length],
+            chain_index=(
+                output["chain_index"][i, :length]
+                if "chain_index" in output
+                else None
+            ),
+        )
+        pdbs.append(to_pdb(pred))
+    return pdbs
 
 
 class FoldingModel:
-    def __init__(self, cfg, device_id=None):
+    """Folding of sequences with ESMFold (in process) or AF2 (ColabFold),
+    and inverse folding with ProteinMPNN.
+
+    ESMFold folds sequences in batches of similar lengths, of at most
+    `esmf_max_batch_size` sequences and `esmf_max_num_res_squared`
+    (batch size * length^2) residues^2, with the chunk size
+    `esmf_chunk_size` of the folding trunk (None: not chunked). The model
+    is `esm.pretrained.<esmf_model>` (default: `esmfold_v1`).
+
+    ProteinMPNN runs either as subprocesses per structure (`run_pmpnn`),
+    or in process (`design_sequences`, see `pmpnn.ProteinMPNNRunner`)
+    with the weights `pmpnn_model_name` (default: `v_48_020`) and batches
+    of at most `pmpnn_max_batch_size` sequences and `pmpnn_max_tokens`
+    residues.
+    """
+
+    def __init__(self, cfg, device_id=None, device=None):
         self._print_logger = logging.getLogger(__name__)
         self._cfg = cfg
         self._esmf = None
+        self._pmpnn = None
         self._device_id = device_id
-        self._device = None
+        self._device = device
 
     @property
     def device_id(self):
@@ -53,35 +105,93 @@ class FoldingModel:
             )
         return folded_output
 
-    @torch.no_grad()
-    def _esmf_model(self, fasta_path, output_dir):
+    @property
+    def esmf(self):
         if self._esmf is None:
             self._print_logger.info(f"Loading ESMFold on device {self.device}")
             # torch.hub.set_dir(self._cfg.pt_hub_dir)
-            self._esmf = esm.pretrained.esmfold_v1().eval().to(self.device)
+            esmf_model = self._cfg.get("esmf_model", "esmfold_v1")
+            self._esmf = (
+                getattr(esm.pretrained, esmf_model)().eval().to(self.device)
+            )
+            self._esmf.set_chunk_size(self._cfg.get("esmf_chunk_size", None))
+        return self._esmf
+
+    @torch.no_grad()
+    def fold_sequences(self, sequences, output_dir=None):
+        """Fold `sequences` (a dict of header -> sequence, or a list) with
+        ESMFold, in batches of similar lengths (see the class docstring).
+
+        Yields, per batch, a list of dicts of `index` (in `sequences`),
+        `header`, `seq`, `pdb` (the PDB string), `plddt` (mean pLDDT) and,
+        with `output_dir`, `folded_path`, where the PDB is written as
+        `folded_<header>.pdb`.
+        """
+        if isinstance(sequences, dict):
+            headers, sequences = list(sequences), list(sequences.values())
+        else:
+            headers = [str(i) for i in range(len(sequences))]
+        # Need to convert unknown amino acids to alanine since ESMFold
+        # doesn't like them and will remove them...
+        sequences = [seq.replace("X", "A") for seq in sequences]
+        if not sequences:
+            return
+
+        lengths = np.array([len(seq) for seq in sequences])
+        order = np.argsort(lengths, kind="stable")
+        bounds, _ = pack_batches(
+            lengths[order],
+            max_tokens=np.iinfo(np.int64).max,
+            max_batch=self._cfg.get("esmf_max_batch_size", 16),
+            max_square_tokens=self._cfg.get(
+                "esmf_max_num_res_squared", 2_000_000
+            ),
+        )
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            indices = order[start:end].tolist()
+            batch_seqs = [sequences[i] for i in indices]
+            esmf_outputs = self.esmf.infer(batch_seqs)
+            pdbs = esmf_output_to_pdbs(
+                esmf_outputs, [len(seq) for seq in batch_seqs]
+            )
+            mean_plddt = esmf_outputs["mean_plddt"].tolist()
+            results = []
+            for i, seq, pdb, plddt in zip(
+                indices, batch_seqs, pdbs, mean_plddt
+            ):
+                result = {
+                    "index": i,
+                    "header": headers[i],
+                    "seq": seq,
+                    "pdb": pdb,
+                    "plddt": plddt,
+                }
+                if output_dir is not None:
+                    result["folded_path"] = os.path.join(
+                        output_dir, f"folded_{headers[i]}.pdb"
+                    )
+                    with open(result["folded_path"], "w") as f:
+                        f.write(pdb)
+                results.append(result)
+            yield results
+
+    def _esmf_model(self, fasta_path, output_dir):
         fasta_seqs = fasta.FastaFile.read(fasta_path)
-        folded_outputs = {
-            "folded_path": [],
-            "header": [],
-            "plddt": [],
-            "seq": [],
-        }
-        for header, string in fasta_seqs.items():
-            # Run ESMFold
-            # Need to convert unknown amino acids to alanine since ESMFold
-            # doesn't like them and will remove them...
-            string = string.replace("X", "A")
-            esmf_sample_path = os.path.join(output_dir, f"folded_{header}.pdb")
-            esmf_outputs = self._esmf.infer(string)
-            pdb_output = self._esmf.output_to_pdb(esmf_outputs)[0]
-            with open(esmf_sample_path, "w") as f:
-                f.write(pdb_output)
-            mean_plddt = esmf_outputs["mean_plddt"][0].item()
-            folded_outputs["folded_path"].append(esmf_sample_path)
-            folded_outputs["header"].append(header)
-            folded_outputs["plddt"].append(mean_plddt)
-            folded_outputs["seq"].append(string)
-        return pd.DataFrame(folded_outputs)
+        results = [
+            result
+            for batch in self.fold_sequences(
+                dict(fasta_seqs.items()), output_dir
+            )
+            for result in batch
+        ]
+        # in the order of the fasta file
+        results.sort(key=lambda result: result["index"])
+        return pd.DataFrame(
+            {
+                key: [result[key] for result in results]
+                for key in ["folded_path", "header", "plddt", "seq"]
+            }
+        )
 
     def _af2_model(self, fasta_path, output_dir):
         af2_args = [
@@ -181,6 +291,27 @@ class FoldingModel:
         )
         _ = process.wait()
 
+    @property
+    def pmpnn(self):
+        if self._pmpnn is None:
+            self._pmpnn = ProteinMPNNRunner(
+                pmpnn_path=self._cfg.pmpnn_path,
+                model_name=self._cfg.get("pmpnn_model_name", "v_48_020"),
+                device=self.device,
+                seq_per_sample=self._cfg.seq_per_sample,
+                sampling_temp=0.1,
+                seed=38,
+                max_batch_size=self._cfg.get("pmpnn_max_batch_size", 64),
+                max_tokens=self._cfg.get("pmpnn_max_tokens", 65536),
+            )
+        return self._pmpnn
+
+    def design_sequences(self, backbones, aatypes=None):
+        """Design `seq_per_sample` sequences for each of `backbones`
+        (atom37 coordinates) with the in-process ProteinMPNN, with the
+        sampling temperature and seed of `run_pmpnn`."""
+        return self.pmpnn.design(backbones, aatypes=aatypes)
+
     # def run_pmpnn(self, input_dir, output_path):
 
     #     os.makedirs(os.path.join(input_dir, "seqs"), exist_ok=True)
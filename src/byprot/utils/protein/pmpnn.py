@@ -0,0 +1,248 @@
+# Copyright (c) 2025 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+"""In-process inverse folding with ProteinMPNN.
+
+`ProteinMPNNRunner` keeps a ProteinMPNN model resident and designs
+sequences for many backbones at once, from their atom37 coordinates in
+memory, instead of running `helper_scripts/parse_multiple_chains.py` and
+`protein_mpnn_run.py` (which reloads the weights) as subprocesses per
+structure and reading their fasta back, e.g.,
+
+    runner = ProteinMPNNRunner(
+        pmpnn_path="vendor/ProteinMPNN", device="cuda:0", seq_per_sample=8
+    )
+    seqs = runner.design([atom37_a, atom37_b])  # [[8 seqs], [8 seqs]]
+
+The model is the `ProteinMPNN` of the `protein_mpnn_utils.py` of
+`pmpnn_path`, with the vanilla weights `model_name`, or any module with
+the same `sample` interface passed as `model` (e.g., a small stand-in for
+testing). Backbones are single chains and all their residues are
+designed, as `FoldingModel.run_pmpnn` does.
+"""
+
+import importlib.util
+import os
+
+import numpy as np
+import torch
+
+from byprot import utils
+from byprot.datamodules.dataset.batch_sampler import pack_batches
+from byprot.utils.protein.residue_constants import atom_order, restypes_with_x
+
+log = utils.get_logger(__name__)
+
+# the amino acid order of ProteinMPNN
+MPNN_ALPHABET = "ACDEFGHIKLMNPQRSTVWYX"
+BACKBONE_ATOMS = [atom_order[atom] for atom in ("N", "CA", "C", "O")]
+_AATYPE_TO_MPNN = np.array([MPNN_ALPHABET.index(aa) for aa in restypes_with_x])
+
+
+def load_protein_mpnn(pmpnn_path, model_name="v_48_020", device="cpu"):
+    """The ProteinMPNN of a checkout of its repository at `pmpnn_path`,
+    with the vanilla weights `model_name`, as `protein_mpnn_run.py`
+    loads it."""
+    spec = importlib.util.spec_from_file_location(
+        "protein_mpnn_utils",
+        os.path.join(pmpnn_path, "protein_mpnn_utils.py"),
+    )
+    protein_mpnn_utils = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(protein_mpnn_utils)
+
+    checkpoint_path = os.path.join(
+        pmpnn_path, "vanilla_model_weights", f"{model_name}.pt"
+    )
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    model = protein_mpnn_utils.ProteinMPNN(
+        ca_only=False,
+        num_letters=21,
+        node_features=128,
+        edge_features=128,
+        hidden_dim=128,
+        num_encoder_layers=3,
+        num_decoder_layers=3,
+        augment_eps=0.0,
+        k_neighbors=checkpoint["num_edges"],
+    )
+    model.load_state_dict(checkpoint["model_state_dict"])
+    return model.to(device).eval()
+
+
+def featurize_backbones(backbones, aatypes=None, device="cpu"):
+    """The inputs of `ProteinMPNN.sample` for single-chain `backbones`
+    (atom37 coordinates, [L, 37, 3] each) padded to the longest, as
+    `tied_featurize` of ProteinMPNN makes them from parsed PDBs: `X`
+    [B, L, 4, 3] (N, CA, C, O), `S` [B, L] (`aatypes` in the residue
+    order of `restypes_with_x`, or X), `mask` [B, L] (residues with the
+    four atoms), `chain_M` [B, L] (the residues of the chain, all
+    designed), `chain_encoding_all` and `residue_idx`."""
+    max_len = max(len(backbone) for backbone in backbones)
+    num = len(backbones)
+    X = np.zeros((num, max_len, 4, 3), dtype=np.float32)
+    S = np.full((num, max_len), MPNN_ALPHABET.index("X"), dtype=np.int64)
+    mask = np.zeros((num, max_len), dtype=np.float32)
+    chain_M = np.zeros((num, max_len), dtype=np.float32)
+    chain_encoding_all = np.zeros((num, max_len), dtype=np.int64)
+    residue_idx = np.full((num, max_len), -100000, dtype=np.int64)
+    for i, backbone in enumerate(backbones):
+        length = len(backbone)
+        bb_pos = np.asarray(backbone, dtype=np.float32)[:, BACKBONE_ATOMS]
+        # atoms at the origin are missing, as in `write_prot_to_pdb`
+        atom_mask = np.abs(bb_pos).sum(-1) > 1e-7
+        X[i, :length] = bb_pos
+        mask[i, :length] = atom_mask.all(-1)
+        chain_M[i, :length] = 1
+        chain_encoding_all[i, :length] = 1
+        residue_idx[i, :length] = np.arange(length)
+        if aatypes is not None and aatypes[i] is not None:
+            # anything past the amino acids (e.g., mask) is X
+            aatype = np.minimum(
+                np.asarray(aatypes[i]), len(restypes_with_x) - 1
+            )
+            S[i, :length] = _AATYPE_TO_MPNN[aatype]
+
+    def to_tensor(x):
+        return torch.from_numpy(x).to(device)
+
+    return {
+        "X": to_tensor(X),
+        "S": to_tensor(S),
+        "mask": to_tensor(mask),
+        "chain_M": to_tensor(chain_M),
+        "chain_encoding_all": to_tensor(chain_encoding_all),
+        "residue_idx": to_tensor(residue_idx),
+    }
+
+
+class ProteinMPNNRunner(object):
+    """Designs `seq_per_sample` sequences per backbone with a resident
+    ProteinMPNN (see the module docstring), at `sampling_temp`, without
+    the amino acids of `omit_aas`.
+
+    The copies of the backbones are sampled in batches of similar lengths,
+    of at most `max_batch_size` rows and `max_tokens` (rows * length)
+    residues. Sampling is seeded with `seed` at every `design` call, so
+    the same backbones (in the same order) give the same sequences.
+    """
+
+    def __init__(
+        self,
+        model=None,
+        pmpnn_path=None,
+        model_name="v_48_020",
+        device="cpu",
+        seq_per_sample=8,
+        sampling_temp=0.1,
+        omit_aas="X",
+        seed=38,
+        max_batch_size=64,
+        max_tokens=65536,
+    ):
+        if model is None and pmpnn_path is None:
+            raise ValueError("Either `model` or `pmpnn_path` is required.")
+        self._model = model
+        self.pmpnn_path = pmpnn_path
+        self.model_name = model_name
+        self.device = device
+        self.seq_per_sample = seq_per_sample
+        self.sampling_temp = sampling_temp
+        self.omit_aas = np.array(
+            [aa in omit_aas for aa in MPNN_ALPHABET], dtype=np.float32
+        )
+        self.seed = seed
+        self.max_batch_size = max_batch_size
+        self.max_tokens = max_tokens
+
+    @property
+    def model(self):
+        if self._model is None:
+            log.info(
+                f"Loading ProteinMPNN {self.model_name} on device "
+                f"{self.device}"
+            )
+            self._model = load_protein_mpnn(
+                self.pmpnn_path, self.model_name, self.device
+            )
+        return self._model
+
+    def _sample(self, features):
+        X, mask, chain_M = features["X"], features["mask"], features["chain_M"]
+        num, length = mask.shape
+        # all residues are designed, without PSSM or biases
+        zeros = torch.zeros(num, length, 21, device=X.device)
+        sample = self.model.sample(
+            X,
+            torch.randn(chain_M.shape, device=X.device),
+            features["S"],
+            chain_M,
+            features["chain_encoding_all"],
+            features["residue_idx"],
+            mask=mask,
+            temperature=self.sampling_temp,
+            omit_AAs_np=self.omit_aas,
+            bias_AAs_np=np.zeros(21, dtype=np.float32),
+            chain_M_pos=torch.ones_like(mask),
+            omit_AA_mask=zeros,
+            pssm_coef=torch.zeros_like(mask),
+            pssm_bias=zeros,
+            pssm_multi=0.0,
+            pssm_log_odds_flag=False,
+            pssm_log_odds_mask=zeros,
+            pssm_bias_flag=False,
+            bias_by_res=zeros,
+        )
+        # every residue of the chain, as `protein_mpnn_run.py` writes them,
+        # i.e., those missing backbone atoms keep their input residue
+        designed = chain_M.bool().cpu().numpy()
+        return [
+            "".join(MPNN_ALPHABET[aa] for aa in row[keep])
+            for row, keep in zip(sample["S"].cpu().numpy(), designed)
+        ]
+
+    @torch.no_grad()
+    def design(self, backbones, aatypes=None):
+        """Design sequences for `backbones` (atom37 coordinates, [L, 37, 3]
+        arrays or tensors, with `aatypes` [L] as the native sequences).
+        Returns, per backbone, a list of `seq_per_sample` sequences."""
+        backbones = [
+            bb.cpu().numpy() if torch.is_tensor(bb) else np.asarray(bb)
+            for bb in backbones
+        ]
+        if aatypes is not None:
+            aatypes = [
+                aa.cpu().numpy() if torch.is_tensor(aa) else aa
+                for aa in aatypes
+            ]
+        designed = [[] for _ in backbones]
+        if not backbones:
+            return designed
+
+        # the copies of each backbone, sorted by length
+        rows = np.repeat(np.arange(len(backbones)), self.seq_per_sample)
+        lengths = np.array([len(backbones[i]) for i in rows])
+        order = np.argsort(lengths, kind="stable")
+        rows, lengths = rows[order], lengths[order]
+        # copies longer than max_tokens are batches of their own, which
+        # are sampled all the same
+        bounds, _ = pack_batches(lengths, self.max_tokens, self.max_batch_size)
+
+        device = torch.device(self.device)
+        with torch.random.fork_rng(
+            devices=[device] if device.type == "cuda" else []
+        ):
+            torch.manual_seed(self.seed)
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                batch = rows[start:end]
+                features = featurize_backbones(
+                    [backbones[i] for i in batch],
+                    aatypes=(
+                        [aatypes[i] for i in batch]
+                        if aatypes is not None
+                        else None
+                    ),
+                    device=device,
+                )
+                for i, seq in zip(batch, self._sample(features)):
+                    designed[i].append(seq)
+        return designed
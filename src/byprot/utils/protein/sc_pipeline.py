@@ -0,0 +1,262 @@
+# Copyright (c) 2025 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+"""Staged pipeline for the self-consistency evaluation of samples, see
+`EvalRunner` in `evaluator_dplm2`.
+
+Samples flow through three stages connected by bounded queues:
+
+- `prepare`: writing the PDB of a sample and designing its sequences
+  (ProteinMPNN subprocesses), in a pool of threads.
+- `fold`: folding the sequences of as many samples as are ready at once
+  (and designing them before, with an in-process ProteinMPNN), in a
+  single thread that keeps the GPU busy.
+- `score`: parsing the folded structures back and scoring them (RMSD /
+  TM-score, secondary structure), in a pool of processes.
+
+so that the CPU-bound and subprocess-bound stages of some samples overlap
+with the folding of others. `submit` blocks while the pipeline is full.
+Per stage, the processed samples, throughput, busy time and queue depths
+are logged every `log_interval` seconds and returned by `close`.
+"""
+
+import multiprocessing as mp
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from byprot import utils
+
+log = utils.get_logger(__name__)
+
+_DONE = object()
+
+
+class _StageStats(object):
+    def __init__(self, name, num_workers):
+        self.name = name
+        self.num_workers = num_workers
+        self.count = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.num_depths = 0
+        self._lock = threading.Lock()
+
+    def record(self, count, busy, failed=0):
+        with self._lock:
+            self.count += count
+            self.failed += failed
+            self.busy += busy
+
+    def record_depth(self, depth):
+        with self._lock:
+            self.depth_sum += depth
+            self.depth_max = max(self.depth_max, depth)
+            self.num_depths += 1
+
+    def summary(self, elapsed):
+        return {
+            "samples": self.count,
+            "failed": self.failed,
+            "samples_per_hour": self.count / elapsed * 3600
+            if elapsed > 0
+            else 0.0,
+            # busy time per worker over the wall time of the pipeline
+            "utilization": self.busy / (elapsed * self.num_workers)
+            if elapsed > 0
+            else 0.0,
+            "mean_queue_depth": self.depth_sum / self.num_depths
+            if self.num_depths
+            else 0.0,
+            "max_queue_depth": self.depth_max,
+        }
+
+
+class SelfConsistencyPipeline(object):
+    """Runs `prepare_fn(job) -> job`, `fold_fn(jobs) -> [folded]` and
+    `score_fn(job, folded) -> result` over the submitted jobs, see the
+    module docstring, and calls `on_result(job, result)` in the main
+    process as results come.
+
+    `score_fn` runs in processes (started with `mp_context`, `spawn` by
+    default as the parent holds CUDA), so it and its arguments must be
+    picklable. `fold_fn` gets up to `max_fold_jobs` jobs at a time. Jobs
+    failing in any stage are logged and skipped, and `close` raises once
+    all others are done if any failed.
+    """
+
+    def __init__(
+        self,
+        prepare_fn,
+        fold_fn,
+        score_fn,
+        on_result,
+        num_prepare_workers=8,
+        num_score_workers=8,
+        max_fold_jobs=16,
+        queue_size=32,
+        log_interval=60.0,
+        mp_context="spawn",
+    ):
+        self.prepare_fn = prepare_fn
+        self.fold_fn = fold_fn
+        self.score_fn = score_fn
+        self.on_result = on_result
+        self.max_fold_jobs = max_fold_jobs
+        self.log_interval = log_interval
+
+        self._prepare_queue = queue.Queue(maxsize=queue_size)
+        self._fold_queue = queue.Queue(maxsize=queue_size)
+        # bounds the jobs submitted to the score processes
+        self._score_slots = threading.BoundedSemaphore(queue_size)
+        self._score_pending = 0
+        self._score_lock = threading.Lock()
+        self._score_pool = ProcessPoolExecutor(
+            num_score_workers, mp_context=mp.get_context(mp_context)
+        )
+
+        self.stats = {
+            "prepare": _StageStats("prepare", num_prepare_workers),
+            "fold": _StageStats("fold", 1),
+            "score": _StageStats("score", num_score_workers),
+        }
+        self._errors = []
+        self._start = time.perf_counter()
+        self._last_log = self._start
+
+        self._prepare_threads = [
+            threading.Thread(target=self._prepare_loop, daemon=True)
+            for _ in range(num_prepare_workers)
+        ]
+        self._fold_thread = threading.Thread(
+            target=self._fold_loop, daemon=True
+        )
+        for thread in self._prepare_threads + [self._fold_thread]:
+            thread.start()
+
+    def _fail(self, stage, job, error):
+        log.error(
+            f"Self-consistency {stage} failed for "
+            f"{job.get('sample_dir', job)}: {error!r}"
+        )
+        self.stats[stage].record(0, 0.0, failed=1)
+        self._errors.append(error)
+
+    def _prepare_loop(self):
+        while True:
+            job = self._prepare_queue.get()
+            if job is _DONE:
+                return
+            start = time.perf_counter()
+            try:
+                job = self.prepare_fn(job)
+            except Exception as e:
+                self._fail("prepare", job, e)
+                continue
+            self.stats["prepare"].record(1, time.perf_counter() - start)
+            self._fold_queue.put(job)
+
+    def _fold_loop(self):
+        done = False
+        while not done:
+            jobs = [self._fold_queue.get()]
+            # and whatever else is ready, up to max_fold_jobs
+            while len(jobs) < self.max_fold_jobs:
+                try:
+                    jobs.append(self._fold_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _DONE in jobs:
+                done = True
+                jobs = [job for job in jobs if job is not _DONE]
+            if not jobs:
+                continue
+            self.stats["fold"].record_depth(self._fold_queue.qsize())
+
+            start = time.perf_counter()
+            try:
+                folded = self.fold_fn(jobs)
+            except Exception as e:
+                for job in jobs:
+                    self._fail("fold", job, e)
+                continue
+            self.stats["fold"].record(len(jobs), time.perf_counter() - start)
+            for job, job_folded in zip(jobs, folded):
+                self._submit_score(job, job_folded)
+            self._maybe_log()
+
+    def _submit_score(self, job, folded):
+        self._score_slots.acquire()
+        with self._score_lock:
+            self._score_pending += 1
+            self.stats["score"].record_depth(self._score_pending)
+        submitted = time.perf_counter()
+        future = self._score_pool.submit(self.score_fn, job, folded)
+
+        def _done(future):
+            with self._score_lock:
+                self._score_pending -= 1
+            self._score_slots.release()
+            try:
+                result = future.result()
+                self.on_result(job, result)
+            except Exception as e:
+                self._fail("score", job, e)
+                return
+            # including the wait for a free process
+            self.stats["score"].record(1, time.perf_counter() - submitted)
+
+        future.add_done_callback(_done)
+
+    def _maybe_log(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self._last_log < self.log_interval:
+            return
+        self._last_log = now
+        elapsed = now - self._start
+        log.info(
+            f"Self-consistency pipeline after {elapsed:.0f} s: "
+            + ", ".join(
+                f"{name} {stats.count} done "
+                f"({stats.summary(elapsed)['samples_per_hour']:.0f}/h)"
+                for name, stats in self.stats.items()
+            )
+            + f", queue depths: prepare {self._prepare_queue.qsize()}, "
+            f"fold {self._fold_queue.qsize()}, score {self._score_pending}"
+        )
+
+    def submit(self, job):
+        """Queue `job` (a dict), blocking while the pipeline is full."""
+        self.stats["prepare"].record_depth(self._prepare_queue.qsize())
+        self._prepare_queue.put(job)
+
+    def summary(self):
+        """The stats per stage so far, as returned by `close`."""
+        elapsed = time.perf_counter() - self._start
+        summary = {
+            name: stats.summary(elapsed) for name, stats in self.stats.items()
+        }
+        summary["elapsed_seconds"] = elapsed
+        return summary
+
+    def close(self):
+        """Wait for all submitted jobs, and return the stats per stage."""
+        for _ in self._prepare_threads:
+            self._prepare_queue.put(_DONE)
+        for thread in self._prepare_threads:
+            thread.join()
+        self._fold_queue.put(_DONE)
+        self._fold_thread.join()
+        self._score_pool.shutdown(wait=True)
+
+        self._maybe_log(force=True)
+        summary = self.summary()
+        if self._errors:
+            raise RuntimeError(
+                f"Self-consistency evaluation failed for {len(self._errors)} "
+                f"samples, the first with: {self._errors[0]!r}"
+            )
+        return summary
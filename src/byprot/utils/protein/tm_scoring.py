@@ -0,0 +1,327 @@
+# Copyright (c) 2025 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+"""Batched structure scoring: RMSD and TM-score.
+
+For structures whose residues correspond one to one (e.g., a sample and
+the structures folded from its designed sequences), `superimposed_rmsd`
+and `tm_score` score whole batches of pairs at once, with batched
+(weighted) Kabsch superpositions in torch:
+
+- `superimposed_rmsd`: the RMSD after the optimal superposition, as
+  `openfold.utils.superimposition.superimpose`.
+- `tm_score`: the TM-score of the correspondence, searched as the
+  TMscore program does, i.e., from the superpositions of fragments of the
+  structure, refined iteratively on the residues within `d0_search`.
+
+For structures without a correspondence (e.g., novelty or diversity
+between samples), `TMAlignScorer` runs the sequence-independent TM-align
+(tmtools) of PDB files in a pool of processes, and caches the scores by
+the content hash of the files, so pairs scored before are not aligned
+again. `TMAlignScorer.matrix` scores a set of queries against a set of
+references, or all-vs-all.
+"""
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+from byprot import utils
+from byprot.datamodules.pdb_dataset import utils as du
+
+log = utils.get_logger(__name__)
+
+
+def tm_d0(length):
+    """The distance scale d0 of the TM-score of `length` residues."""
+    length = np.asarray(length, dtype=np.float64)
+    d0 = 1.24 * np.cbrt(np.maximum(length, 19.0) - 15.0) - 1.8
+    return np.maximum(d0, 0.5)
+
+
+def _to_tensor(x, dtype=torch.float64):
+    if torch.is_tensor(x):
+        return x.to(dtype)
+    return torch.as_tensor(np.asarray(x), dtype=dtype)
+
+
+def kabsch(pos_1, pos_2, weights):
+    """Superimpose `pos_1` onto `pos_2` ([..., N, 3]), minimizing the
+    `weights` ([..., N]) weighted squared distances. Returns the
+    superimposed `pos_1`."""
+    weights = weights[..., None]
+    total = weights.sum(-2, keepdim=True).clamp(min=1e-8)
+    center_1 = (pos_1 * weights).sum(-2, keepdim=True) / total
+    center_2 = (pos_2 * weights).sum(-2, keepdim=True) / total
+    centered_1 = pos_1 - center_1
+    centered_2 = pos_2 - center_2
+    covariance = (centered_1 * weights).transpose(-1, -2) @ centered_2
+    u, _, vh = torch.linalg.svd(covariance)
+    # a rotation, not a reflection
+    sign = torch.sign(torch.linalg.det(u @ vh))
+    vh = torch.cat(
+        [vh[..., :2, :], vh[..., 2:, :] * sign[..., None, None]], -2
+    )
+    return centered_1 @ (u @ vh) + center_2
+
+
+def superimposed_rmsd(pos_1, pos_2, mask=None):
+    """RMSD of the pairs of `pos_1` and `pos_2` ([B, N, 3]) over the
+    atoms of `mask` ([B, N] or [N]), after superimposing them there.
+    Returns a [B] array."""
+    pos_1, pos_2 = _to_tensor(pos_1), _to_tensor(pos_2)
+    if mask is None:
+        mask = torch.ones(pos_1.shape[:-1], dtype=pos_1.dtype)
+    mask = _to_tensor(mask, pos_1.dtype).expand(pos_1.shape[:-1])
+    aligned = kabsch(pos_1, pos_2, mask)
+    squared = ((aligned - pos_2) ** 2).sum(-1)
+    rmsd = torch.sqrt((squared * mask).sum(-1) / mask.sum(-1).clamp(min=1e-8))
+    return rmsd.cpu().numpy()
+
+
+def _seed_fragments(length, seeds_per_level=16, min_fragment=4):
+    # (start, length) of the fragments seeding the superpositions: the
+    # whole structure, then fragments of L / 2, L / 4, ... residues down to
+    # `min_fragment`, at about `seeds_per_level` evenly spaced starts each
+    # (all starts, in the TMscore program)
+    seeds = [(0, length)]
+    fragment = length // 2
+    while fragment >= min_fragment:
+        stride = max(1, (length - fragment) // seeds_per_level)
+        seeds.extend(
+            (start, fragment)
+            for start in range(0, length - fragment + 1, stride)
+        )
+        fragment //= 2
+    return seeds
+
+
+def tm_score(pos_1, pos_2, mask=None, num_iters=20, seeds_per_level=16):
+    """TM-score of the pairs of `pos_1` and `pos_2` ([B, N, 3] CA
+    coordinates, residue i of one corresponding to residue i of the
+    other) over the residues of `mask` ([B, N] or [N]), normalized by
+    their number. Returns a [B] array.
+
+    The superposition is searched as the TMscore program does: starting
+    from the superpositions on fragments of the structure (see
+    `_seed_fragments`), each is refined `num_iters` times on the residues
+    closer than d0_search after the previous one, and the best TM-score
+    is kept. All pairs and fragments are superimposed at once.
+    """
+    pos_1, pos_2 = _to_tensor(pos_1), _to_tensor(pos_2)
+    num_pairs, max_len = pos_1.shape[:2]
+    if mask is None:
+        mask = torch.ones(pos_1.shape[:-1], dtype=torch.bool)
+    mask = _to_tensor(mask, torch.bool).expand(num_pairs, max_len)
+    lengths = mask.sum(-1).cpu().numpy()
+    d0 = _to_tensor(tm_d0(lengths))[:, None, None]
+    d0_search = d0.clamp(4.5, 8.0)
+
+    # the seeds as masks over the ranks of the residues in `mask`
+    seeds = [
+        _seed_fragments(int(length), seeds_per_level=seeds_per_level)
+        for length in lengths
+    ]
+    num_seeds = max(len(s) for s in seeds)
+    starts = torch.zeros(num_pairs, num_seeds, 1, dtype=torch.long)
+    ends = torch.zeros(num_pairs, num_seeds, 1, dtype=torch.long)
+    for i, pair_seeds in enumerate(seeds):
+        # padded with the whole structure
+        pair_seeds = pair_seeds + [pair_seeds[0]] * (
+            num_seeds - len(pair_seeds)
+        )
+        for j, (start, length) in enumerate(pair_seeds):
+            starts[i, j], ends[i, j] = start, start + length
+    rank = (mask.cumsum(-1) - 1)[:, None, :]
+    valid = mask[:, None, :]
+    weights = (valid & (rank >= starts) & (rank < ends)).to(pos_1.dtype)
+
+    pos_1 = pos_1[:, None].expand(-1, num_seeds, -1, -1)
+    pos_2 = pos_2[:, None].expand(-1, num_seeds, -1, -1)
+    valid = valid.to(pos_1.dtype)
+    norm = _to_tensor(np.maximum(lengths, 1))[:, None]
+    best = torch.zeros(num_pairs, dtype=pos_1.dtype)
+    for _ in range(num_iters):
+        aligned = kabsch(pos_1, pos_2, weights)
+        dist = torch.linalg.norm(aligned - pos_2, dim=-1)
+        scores = (valid / (1 + (dist / d0) ** 2)).sum(-1) / norm
+        best = torch.maximum(best, scores.max(-1).values)
+        # refine on the residues within d0_search, or the 3 closest
+        dist = dist.masked_fill(valid == 0, float("inf"))
+        closest = dist.topk(min(3, max_len), dim=-1, largest=False).values
+        cutoff = torch.maximum(d0_search, closest[..., -1:])
+        weights = ((dist <= cutoff) & (valid > 0)).to(pos_1.dtype)
+    return best.cpu().numpy()
+
+
+def _read_ca(path):
+    # CA coordinates and sequence of the first chain of a PDB file, for
+    # TM-align
+    feats = du.parse_pdb_feats("pdb", path, chain_id=None)
+    feats = next(iter(feats.values()))
+    return feats["bb_positions"], du.aatype_to_seq(feats["aatype"])
+
+
+def _try_read_ca(path):
+    # None if unreadable (kept by content hash, so not read again), scored
+    # as NaN
+    try:
+        return _read_ca(path)
+    except Exception as e:
+        log.warning(f"Failed to read {path}: {e!r}")
+        return None
+
+
+def _tm_align(structure_1, structure_2):
+    from tmtools import tm_align
+
+    if structure_1 is None or structure_2 is None:
+        return np.nan, np.nan
+    (pos_1, seq_1), (pos_2, seq_2) = structure_1, structure_2
+    try:
+        result = tm_align(np.float64(pos_1), np.float64(pos_2), seq_1, seq_2)
+    except Exception as e:
+        log.warning(f"TM-align failed: {e!r}")
+        return np.nan, np.nan
+    return result.tm_norm_chain1, result.tm_norm_chain2
+
+
+def _tm_align_chunk(pairs):
+    return [_tm_align(s_1, s_2) for s_1, s_2 in pairs]
+
+
+class TMAlignScorer(object):
+    """Sequence-independent TM-align of PDB files in a pool of
+    `num_workers` processes, with the scores cached by the content hash
+    of the files (see the module docstring).
+
+    `cache` maps `(hash_1, hash_2)` to the TM-scores of the pair
+    normalized by the length of each, i.e., `(tm_1, tm_2)`, and is an
+    in-memory dict by default. Any mapping with `get` and `__setitem__`
+    works, e.g., a persistent store shared across runs.
+
+    Pairs with a file that cannot be read, or that TM-align fails on,
+    score NaN (as the `TMalign` binary failing in `cal_tmscore.py`), and
+    are not cached.
+    """
+
+    def __init__(
+        self, num_workers=None, cache=None, chunk_size=64, block_size=100_000
+    ):
+        self.num_workers = num_workers or os.cpu_count()
+        self.cache = {} if cache is None else cache
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        self._hashes = {}
+        # CA coordinates and sequences of the files read, by hash
+        self._structures = {}
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        if key not in self._hashes:
+            with open(path, "rb") as f:
+                self._hashes[key] = hashlib.sha1(f.read()).hexdigest()
+        return self._hashes[key]
+
+    def _cached(self, key):
+        score = self.cache.get(key)
+        if score is None:
+            # the same pair the other way around
+            score = self.cache.get(key[::-1])
+            if score is not None:
+                score = tuple(score)[::-1]
+        return score
+
+    def align_pairs(self, pairs):
+        """TM-scores `(tm_1, tm_2)` of the pairs of PDB files `pairs`,
+        aligning only those not cached."""
+        keys = [
+            (self.file_hash(p_1), self.file_hash(p_2)) for p_1, p_2 in pairs
+        ]
+        todo = {}
+        for key, pair in zip(keys, pairs):
+            # each pair is aligned once, either way around
+            if key[::-1] not in todo and self._cached(key) is None:
+                todo[key] = pair
+        failed = {}
+        if todo:
+            log.info(
+                f"TM-aligning {len(todo)} new pairs of {len(pairs)} with "
+                f"{self.num_workers} processes."
+            )
+            failed = self._align(todo)
+        scores = []
+        for key in keys:
+            if key in failed or key[::-1] in failed:
+                scores.append((np.nan, np.nan))
+            else:
+                scores.append(tuple(self._cached(key)))
+        return scores
+
+    def _align(self, todo):
+        keys = list(todo)
+        paths = {key[k]: todo[key][k] for key in keys for k in range(2)}
+        new = [h for h in paths if h not in self._structures]
+        with ProcessPoolExecutor(self.num_workers) as pool:
+            new_paths = [paths[h] for h in new]
+            self._structures.update(
+                zip(new, pool.map(_try_read_ca, new_paths, chunksize=16))
+            )
+            structures = self._structures
+            chunks = [
+                [
+                    (structures[key[0]], structures[key[1]])
+                    for key in keys[i : i + self.chunk_size]
+                ]
+                for i in range(0, len(keys), self.chunk_size)
+            ]
+            results = pool.map(_tm_align_chunk, chunks)
+            failed = set()
+            for i, chunk_scores in enumerate(results):
+                offset = i * self.chunk_size
+                for key, score in zip(keys[offset:], chunk_scores):
+                    if np.isnan(score).any():
+                        failed.add(key)
+                    else:
+                        self.cache[key] = score
+        return failed
+
+    def matrix(self, queries, references=None):
+        """TM-scores [Q, R] of the PDB files `queries` against
+        `references`, normalized by the length of the query (i.e., as
+        `analysis/cal_tmscore.py`). Without `references`, the all-vs-all
+        matrix of `queries`, with each pair aligned once. Pairs are
+        aligned in blocks of about `block_size`."""
+        if references is not None:
+            scores = np.zeros((len(queries), len(references)))
+            rows = max(1, self.block_size // max(len(references), 1))
+            for start in range(0, len(queries), rows):
+                pairs = [
+                    (q, r)
+                    for q in queries[start : start + rows]
+                    for r in references
+                ]
+                block = [tm_1 for tm_1, _ in self.align_pairs(pairs)]
+                scores[start : start + rows] = np.reshape(
+                    block, (-1, len(references))
+                )
+            return scores
+
+        num = len(queries)
+        rows, cols = np.triu_indices(num, k=1)
+        scores = np.eye(num)
+        for start in range(0, len(rows), self.block_size):
+            block = slice(start, start + self.block_size)
+            pairs = [
+                (queries[i], queries[j])
+                for i, j in zip(rows[block], cols[block])
+            ]
+            for i, j, (tm_1, tm_2) in zip(
+                rows[block], cols[block], self.align_pairs(pairs)
+            ):
+                scores[i, j], scores[j, i] = tm_1, tm_2
+        return scores
@@ -0,0 +1,206 @@
+# Copyright (c) 2025 Bytedance Ltd. and/or its affiliates
+# SPDX-License-Identifier: Apache-2.0
+
+"""A persistent store of pairwise TM-scores, for diversity and novelty.
+
+`TMScoreStore` keeps the TM-align scores of pairs of structures in a
+SQLite database, keyed by the content hash of their PDB files (see
+`tm_scoring.TMAlignScorer`, which it serves as the cache of). Scoring a
+set of structures only aligns the pairs not in the store, so evaluating
+new samples of a generation config against the same references, or
+re-clustering them with a few new ones, costs the new pairs only, e.g.,
+
+    store = TMScoreStore("tm_scores.sqlite", num_workers=32)
+    clusters = store.clusters(sample_paths, threshold=0.5)  # diversity
+    novelty = store.max_tm_to_references(sample_paths, pdb_paths)
+
+Pairs are stored once, either way around, with the TM-scores normalized
+by the length of each structure.
+"""
+
+import os
+import sqlite3
+
+import numpy as np
+
+from byprot import utils
+from byprot.utils.protein.tm_scoring import TMAlignScorer
+
+log = utils.get_logger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS structures (
+    hash TEXT PRIMARY KEY,
+    path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tm_scores (
+    hash_1 TEXT NOT NULL,
+    hash_2 TEXT NOT NULL,
+    tm_1 REAL NOT NULL,
+    tm_2 REAL NOT NULL,
+    PRIMARY KEY (hash_1, hash_2)
+) WITHOUT ROWID;
+"""
+
+
+class TMScoreStore(object):
+    """TM-scores of pairs of structures in the SQLite database `path` (see
+    the module docstring), aligned with a `TMAlignScorer` of
+    `num_workers` processes when missing.
+
+    As the cache of the scorer, it maps `(hash_1, hash_2)` to
+    `(tm_1, tm_2)`. New scores are written in batches of `flush_every`,
+    and at the end of every query.
+    """
+
+    def __init__(self, path, num_workers=None, flush_every=10_000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.flush_every = flush_every
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(_SCHEMA)
+        self._pending = {}
+        # the scores of the pairs of the current query, loaded at once
+        self._prefetched = {}
+        self.scorer = TMAlignScorer(num_workers=num_workers, cache=self)
+
+    def __len__(self):
+        self.flush()
+        (count,) = self._conn.execute(
+            "SELECT COUNT(*) FROM tm_scores"
+        ).fetchone()
+        return count
+
+    @staticmethod
+    def _canonical(key):
+        return key if key[0] <= key[1] else key[::-1]
+
+    def get(self, key, default=None):
+        canonical = self._canonical(key)
+        score = self._pending.get(canonical) or self._prefetched.get(canonical)
+        if score is None:
+            score = self._conn.execute(
+                "SELECT tm_1, tm_2 FROM tm_scores "
+                "WHERE hash_1 = ? AND hash_2 = ?",
+                canonical,
+            ).fetchone()
+        if score is None:
+            return default
+        return tuple(score) if canonical == key else tuple(score)[::-1]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        score = self.get(key)
+        if score is None:
+            raise KeyError(key)
+        return score
+
+    def __setitem__(self, key, score):
+        canonical = self._canonical(key)
+        score = tuple(score) if canonical == key else tuple(score)[::-1]
+        self._pending[canonical] = score
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tm_scores VALUES (?, ?, ?, ?)",
+                [key + score for key, score in self._pending.items()],
+            )
+        self._pending = {}
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def hashes(self, paths):
+        """The content hashes of the PDB files `paths`, which are recorded
+        with their paths."""
+        hashes = [self.scorer.file_hash(path) for path in paths]
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO structures VALUES (?, ?)",
+                [(h, os.path.abspath(p)) for h, p in zip(hashes, paths)],
+            )
+        return hashes
+
+    def _temp_hashes(self, name, hashes):
+        self._conn.execute(f"DROP TABLE IF EXISTS temp.{name}")
+        self._conn.execute(f"CREATE TEMP TABLE {name} (hash TEXT PRIMARY KEY)")
+        self._conn.executemany(
+            f"INSERT OR IGNORE INTO temp.{name} VALUES (?)",
+            [(h,) for h in hashes],
+        )
+
+    def _prefetch(self, hashes_1, hashes_2):
+        # the stored scores of all pairs between the two sets, at once
+        self._temp_hashes("set_1", hashes_1)
+        self._temp_hashes("set_2", hashes_2)
+        rows = self._conn.execute(
+            "SELECT s.* FROM tm_scores s "
+            "JOIN temp.set_1 a ON s.hash_1 = a.hash "
+            "JOIN temp.set_2 b ON s.hash_2 = b.hash "
+            "UNION "
+            "SELECT s.* FROM tm_scores s "
+            "JOIN temp.set_2 b ON s.hash_1 = b.hash "
+            "JOIN temp.set_1 a ON s.hash_2 = a.hash"
+        )
+        self._prefetched = {
+            (h_1, h_2): (tm_1, tm_2) for h_1, h_2, tm_1, tm_2 in rows
+        }
+
+    def matrix(self, queries, references=None):
+        """TM-scores of the PDB files `queries` against `references`, or
+        all-vs-all, as `TMAlignScorer.matrix`, aligning only the pairs not
+        in the store."""
+        query_hashes = self.hashes(queries)
+        reference_hashes = (
+            query_hashes if references is None else self.hashes(references)
+        )
+        self._prefetch(query_hashes, reference_hashes)
+        try:
+            return self.scorer.matrix(queries, references)
+        finally:
+            self._prefetched = {}
+            self.flush()
+
+    def max_tm_to_references(self, queries, references):
+        """The highest TM-score of each of the PDB files `queries` to
+        `references` (normalized by the length of the query), i.e., the
+        novelty of the queries is one minus it."""
+        if not len(references):
+            return np.zeros(len(queries))
+        return self.matrix(queries, references).max(1)
+
+    def clusters(self, paths, threshold=0.5):
+        """Cluster the PDB files `paths` at a TM-score of `threshold`
+        (normalized by either structure of a pair, as the coverage of both
+        in foldseek), greedily by set cover, as foldseek / MMseqs2
+        clustering: in the order of their number of similar structures,
+        each structure not yet in a cluster represents a new one, with the
+        similar structures not yet in a cluster. Returns the clusters as
+        lists of paths, the representative first."""
+        if not paths:
+            return []
+        scores = self.matrix(paths)
+        similar = np.minimum(scores, scores.T) >= threshold
+        unassigned = np.ones(len(paths), dtype=bool)
+        clusters = []
+        for i in np.argsort(-similar.sum(1), kind="stable"):
+            if not unassigned[i]:
+                continue
+            members = np.flatnonzero(similar[i] & unassigned)
+            members = [i] + [j for j in members if j != i]
+            unassigned[members] = False
+            clusters.append([paths[j] for j in members])
+        log.info(
+            f"{len(clusters)} clusters of {len(paths)} structures at a "
+            f"TM-score of {threshold}."
+        )
+        return clusters
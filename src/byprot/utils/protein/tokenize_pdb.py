@@ -4,14 +4,17 @@
 
 import argparse
 import os
+import queue
+import threading
 import warnings
 from glob import glob
 
+import numpy as np
 import torch
 import torch.utils
-from biotite.sequence.io import fasta
 from tqdm.auto import tqdm
 
+from byprot.datamodules.dataset.batch_sampler import pack_batches
 from byprot.datamodules.pdb_dataset import utils as du
 from byprot.datamodules.pdb_dataset.pdb_datamodule import (
     PdbDataset,
@@ -33,57 +36,248 @@ def load_from_pdb(pdb_path, process_chain=PdbDataset.process_chain):
     return chain_feats
 
 
-@torch.no_grad()
-def run_tokenize(struct_tokenizer, input_pdb_folder, output_dir):
-    all_data = []
+class PdbFileDataset(torch.utils.data.Dataset):
+    """Features of PDB files, parsed on access (e.g., in DataLoader
+    workers)."""
 
-    for pdb_path in glob(os.path.join(input_pdb_folder, "*.pdb")):
-        log.info(f"Processing {pdb_path}")
+    def __init__(self, pdb_paths, process_chain=PdbDataset.process_chain):
+        self.pdb_paths = pdb_paths
+        self.process_chain = process_chain
 
-        # predicted structures
-        feats = load_from_pdb(
-            pdb_path, process_chain=struct_tokenizer.process_chain
-        )
+    def __len__(self):
+        return len(self.pdb_paths)
+
+    def __getitem__(self, idx):
+        pdb_path = self.pdb_paths[idx]
+        feats = load_from_pdb(pdb_path, process_chain=self.process_chain)
         feats["pdb_path"] = pdb_path
         feats["header"] = feats["pdb_name"]
+        return feats
 
-        all_data.append(feats)
 
-    dataloader = torch.utils.data.DataLoader(
-        all_data,
-        batch_size=1,
-        shuffle=False,
-        drop_last=False,
-        collate_fn=collate_fn,
-    )
+def iter_length_batches(
+    samples,
+    max_batch_size=64,
+    max_num_res_squared=1_000_000,
+    buffer_size=1024,
+):
+    """Collate the feature dicts of `samples` into batches of similar
+    lengths, as they come.
 
-    all_header_struct_seq = []
-    all_header_aa_seq = []
-    pbar = tqdm(dataloader)
-    device = next(struct_tokenizer.parameters()).device
-    for batch in pbar:
-        pdb_name = batch["pdb_name"][0]
-        pbar.set_description(
-            f"Tokenize: {pdb_name} (L={batch['seq_length'][0]})"
-        )
-        batch = recursive_to(batch, device)
+    Samples are buffered `buffer_size` at a time, sorted by length and
+    packed into batches of at most `max_batch_size` proteins whose
+    padded length^2 * batch size stays under `max_num_res_squared`, as
+    the encoder cost grows about quadratically with the length. A protein
+    over the budget by itself makes a batch of one.
+    """
 
-        struct_ids = struct_tokenizer.tokenize(
-            batch["all_atom_positions"], batch["res_mask"], batch["seq_length"]
-        )
-        struct_seq = struct_tokenizer.struct_ids_to_seq(
-            struct_ids.cpu().tolist()[0]
+    def pack(buffer):
+        lengths = np.array([len(feats["res_mask"]) for feats in buffer])
+        order = np.argsort(lengths, kind="stable")
+        bounds, _ = pack_batches(
+            lengths[order],
+            max_tokens=np.iinfo(np.int64).max,
+            max_batch=max_batch_size,
+            max_square_tokens=max_num_res_squared,
         )
-        all_header_struct_seq.append((pdb_name, struct_seq))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield collate_fn([buffer[i] for i in order[start:end]])
 
-        aa_seq = du.aatype_to_seq(batch["aatype"].cpu().tolist()[0])
-        all_header_aa_seq.append((pdb_name, aa_seq))
+    buffer = []
+    for feats in samples:
+        buffer.append(feats)
+        if len(buffer) >= buffer_size:
+            yield from pack(buffer)
+            buffer = []
+    if buffer:
+        yield from pack(buffer)
 
-    output_struct_fasta_path = os.path.join(output_dir, "struct_seq.fasta")
-    fasta.FastaFile.write_iter(output_struct_fasta_path, all_header_struct_seq)
 
+@torch.no_grad()
+def tokenize_batches(struct_tokenizer, batches, output_dir):
+    """Tokenize the collated `batches` of structures with
+    `struct_tokenizer` (e.g., a `VQModel`), writing the structure tokens
+    and amino acids of every protein to `struct_seq.fasta` and
+    `aa_seq.fasta` in `output_dir` as the batches complete.
+
+    Returns the paths of both FASTA files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    output_struct_fasta_path = os.path.join(output_dir, "struct_seq.fasta")
     output_aa_fasta_path = os.path.join(output_dir, "aa_seq.fasta")
-    fasta.FastaFile.write_iter(output_aa_fasta_path, all_header_aa_seq)
+    device = next(struct_tokenizer.parameters()).device
+    num_proteins = 0
+    with open(output_struct_fasta_path, "w") as struct_fasta, open(
+        output_aa_fasta_path, "w"
+    ) as aa_fasta:
+        pbar = tqdm(batches, desc="Tokenize", unit="batch")
+        for batch in pbar:
+            seq_lengths = batch["seq_length"].tolist()
+            batch = recursive_to(batch, device)
+            struct_ids = struct_tokenizer.tokenize(
+                batch["all_atom_positions"],
+                batch["res_mask"],
+                batch["seq_length"],
+            )
+            # one device to host copy per batch
+            struct_ids = struct_ids.cpu().tolist()
+            aatype = batch["aatype"].cpu().tolist()
+            for i, pdb_name in enumerate(batch["pdb_name"]):
+                length = seq_lengths[i]
+                struct_seq = struct_tokenizer.struct_ids_to_seq(
+                    struct_ids[i][:length]
+                )
+                aa_seq = du.aatype_to_seq(aatype[i][:length])
+                struct_fasta.write(f">{pdb_name}\n{struct_seq}\n")
+                aa_fasta.write(f">{pdb_name}\n{aa_seq}\n")
+            struct_fasta.flush()
+            aa_fasta.flush()
+            num_proteins += len(seq_lengths)
+            pbar.set_postfix(
+                proteins=num_proteins, L=max(seq_lengths), B=len(seq_lengths)
+            )
+    log.info(f"Tokenized {num_proteins} proteins into {output_dir}")
+    return output_struct_fasta_path, output_aa_fasta_path
+
+
+class BackgroundWriter(object):
+    """Run write jobs in order on a background thread, so that they overlap
+    with the GPU work of the next batches. At most `max_pending` jobs are
+    queued; errors of the jobs are raised by :meth:`close`."""
+
+    def __init__(self, max_pending=4):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            if self._error is None:
+                try:
+                    job()
+                except Exception as e:
+                    self._error = e
+
+    def submit(self, fn, *args, **kwargs):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(lambda: fn(*args, **kwargs))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+def _write_structures(
+    struct_tokenizer, decoder_out, headers, lengths, output_dir, output_format
+):
+    for i, (header, length) in enumerate(zip(headers, lengths)):
+        # without the padding of the batch
+        sample = {k: v[i : i + 1, :length] for k, v in decoder_out.items()}
+        if output_format == "npz":
+            np.savez(
+                os.path.join(output_dir, f"{header}.npz"),
+                atom37_positions=sample["atom37_positions"][0].numpy(),
+                atom37_mask=sample["atom37_mask"][0].bool().numpy(),
+                aatype=sample["aatype"][0].to(torch.int8).numpy(),
+                residue_index=sample["residue_index"][0].int().numpy(),
+                plddt=sample["plddt"][0].half().numpy(),
+            )
+        else:
+            pdb_string = struct_tokenizer.decoder.output_to_pdb(sample)[0]
+            with open(os.path.join(output_dir, f"{header}.pdb"), "w") as f:
+                f.write(pdb_string)
+
+
+@torch.no_grad()
+def detokenize_batches(
+    struct_tokenizer,
+    batches,
+    output_dir,
+    with_aatype=False,
+    output_format="pdb",
+    max_pending=4,
+):
+    """Decode the collated `batches` of structure tokens (`structok`,
+    `res_mask` and `header`, and `aatype` with `with_aatype`) with
+    `struct_tokenizer`, e.g., from :func:`iter_length_batches`.
+
+    The outputs of a batch are copied to the host at once and written to
+    `output_dir` by a :class:`BackgroundWriter` while the next batches are
+    decoded, as `<header>.pdb` or, with `output_format="npz"`, as
+    `<header>.npz` of the atom37 positions / mask, aatype, residue index
+    and pLDDT.
+    """
+    if output_format not in ("pdb", "npz"):
+        raise ValueError(f"Unknown output format {output_format}")
+    os.makedirs(output_dir, exist_ok=True)
+    device = next(struct_tokenizer.parameters()).device
+    writer = BackgroundWriter(max_pending=max_pending)
+    num_structures = 0
+    try:
+        pbar = tqdm(batches, desc="struct detokenizer", unit="batch")
+        for batch in pbar:
+            lengths = batch["res_mask"].sum(-1).long().tolist()
+            headers = batch["header"]
+            batch = recursive_to(batch, device=device)
+            decoder_out = struct_tokenizer.detokenize(
+                batch["structok"], batch["res_mask"]
+            )
+            if with_aatype:
+                decoder_out["aatype"] = batch["aatype"]
+            decoder_out = {k: v.cpu() for k, v in decoder_out.items()}
+            writer.submit(
+                _write_structures,
+                struct_tokenizer,
+                decoder_out,
+                headers,
+                lengths,
+                output_dir,
+                output_format,
+            )
+            num_structures += len(headers)
+            pbar.set_postfix(
+                structures=num_structures, L=max(lengths), B=len(lengths)
+            )
+    finally:
+        writer.close()
+    log.info(f"Saved {num_structures} predicted structures to {output_dir}")
+    return output_dir
+
+
+def run_tokenize(
+    struct_tokenizer,
+    input_pdb_folder,
+    output_dir,
+    max_batch_size=64,
+    max_num_res_squared=1_000_000,
+    num_workers=4,
+):
+    """Tokenize the PDB files of `input_pdb_folder`, parsed by
+    `num_workers` DataLoader workers and batched by length (see
+    :func:`iter_length_batches`)."""
+    pdb_paths = sorted(glob(os.path.join(input_pdb_folder, "*.pdb")))
+    log.info(f"Tokenizing {len(pdb_paths)} PDB files of {input_pdb_folder}")
+    samples = torch.utils.data.DataLoader(
+        PdbFileDataset(
+            pdb_paths, process_chain=struct_tokenizer.process_chain
+        ),
+        batch_size=None,
+        shuffle=False,
+        num_workers=num_workers,
+    )
+    batches = iter_length_batches(
+        samples,
+        max_batch_size=max_batch_size,
+        max_num_res_squared=max_num_res_squared,
+    )
+    return tokenize_batches(struct_tokenizer, batches, output_dir)
 
 
 def main():
@@ -97,11 +291,42 @@ def main():
         type=str,
         default="./generation-results/tokenized_protein",
     )
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument(
+        "--max_num_res_squared",
+        type=int,
+        default=1_000_000,
+        help="budget of batch size * (padded length)^2 of a batch",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="DataLoader workers parsing the PDB files",
+    )
+    parser.add_argument(
+        "--device", type=str, default="cuda", help="cuda or cpu"
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=None,
+        help="intra-op threads of torch, e.g., to tokenize on cpu",
+    )
     args = parser.parse_args()
 
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
     struct_tokenizer = get_struct_tokenizer()
-    struct_tokenizer = struct_tokenizer.cuda()
-    run_tokenize(struct_tokenizer, args.input_pdb_folder, args.output_dir)
+    struct_tokenizer = struct_tokenizer.to(args.device).eval()
+    run_tokenize(
+        struct_tokenizer,
+        args.input_pdb_folder,
+        args.output_dir,
+        max_batch_size=args.max_batch_size,
+        max_num_res_squared=args.max_num_res_squared,
+        num_workers=args.num_workers,
+    )
 
 
 if __name__ == "__main__":
@@ -30,14 +30,18 @@ from biotite.sequence.io import fasta
 from openfold.np import residue_constants
 from openfold.utils import rigid_utils
 from openfold.utils import rigid_utils as ru
-from openfold.utils.superimposition import superimpose
 from pytorch_lightning.utilities.rank_zero import rank_zero_only
 from torch.nn import functional as F
 
+from byprot import utils
 from byprot.datamodules.pdb_dataset import utils as du
+from byprot.utils.protein import tm_scoring
+from byprot.utils.protein.tm_store import TMScoreStore
 
 CA_IDX = residue_constants.atom_order["CA"]
 
+log = utils.get_logger(__name__)
+
 
 Rigid = rigid_utils.Rigid
 
@@ -147,7 +151,11 @@ def get_all_top_samples(output_dir, csv_fname="*/*/top_sample.csv"):
 
 
 def calculate_diversity(
-    output_dir, metrics_df, top_sample_csv, designable_csv_path
+    output_dir,
+    metrics_df,
+    top_sample_csv,
+    designable_csv_path,
+    score_store=None,
 ):
     designable_samples = top_sample_csv[top_sample_csv.designable]
     designable_dir = os.path.join(output_dir, "designable")
@@ -165,12 +173,29 @@ def calculate_diversity(
     if metrics_df["Total codesignable"].iloc[0] <= 1:
         metrics_df["Clusters"] = metrics_df["Total codesignable"].iloc[0]
     else:
-        add_diversity_metrics(designable_dir, metrics_df, designable_csv_path)
+        add_diversity_metrics(
+            designable_dir,
+            metrics_df,
+            designable_csv_path,
+            score_store=score_store,
+        )
 
 
-def add_diversity_metrics(designable_dir, designable_csv, designable_csv_path):
+def add_diversity_metrics(
+    designable_dir, designable_csv, designable_csv_path, score_store=None
+):
     designable_txt = os.path.join(designable_dir, "designable.txt")
-    clusters = run_easy_cluster(designable_dir, designable_dir)
+    if score_store is not None:
+        # clusters by TM-align, reusing the scores of the pairs seen before
+        with open(designable_txt) as f:
+            designable_paths = f.read().split()
+        store = TMScoreStore(score_store)
+        try:
+            clusters = len(store.clusters(designable_paths, threshold=0.5))
+        finally:
+            store.close()
+    else:
+        clusters = run_easy_cluster(designable_dir, designable_dir)
     designable_csv["Clusters"] = clusters
     designable_csv.to_csv(designable_csv_path, index=False)
 
@@ -621,7 +646,51 @@ def t_stratified_loss(batch_t, batch_loss, num_bins=4, loss_name=None):
     return stratified_losses
 
 
+def _score_backbone_pairs(pairs, res_mask):
+    """Backbone RMSDs, CA RMSDs and TM-scores of `pairs` of backbones
+    ([L, 3, 3], N / CA / C) over the residues of `res_mask`, with the
+    batched scoring of `tm_scoring`, all pairs at once. Pairs that cannot
+    be superimposed (of other lengths, or with non-finite coordinates)
+    get an RMSD of 100 and a TM-score of 0."""
+    num_pairs = len(pairs)
+    bb_rmsd = np.full(num_pairs, 100.0)
+    ca_rmsd = np.full(num_pairs, 100.0)
+    bb_tmscore = np.zeros(num_pairs)
+    shape = (len(res_mask), 3, 3)
+    valid = [
+        i
+        for i, (pos_1, pos_2) in enumerate(pairs)
+        if pos_1.shape == pos_2.shape == shape
+        and np.isfinite(pos_1).all()
+        and np.isfinite(pos_2).all()
+    ]
+    if len(valid) < num_pairs:
+        log.warning(
+            f"There is a superimpose error! {num_pairs - len(valid)} of "
+            f"{num_pairs} pairs cannot be superimposed."
+        )
+    if valid:
+        pos_1 = np.stack([pairs[i][0] for i in valid])
+        pos_2 = np.stack([pairs[i][1] for i in valid])
+        bb_rmsd[valid] = tm_scoring.superimposed_rmsd(
+            pos_1.reshape(len(valid), -1, 3),
+            pos_2.reshape(len(valid), -1, 3),
+            np.repeat(res_mask, 3),
+        )
+        ca_rmsd[valid] = tm_scoring.superimposed_rmsd(
+            pos_1[:, :, CA_IDX], pos_2[:, :, CA_IDX], res_mask
+        )
+        bb_tmscore[valid] = tm_scoring.tm_score(
+            pos_1[:, :, CA_IDX], pos_2[:, :, CA_IDX], res_mask
+        )
+    return bb_rmsd, ca_rmsd, bb_tmscore
+
+
 def process_folded_outputs(sample_path, folded_output, true_bb_pos=None):
+    """Score the sample of `sample_path` against the structures folded
+    from its sequences (`folded_output`, see `FoldingModel.fold_fasta`),
+    and against its ground truth backbone `true_bb_pos` ([L * 3, 3]) if
+    given, all structures at once (see `_score_backbone_pairs`)."""
     mpnn_results = {
         "header": [],
         "sequence": [],
@@ -632,72 +701,9 @@ def process_folded_outputs(sample_path, folded_output, true_bb_pos=None):
         "folded_path": [],
     }
 
-    if true_bb_pos is not None:
-        true_ca_pos = true_bb_pos.reshape(-1, 3, 3)[..., CA_IDX, :]
-        mpnn_results["ca_rmsd_to_gt"] = []
-
-        mpnn_results["bb_rmsd_to_gt"] = []
-        mpnn_results["bb_tmscore_to_gt"] = []
-
-        mpnn_results["fold_model_bb_rmsd_to_gt"] = []
-
     sample_feats = du.parse_pdb_feats("sample", sample_path)
     sample_seq = du.aatype_to_seq(sample_feats["aatype"])
-    sample_ca_pos = sample_feats["bb_positions"]
-    sample_bb_pos = sample_feats["atom_positions"][:, :3].reshape(-1, 3)
-
-    def _calc_ca_rmsd(mask, sample_ca_pos, folded_ca_pos):
-        if "7W2P" not in sample_path:
-            rmsd = superimpose(
-                torch.tensor(sample_ca_pos)[None],
-                torch.tensor(folded_ca_pos[None]),
-                mask,
-            )[1].item()
-        else:
-            print("There is a superimpose error!")
-            rmsd = 100.0
-        return rmsd
-
-    def _calc_bb_rmsd(mask, sample_bb_pos, folded_bb_pos):
-        if (
-            "7W2P" not in sample_path
-            and "2o0a_A" not in sample_path
-            and "4bg7_A" not in sample_path
-            and "4l8o_A" not in sample_path
-            and "5k29_A" not in sample_path
-        ):
-            rmsd = superimpose(
-                torch.tensor(sample_bb_pos)[None],
-                torch.tensor(folded_bb_pos)[None],
-                mask[:, None].repeat(1, 3).reshape(-1),
-            )[1].item()
-        else:
-            print("There is a superimpose error!")
-            rmsd = 100.0
-        return rmsd
-
-    def _calc_bb_tmscore(mask, sample_bb_pos, folded_bb_pos, sample_seq):
-        if (
-            "7W2P" not in sample_path
-            and "2o0a_A" not in sample_path
-            and "4bg7_A" not in sample_path
-            and "4l8o_A" not in sample_path
-            and "5k29_A" not in sample_path
-        ):
-            bb_mask = mask[:, None].repeat(1, 3).bool()
-            _sample_seq = "A" * mask.long().sum().item()
-            _, tmscore = calc_tm_score(
-                # torch.tensor(sample_bb_pos)[mask],
-                # torch.tensor(folded_bb_pos)[mask],
-                sample_bb_pos[bb_mask.reshape(-1)].reshape(-1, 3, 3),
-                folded_bb_pos[bb_mask.reshape(-1)].reshape(-1, 3, 3),
-                _sample_seq,
-                _sample_seq,
-            )
-        else:
-            print("There is a superimpose error!")
-            tmscore = 0.0
-        return tmscore
+    sample_bb_pos = sample_feats["atom_positions"][:, :3]
 
     if folded_output is None:
         folded_output = {
@@ -708,47 +714,43 @@ def process_folded_outputs(sample_path, folded_output, true_bb_pos=None):
         }
         folded_output = pd.DataFrame(folded_output)
 
-    for _, row in folded_output.iterrows():
-        folded_feats = du.parse_pdb_feats("folded", row.folded_path)
-        seq = du.aatype_to_seq(folded_feats["aatype"])
-        folded_ca_pos = folded_feats["bb_positions"]
-        folded_bb_pos = folded_feats["atom_positions"][:, :3].reshape(-1, 3)
-
-        res_mask = torch.ones(folded_ca_pos.shape[0])
-
-        if true_bb_pos is not None:
-            res_mask = torch.tensor(true_ca_pos).abs().sum(-1) > 1e-7
-            bb_rmsd_to_gt = _calc_bb_rmsd(res_mask, sample_bb_pos, true_bb_pos)
-            ca_rmsd_to_gt = _calc_ca_rmsd(res_mask, sample_ca_pos, true_ca_pos)
-            mpnn_results["bb_rmsd_to_gt"].append(bb_rmsd_to_gt)
-            mpnn_results["ca_rmsd_to_gt"].append(ca_rmsd_to_gt)
-
-            bb_tmscore_to_gt = _calc_bb_tmscore(
-                res_mask, sample_bb_pos, true_bb_pos, sample_seq
-            )
-            mpnn_results["bb_tmscore_to_gt"].append(bb_tmscore_to_gt)
-
-            fold_model_bb_rmsd_to_gt = _calc_bb_rmsd(
-                res_mask, folded_bb_pos, true_bb_pos
-            )
-            mpnn_results["fold_model_bb_rmsd_to_gt"].append(
-                fold_model_bb_rmsd_to_gt
-            )
+    folded_feats = [
+        du.parse_pdb_feats("folded", folded_path)
+        for folded_path in folded_output.folded_path
+    ]
+    folded_bb_pos = [feats["atom_positions"][:, :3] for feats in folded_feats]
+    num_folded = len(folded_feats)
 
-            # fold_model_bb_tmscore_to_gt = _calc_bb_tmscore(res_mask, folded_bb_pos, true_bb_pos, seq)
-            # mpnn_results["fold_model_bb_tmscore_to_gt"].append(fold_model_bb_tmscore_to_gt)
-        bb_rmsd = _calc_bb_rmsd(res_mask, sample_bb_pos, folded_bb_pos)
-        ca_rmsd = _calc_ca_rmsd(res_mask, sample_ca_pos, folded_ca_pos)
-        bb_tmscore = _calc_bb_tmscore(
-            res_mask, sample_bb_pos, folded_bb_pos, seq
+    pairs = [(sample_bb_pos, bb_pos) for bb_pos in folded_bb_pos]
+    if true_bb_pos is not None:
+        true_bb_pos = true_bb_pos.reshape(-1, 3, 3)
+        res_mask = np.abs(true_bb_pos[:, CA_IDX]).sum(-1) > 1e-7
+        # the sample, then the folded structures against the ground truth
+        pairs.append((sample_bb_pos, true_bb_pos))
+        pairs.extend((bb_pos, true_bb_pos) for bb_pos in folded_bb_pos)
+    else:
+        res_mask = np.ones(
+            len(folded_bb_pos[0]) if folded_bb_pos else 0, dtype=bool
         )
-        mpnn_results["bb_rmsd"].append(bb_rmsd)
-        mpnn_results["ca_rmsd"].append(ca_rmsd)
-        mpnn_results["bb_tmscore"].append(bb_tmscore)
+    bb_rmsd, ca_rmsd, bb_tmscore = _score_backbone_pairs(pairs, res_mask)
 
+    mpnn_results["bb_rmsd"] = bb_rmsd[:num_folded].tolist()
+    mpnn_results["ca_rmsd"] = ca_rmsd[:num_folded].tolist()
+    mpnn_results["bb_tmscore"] = bb_tmscore[:num_folded].tolist()
+    if true_bb_pos is not None:
+        mpnn_results["ca_rmsd_to_gt"] = [ca_rmsd[num_folded]] * num_folded
+        mpnn_results["bb_rmsd_to_gt"] = [bb_rmsd[num_folded]] * num_folded
+        mpnn_results["bb_tmscore_to_gt"] = [
+            bb_tmscore[num_folded]
+        ] * num_folded
+        mpnn_results["fold_model_bb_rmsd_to_gt"] = bb_rmsd[
+            num_folded + 1 :
+        ].tolist()
+
+    for feats, row in zip(folded_feats, folded_output.itertuples()):
         mpnn_results["folded_path"].append(row.folded_path)
         mpnn_results["header"].append(row.header)
-        mpnn_results["sequence"].append(seq)
+        mpnn_results["sequence"].append(du.aatype_to_seq(feats["aatype"]))
         mpnn_results["mean_plddt"].append(row.plddt)
     mpnn_results = pd.DataFrame(mpnn_results)
     mpnn_results["sample_path"] = sample_path